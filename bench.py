@@ -0,0 +1,1279 @@
+# bench.py — Бенчмарки игровой логики без Telegram
+#
+# Запуск:  python bench.py [имя ...]   (без аргументов — все бенчмарки)
+# Каждый бенчмарк работает на временной копии БД и не трогает cars_bot.db.
+import os
+import sys
+import time
+import json
+import random
+import asyncio
+import tempfile
+import importlib.util
+import statistics
+import subprocess
+import tracemalloc
+from collections import Counter
+from typing import List
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+
+import aiosqlite
+import main
+
+
+async def fresh_db() -> str:
+    """Создаёт пустую временную БД и переключает на неё main.DB_PATH"""
+    fd, path = tempfile.mkstemp(suffix=".db", prefix="cars_bench_")
+    os.close(fd)
+    main.DB_PATH = path
+    # Кэши в памяти относятся к прошлой БД: то, что не поднимается при старте, чистим,
+    # остальное загружаем из новой БД теми же функциями, что и on_startup
+    for cache in (main.PENDING_NAMES, main.OWNED_CACHE, main.OWNED_MISSES, main.OWNED_BUILDS,
+                  main.RENDER_CACHE, main.VARIANT_USED):
+        cache.clear()
+    await main.init_db()
+    await main.init_rng("bench")
+    for load in (main.load_order_book, main.load_market_values, main.load_cooldowns,
+                 main.load_known_users, main.load_bans, main.load_media):
+        await load()
+    return path
+
+
+async def seed_users(count: int, start_id: int = 1, drop_credits: int = 0):
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.executemany(
+            "INSERT OR IGNORE INTO users (user_id, username, display_name, currency, drop_credits) VALUES (?, ?, ?, 'USD', ?)",
+            [(uid, f"user{uid}", f"Игрок {uid}", drop_credits) for uid in range(start_id, start_id + count)]
+        )
+        await db.commit()
+
+
+def report(name: str, ops: int, seconds: float):
+    print(f"  {name:<32} {ops:>8} оп. за {seconds:7.3f} с  ->  {ops / seconds:10.1f} оп/с")
+
+
+# ========== ВЫБИТЬ xN ==========
+
+async def bench_drops(opens: int = 2_000, batch: int = 10):
+    print(f"🎁 Выбить машину: {opens} открытий, пачка x{batch}")
+    await fresh_db()
+    await seed_users(2, drop_credits=opens)
+
+    start = time.perf_counter()
+    for _ in range(opens):
+        await main.grant_drops(1, 1)
+    report("последовательно (x1)", opens, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(opens // batch):
+        await main.grant_drops(2, batch, credits_only=True)
+    report(f"пачкой (x{batch})", opens, time.perf_counter() - start)
+
+
+# ========== РЫНОК ==========
+
+async def bench_market(open_orders: int = 10_000, trades: int = 2_000):
+    print(f"📈 Рынок: {open_orders} открытых заявок, {trades} сделок")
+    await fresh_db()
+    sellers = open_orders
+    buyers = trades
+    await seed_users(sellers + buyers)
+    car_ids = [car.id for car in main.catalog().all_cars]
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.executemany(
+            "INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at) VALUES (?, ?, 0, 'Выпала', ?)",
+            [(uid, car_ids[uid % len(car_ids)], main.now_iso()) for uid in range(1, sellers + 1)]
+        )
+        await db.execute("UPDATE users SET balance = 100000000000 WHERE user_id > ?", (sellers,))
+        await db.commit()
+    await main.load_order_book()
+
+    start = time.perf_counter()
+    for uid in range(1, sellers + 1):
+        car = main.catalog().cars_by_id[car_ids[uid % len(car_ids)]]
+        await main.place_order(uid, car.id, "ask", car.price_usd + uid)
+    report("выставление заявок (ask)", sellers, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    filled = 0
+    for i in range(buyers):
+        car = main.catalog().cars_by_id[car_ids[i % len(car_ids)]]
+        status, _, _ = await main.place_order(sellers + 1 + i, car.id, "bid", car.price_usd * 10)
+        filled += status == "filled"
+    report("сведение заявок (bid -> ask)", filled, time.perf_counter() - start)
+    print(f"  открытых заявок после сделок: {len(main.MARKET_ORDERS)}")
+
+    # Своя лучшая встречная заявка не заслоняет чужую, которая стоит за ней
+    me, other = sellers + buyers + 1, sellers + buyers + 2
+    await seed_users(2, start_id=me)
+    car = main.catalog().cars_by_id[car_ids[0]]
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.executemany(
+            "INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at) VALUES (?, ?, 0, 'Выпала', '')",
+            [(me, car.id), (other, car.id)]
+        )
+        await db.execute("UPDATE users SET balance = 100000000000 WHERE user_id = ?", (me,))
+        await db.commit()
+    await main.place_order(me, car.id, "ask", 1)
+    await main.place_order(other, car.id, "ask", 2)
+    status, _, matched = await main.place_order(me, car.id, "bid", 3)
+    assert status == "filled" and matched["user_id"] == other, (status, matched)
+    assert main.best_order(car.id, "ask")[1]["user_id"] == me
+
+
+# ========== РЫНОЧНАЯ СТОИМОСТЬ ==========
+
+async def bench_pricing(events: int = 200_000, rescans: int = 200):
+    print(f"📈 Рыночная стоимость: {events} событий")
+    await fresh_db()
+    car_ids = [car.id for car in main.catalog().all_cars]
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.executemany(
+            "INSERT INTO global_car_counts (car_id, issued_count) VALUES (?, ?)",
+            [(car_id, 1 + car_id % 7) for car_id in car_ids]
+        )
+        await db.commit()
+    await main.load_market_values()
+
+    start = time.perf_counter()
+    for i in range(events):
+        car_id = car_ids[i % len(car_ids)]
+        if i % 4:
+            main.note_issued(car_id)
+        else:
+            main.note_trade(car_id, main.catalog().prices[car_id])
+    report("инкрементально (note_*)", events, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(rescans):
+        await main.load_market_values()
+    report("полный пересчёт из БД", rescans, time.perf_counter() - start)
+
+    # Накрутка сделками: стоимость упирается в полосу, выкуп дилером от сделок не зависит
+    car = main.catalog().cars_by_id[car_ids[0]]
+    payout = main.house_price(car)
+    for _ in range(1_000):
+        main.note_trade(car.id, car.price_usd * 1_000)
+    print(f"  после накрутки: стоимость x{main.market_value(car.id) / car.price_usd:.2f}, выкуп {payout} -> {main.house_price(car)}")
+    assert main.market_value(car.id) <= car.price_usd * main.MARKET_VALUE_BAND[1]
+    assert main.house_price(car) == payout
+
+
+# ========== ЖУРНАЛ ОПЕРАЦИЙ ==========
+
+async def bench_ledger(grants: int = 4_000):
+    print(f"📒 Журнал: {grants} выдач, чередуя с журналом и без (медиана задержки)")
+    await fresh_db()
+    await seed_users(2, drop_credits=grants)
+    write_ledger = main.write_ledger
+
+    async def no_ledger(db, rows):
+        pass
+
+    # Чередуем варианты на каждой операции, чтобы шум диска делился поровну
+    latencies = {True: [], False: []}
+    for i in range(grants):
+        use_ledger = bool(i % 2)
+        main.write_ledger = write_ledger if use_ledger else no_ledger
+        start = time.perf_counter()
+        await main.grant_drops(2 if use_ledger else 1, 1)
+        latencies[use_ledger].append(time.perf_counter() - start)
+    main.write_ledger = write_ledger
+
+    without_ledger = statistics.median(latencies[False])
+    with_ledger = statistics.median(latencies[True])
+    print(f"  без журнала: {without_ledger * 1000:.3f} мс, с журналом: {with_ledger * 1000:.3f} мс")
+    overhead = (with_ledger - without_ledger) / without_ledger * 100
+    print(f"  накладные расходы журнала: {overhead:+.1f}% (цель < 10%)")
+
+    mismatches = await main.verify_ledger(2)
+    print(f"  сверка баланса по журналу: {'OK' if not mismatches else mismatches}")
+
+
+# ========== ПРОМОКОДЫ ==========
+
+async def bench_promo(redeemers: int = 10_000, cap: int = 1_000, concurrency: int = 64):
+    print(f"🎟 Промокод: {redeemers} игроков одновременно, лимит {cap} активаций")
+    await fresh_db()
+    await seed_users(redeemers)
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.execute("""
+            INSERT INTO promo_codes (code, reward_type, reward_value, max_uses, created_at)
+            VALUES ('RACE', 'money', 1000000, ?, 0)
+        """, (cap,))
+        await db.commit()
+
+    # aiosqlite держит поток на соединение — ограничиваем число одновременных обработчиков
+    limit = asyncio.Semaphore(concurrency)
+
+    async def redeem(user_id: int) -> str:
+        async with limit:
+            status, _ = await main.redeem_promo(user_id, "RACE")
+            return status
+
+    start = time.perf_counter()
+    statuses = await asyncio.gather(*(redeem(uid) for uid in range(1, redeemers + 1)))
+    report("активации (гонка)", redeemers, time.perf_counter() - start)
+
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        async with db.execute("SELECT used_count FROM promo_codes WHERE code = 'RACE'") as cursor:
+            used_count = (await cursor.fetchone())[0]
+    ok = statuses.count("ok")
+    print(f"  успешных: {ok}, отказов по лимиту: {statuses.count('exhausted')}, used_count: {used_count}")
+    assert ok == used_count == cap, "лимит промокода нарушен"
+
+
+# ========== ОБМЕН ==========
+
+async def bench_exchange(players: int = 20, cars_each: int = 3, rounds: int = 10, offers: int = 200, concurrency: int = 64):
+    print(f"🔄 Обмен: {rounds} раундов по {offers} пересекающихся предложений на {players * cars_each} машин")
+    await fresh_db()
+    await seed_users(players)
+    car_ids = [car.id for car in main.catalog().drop_cars]
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.execute("UPDATE users SET balance = 5000")
+        await db.executemany(
+            "INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at, color) VALUES (?, ?, 0, 'Выпала', ?, ?)",
+            [(uid, car_ids[(uid * cars_each + i) % len(car_ids)], main.now_iso(), f"цвет {uid}-{i}")
+             for uid in range(1, players + 1) for i in range(cars_each)]
+        )
+        await db.commit()
+    await main.init_db()  # стартовые записи журнала с балансом 5000
+
+    async def garage_rows() -> dict:
+        async with aiosqlite.connect(main.DB_PATH) as db:
+            async with db.execute("SELECT id, user_id, version, color FROM user_cars") as cursor:
+                return {row[0]: row[1:] for row in await cursor.fetchall()}
+
+    colors_before = {row_id: color for row_id, (_, _, color) in (await garage_rows()).items()}
+    rng = random.Random(7)
+    limit = asyncio.Semaphore(concurrency)
+    moved = Counter()
+    statuses = Counter()
+
+    async def propose(trade):
+        async with limit:
+            return trade, await main.exchange_cars(trade)
+
+    elapsed = 0.0
+    for _ in range(rounds):
+        # Все предложения раунда строятся по одному снимку — они конкурируют за одни и те же строки
+        rows = await garage_rows()
+        by_owner = {}
+        for row_id, (owner, version, _) in rows.items():
+            by_owner.setdefault(owner, []).append((row_id, version))
+        trades = []
+        for _ in range(offers):
+            initiator, partner = rng.sample(sorted(by_owner), 2)
+            trades.append(main.Exchange(
+                initiator_id=initiator,
+                partner_id=partner,
+                give=tuple(rng.sample(by_owner[initiator], rng.randint(0, min(2, len(by_owner[initiator]))))),
+                take=tuple(rng.sample(by_owner[partner], rng.randint(1, min(2, len(by_owner[partner]))))),
+                cash=rng.randint(-3000, 3000),
+            ))
+        start = time.perf_counter()
+        results = await asyncio.gather(*(propose(trade) for trade in trades))
+        elapsed += time.perf_counter() - start
+        for trade, status in results:
+            statuses[status] += 1
+            if status == "ok":
+                moved.update(row_id for row_id, _ in trade.give + trade.take)
+    report("предложения обмена", rounds * offers, elapsed)
+    print(f"  итог: {dict(statuses)}")
+
+    rows = await garage_rows()
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        async with db.execute("SELECT SUM(balance) FROM users") as cursor:
+            total_balance = (await cursor.fetchone())[0]
+    assert len(rows) == players * cars_each, "машины пропали или размножились"
+    assert all(version == moved[row_id] for row_id, (_, version, _) in rows.items()), "строка сменила владельца дважды по одной версии"
+    assert {row_id: color for row_id, (_, _, color) in rows.items()} == colors_before, "цвет потерялся при обмене"
+    assert total_balance == players * 5000, "доплаты не сходятся"
+    assert not await main.verify_ledger(), "журнал не сходится с балансами"
+
+
+# ========== ВХОДЯЩИЕ ПРЕДЛОЖЕНИЯ ==========
+
+async def bench_offers(open_offers: int = 100_000, players: int = 20_000, heavy: int = 5_000, lookups: int = 2_000):
+    print(f"📥 Предложения обмена: {open_offers} открытых, {players} игроков, у игрока 1 — {heavy} входящих")
+    await fresh_db()
+    await seed_users(players)
+    car_ids = [car.id for car in main.catalog().all_cars]
+    rng = random.Random(3)
+    now = int(time.time())
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.executemany(
+            "INSERT INTO user_cars (id, user_id, car_id, is_duplicate, source, acquired_at) VALUES (?, ?, ?, 0, 'Выпала', ?)",
+            [(uid, uid, car_ids[uid % len(car_ids)], main.now_iso()) for uid in range(1, players + 1)]
+        )
+        offers = []
+        offer_cars = []
+        for offer_id in range(1, open_offers + 1):
+            recipient = 1 if offer_id <= heavy else rng.randint(2, players)
+            initiator = rng.randint(2, players)
+            while initiator == recipient:
+                initiator = rng.randint(2, players)
+            # Десятая часть уже истекла — их закроет обход
+            expires_at = now - 60 if offer_id % 10 == 0 else now + rng.randint(60, main.EXCHANGE_OFFER_TTL)
+            offers.append((offer_id, initiator, recipient, expires_at))
+            offer_cars += [(offer_id, initiator, 0, "give"), (offer_id, recipient, 0, "take")]
+        await db.executemany("""
+            INSERT INTO exchange_offers (id, initiator_id, recipient_id, cash, status, created_at, expires_at)
+            VALUES (?, ?, ?, 0, 'open', 0, ?)
+        """, offers)
+        await db.executemany(
+            "INSERT INTO exchange_offer_cars (offer_id, user_car_id, version, side) VALUES (?, ?, ?, ?)", offer_cars
+        )
+        await db.commit()
+
+    timings = []
+    for _ in range(lookups):
+        start = time.perf_counter()
+        await main.list_offers(rng.randint(2, players), 0)
+        timings.append(time.perf_counter() - start)
+    report("страница входящих", lookups, sum(timings))
+    print(f"  p99 страницы: {sorted(timings)[int(len(timings) * 0.99)] * 1000:.2f} мс")
+
+    start = time.perf_counter()
+    total, page = await main.list_offers(1, 800)
+    report(f"стр. 800 из {total} (игрок 1)", 1, time.perf_counter() - start)
+
+    # Машина игрока 1 участвует во всех его входящих: обмен закрывает их разом
+    start = time.perf_counter()
+    status = await main.exchange_cars(main.Exchange(initiator_id=2, partner_id=1, give=((2, 0),), take=((1, 0),)))
+    report("обмен + инвалидация", 1, time.perf_counter() - start)
+    assert status == "ok"
+    total, _ = await main.list_offers(1, 0)
+    assert total == 0, "предложения с ушедшей машиной остались открытыми"
+
+    start = time.perf_counter()
+    rejected = await main.close_offers(3, "rejected")
+    report(f"отклонить все ({rejected} шт.)", 1, time.perf_counter() - start)
+
+    # Машину из предложения успели перекрасить: принятие закрывает его в той же транзакции
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        async with db.execute(
+            "SELECT id FROM exchange_offers WHERE status = 'open' AND expires_at > ? LIMIT 1", (int(time.time()),)
+        ) as cursor:
+            offer_id = (await cursor.fetchone())[0]
+    trade = await main.load_offer(offer_id)
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.execute("UPDATE user_cars SET version = version + 1 WHERE id = ?", (trade.give[0][0],))
+        await db.commit()
+    assert await main.exchange_cars(trade, offer_id) == "gone"
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        async with db.execute("SELECT status FROM exchange_offers WHERE id = ?", (offer_id,)) as cursor:
+            assert (await cursor.fetchone())[0] == "invalid", "предложение с ушедшей машиной осталось открытым"
+
+    start = time.perf_counter()
+    expired = 0
+    while True:
+        batch = await main.expire_offers(int(time.time()))
+        expired += len(batch)
+        if len(batch) < main.OFFER_SWEEP_BATCH:
+            break
+    report(f"обход истёкших ({expired} шт.)", expired, time.perf_counter() - start)
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        async with db.execute(
+            "SELECT COUNT(*) FROM exchange_offers WHERE status = 'open' AND expires_at <= ?", (int(time.time()),)
+        ) as cursor:
+            assert (await cursor.fetchone())[0] == 0, "истёкшие предложения остались открытыми"
+
+
+# ========== ДОХОД ОТ НЕДВИЖИМОСТИ ==========
+
+async def bench_estate_income(owners: int = 100_000, hours: int = 1):
+    print(f"🏢 Доход от недвижимости: {owners} владельцев, накоплено за {hours} ч")
+    await fresh_db()
+    await seed_users(owners)
+    rates = {
+        estate["id"]: estate["income_per_10_sec"]
+        for estates in main.catalog().real_estate.values() for estate in estates if estate.get("income_per_10_sec")
+    }
+    estate_ids = sorted(rates)
+    since = int(time.time()) - hours * 3600
+    rng = random.Random(5)
+    holdings = [
+        (uid, estate_id, since)
+        for uid in range(1, owners + 1) for estate_id in rng.sample(estate_ids, rng.randint(1, 3))
+    ]
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.executemany(
+            "INSERT INTO user_real_estate (user_id, estate_id, purchased_at, collected_at) VALUES (?, ?, '', ?)", holdings
+        )
+        await db.commit()
+    await main.init_db()  # стартовые записи журнала
+
+    now = int(time.time())
+    start = time.perf_counter()
+    settled = await main.settle_all_estate_income(now)
+    report(f"один цикл (пачки по {main.ESTATE_SETTLE_BATCH})", settled, time.perf_counter() - start)
+
+    expected = sum((now - since) // main.ESTATE_INCOME_PERIOD * rates[estate_id] for _, estate_id, _ in holdings)
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        async with db.execute("SELECT SUM(balance), SUM(real_estate_income) FROM users") as cursor:
+            balance, income = await cursor.fetchone()
+    assert settled == owners, "начислено не всем владельцам"
+    assert balance == income == expected, "начислено не столько, сколько накопилось"
+    assert await main.settle_all_estate_income(now) == 0, "повторный цикл в ту же секунду начислил ещё раз"
+    assert not await main.verify_ledger(), "журнал не сходится с балансами"
+
+    # Начисление по требованию (покупка) — тот же SQL на одного игрока
+    start = time.perf_counter()
+    for uid in range(1, 2_001):
+        await main.get_balance_with_income(uid)
+    report("по требованию, один игрок", 2_000, time.perf_counter() - start)
+
+
+# ========== ЭКРАНЫ БЕЗ ЗАПИСИ ==========
+
+def dml_statements() -> int:
+    """Сколько INSERT/UPDATE/DELETE выполнено с запуска (по статистике запросов main)"""
+    return sum(
+        stats.count for sql, stats in main.SQL_STATS.items()
+        if sql.split(None, 1)[0].upper() in ("INSERT", "UPDATE", "DELETE")
+    )
+
+
+async def bench_views(players: int = 2_000, views: int = 3_000):
+    print(f"👁 Экраны баланса и доходной недвижимости: {views} показов, у всех {players} игроков есть доход")
+    from loadtest import FakeSession, UpdateFactory
+
+    await fresh_db()
+    await seed_users(players)
+    income_estates = main.catalog().real_estate["income_property"]
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.executemany(
+            "INSERT INTO user_real_estate (user_id, estate_id, purchased_at, collected_at) VALUES (?, ?, '', ?)",
+            # Первая страница — не купленная доходная недвижимость: экран проверяет баланс
+            [(uid, income_estates[-1]["id"], int(time.time()) - 3600) for uid in range(1, players + 1)]
+        )
+        await db.commit()
+    await main.load_known_users()
+    main.bot.session = FakeSession()
+    make = UpdateFactory(main.bot)
+    rng = random.Random(11)
+
+    for data in ("menu_balance", "realestate_income"):
+        updates = [make.callback(rng.randint(1, players), data) for _ in range(views)]
+        writes = dml_statements()
+        start = time.perf_counter()
+        for update in updates:
+            await main.dp.feed_update(main.bot, update)
+        report(data, views, time.perf_counter() - start)
+        print(f"  записей в БД на показ: {(dml_statements() - writes) / views:.2f}")
+
+
+# ========== ИЗВЕСТНЫЕ ИГРОКИ ==========
+
+async def bench_known_users(players: int = 100_000, calls: int = 20_000, renames: int = 1_000):
+    print(f"👤 ensure_user: {players} игроков в памяти, {calls} вызовов, {renames} смен имени")
+    await fresh_db()
+    await seed_users(players)
+
+    start = time.perf_counter()
+    await main.load_known_users()
+    elapsed = time.perf_counter() - start
+    main.KNOWN_USERS.clear()
+    tracemalloc.start()
+    await main.load_known_users()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"  прогрев при старте: {elapsed * 1000:.0f} мс, {size / players:.0f} байт на игрока")
+
+    def user(uid: int, name: str = "Игрок") -> main.types.User:
+        return main.types.User(id=uid, is_bot=False, first_name=f"{name} {uid}", username=f"user{uid}")
+
+    rng = random.Random(5)
+    known = [user(rng.randint(1, players)) for _ in range(calls)]
+
+    # Как было: INSERT OR IGNORE и commit на каждый вызов
+    start = time.perf_counter()
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        for u in known[:calls // 10]:
+            await db.execute(
+                "INSERT OR IGNORE INTO users (user_id, username, display_name, currency) VALUES (?, ?, ?, 'USD')",
+                (u.id, u.username, u.full_name)
+            )
+            await db.commit()
+    report("INSERT OR IGNORE + commit", calls // 10, time.perf_counter() - start)
+
+    writes = dml_statements()
+    start = time.perf_counter()
+    for u in known:
+        await main.ensure_user(u)
+    report("известный игрок (память)", calls, time.perf_counter() - start)
+    assert dml_statements() == writes, "известный игрок записан в БД"
+
+    renamed = [user(uid, "Новое имя") for uid in range(1, renames + 1)]
+    newcomers = [user(uid) for uid in range(players + 1, players + 101)]
+    for u in renamed + newcomers:
+        await main.ensure_user(u)
+    assert len(main.PENDING_NAMES) == renames
+    start = time.perf_counter()
+    flushed = await main.flush_names()
+    report("запись смен имени пачкой", flushed, time.perf_counter() - start)
+
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        async with db.execute("SELECT COUNT(*) FROM users WHERE display_name LIKE 'Новое имя %'") as cursor:
+            assert (await cursor.fetchone())[0] == renames
+        async with db.execute("SELECT COUNT(*) FROM users") as cursor:
+            assert (await cursor.fetchone())[0] == players + len(newcomers)
+    print(f"  счётчики: {main.USER_CACHE_STATS}")
+
+
+# ========== КОЛЛЕКЦИЯ: БИТОВЫЕ МАСКИ ==========
+
+async def bench_ownership(players: int = 2_000, cars_each: int = 20, flips: int = 20_000, ops: int = 3_000):
+    print(f"🧩 Маски коллекции: {players} игроков по {cars_each} машин, {flips} проверок, {ops} изменений")
+    from loadtest import FakeSession, UpdateFactory
+
+    await fresh_db()
+    await seed_users(players, drop_credits=50)
+    rng = random.Random(8)
+    all_ids = [car.id for car in main.catalog().all_cars]
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.execute("UPDATE users SET balance = 1000000000")
+        await db.executemany(
+            "INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at) VALUES (?, ?, 0, 'Выпала', '')",
+            [(uid, rng.choice(all_ids)) for uid in range(1, players + 1) for _ in range(cars_each)]
+        )
+        await db.commit()
+    await main.init_db()
+    main.OWNED_CACHE.clear()
+    main.OWNED_MISSES.clear()
+    checks = [(rng.randint(1, players), rng.choice(all_ids)) for _ in range(flips)]
+
+    # Как было: запрос на каждую проверку
+    start = time.perf_counter()
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        for user_id, car_id in checks:
+            async with db.execute("SELECT 1 FROM user_cars WHERE user_id = ? AND car_id = ?", (user_id, car_id)) as cursor:
+                await cursor.fetchone()
+    report("SELECT 1 на проверку", flips, time.perf_counter() - start)
+
+    # Как в обработчиках: внутри uow(), на одном соединении — так же, как у SELECT 1 выше
+    start = time.perf_counter()
+    async with main.uow():
+        for user_id, car_id in checks:
+            await main.has_car(user_id, car_id)
+    report("has_car (холодный кэш)", flips, time.perf_counter() - start)
+    start = time.perf_counter()
+    for user_id, car_id in checks:
+        await main.has_car(user_id, car_id)
+    report("has_car (маска в кэше)", flips, time.perf_counter() - start)
+    sizes = [sys.getsizeof(mask) for mask in main.OWNED_CACHE.values()]
+    print(f"  маска: {statistics.mean(sizes):.0f} байт в среднем, max {max(sizes)}; {main.OWNED_STATS}")
+
+    main.bot.session = FakeSession()
+    make = UpdateFactory(main.bot)
+    main.HANDLER_STATS.clear()
+    for i in range(2_000):
+        await main.dp.feed_update(main.bot, make.callback(i % players + 1, f"menu_all_cars_{i % len(all_ids)}"))
+    stats = main.HANDLER_STATS["menu_all_cars"]
+    print(f"  menu_all_cars: {stats.queries / stats.count:.2f} SQL и {stats.connections / stats.count:.2f} соединений на листание")
+
+    # Выдачи, продажи, биржа и обмены вперемешку с чтением масок — кэш должен совпасть с БД
+    salon = main.catalog().salon_cars
+
+    async def change(i: int):
+        user_id = rng.randint(1, players)
+        kind = i % 5
+        if kind == 0:
+            await main.grant_drops(user_id, 3, credits_only=True)
+        elif kind == 1:
+            mask = await main.owned_mask(user_id)
+            owned = [car_id for car_id in all_ids if mask >> car_id & 1]
+            if owned:
+                await main.sell_to_house(user_id, rng.choice(owned))
+        elif kind == 2:
+            await main.purchase_car(user_id, rng.choice(salon), "salon_buy", "Куплена")
+        elif kind == 3:
+            seller = rng.randint(1, players)
+            rows = await main.owned_mask(seller)
+            owned = [car_id for car_id in all_ids if rows >> car_id & 1]
+            if owned and seller != user_id:
+                car_id = rng.choice(owned)
+                await main.place_order(seller, car_id, "ask", 1000)
+                await main.place_order(user_id, car_id, "bid", 1000)
+        else:
+            partner = rng.randint(1, players)
+            async with aiosqlite.connect(main.DB_PATH) as db:
+                async with db.execute("SELECT id, version FROM user_cars WHERE user_id = ? LIMIT 1", (partner,)) as cursor:
+                    take = await cursor.fetchone()
+            if take and partner != user_id:
+                await main.exchange_cars(main.Exchange(user_id, partner, (), (tuple(take),)))
+        await main.has_car(rng.randint(1, players), rng.choice(all_ids))
+
+    builds = main.OWNED_STATS["builds"]
+    start = time.perf_counter()
+    for i in range(0, ops, 100):
+        await asyncio.gather(*(change(j) for j in range(i, i + 100)))
+    report("изменения коллекций", ops, time.perf_counter() - start)
+    print(f"  перестроено масок за время изменений: {main.OWNED_STATS['builds'] - builds}")
+
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        stale = [user_id for user_id, mask in main.OWNED_CACHE.items() if mask != await main.read_owned_mask(db, user_id)]
+    print(f"  масок в кэше: {len(main.OWNED_CACHE)}, расходится с БД: {len(stale)}")
+    assert not stale, "маска коллекции разошлась с user_cars"
+    assert not main.OWNED_BUILDS
+    assert not await main.verify_ledger(), "журнал не сходится с балансами"
+
+
+# ========== КАРТИНКИ ==========
+
+async def bench_media(players: int = 500, flips: int = 5_000):
+    print(f"🖼 Картинки каталога: {flips} листаний, файлы есть у половины картинок")
+    from loadtest import FakeSession, UpdateFactory
+
+    await fresh_db()
+    await seed_users(players)
+    main.IMAGES_DIR = tempfile.mkdtemp(prefix="cars_bench_images_")
+    main.MEDIA_UPLOAD_DELAY = 0
+    images = main.catalog_images()
+    present = set(images[::2])
+    for image in present:
+        with open(os.path.join(main.IMAGES_DIR, image), "wb") as f:
+            f.write(os.urandom(4096))
+
+    session = main.bot.session = FakeSession()
+    make = UpdateFactory(main.bot)
+    rng = random.Random(12)
+    total = len(main.catalog().all_cars)
+    updates = [
+        make.callback(rng.randint(1, players), f"menu_all_cars_{rng.randrange(total)}", photo="shown" if i % 2 else None)
+        for i in range(flips)
+    ]
+    lookups = Counter()
+    find_image = main.find_image
+    main.find_image = lambda image: lookups.update([image]) or find_image(image)
+    start = time.perf_counter()
+    for update in updates:
+        await main.dp.feed_update(main.bot, update)
+    report("menu_all_cars с картинкой", flips, time.perf_counter() - start)
+    main.find_image = find_image
+    print(f"  {main.MEDIA_STATS}; проверок файлов: {sum(lookups.values())}; вызовы Bot API: {dict(session.calls)}")
+    shown = {car.image for car in main.catalog().all_cars} & present
+    assert set(session.uploads) <= {os.path.join(main.IMAGES_DIR, image) for image in present} | {"placeholder.png"}
+    assert max(session.uploads.values()) == 1, "картинка загружена больше одного раза"
+    assert set(main.MEDIA_FILE_IDS) <= shown | {main.MEDIA_PLACEHOLDER}
+    assert max(lookups.values()) == 1, "файл картинки проверяется на каждой странице"
+    # Новое сообщение только при переходе из текстового сообщения в фото; машины без файла — с заглушкой
+    assert not session.calls["SendMessage"] and session.calls["DeleteMessage"] == session.calls["SendPhoto"]
+
+    # Со страницы с картинкой в текстовое меню — edit_media заглушки, а не новое сообщение
+    calls = Counter(session.calls)
+    await main.dp.feed_update(main.bot, make.callback(1, "menu_salon", photo="shown"))
+    assert session.calls["EditMessageMedia"] == calls["EditMessageMedia"] + 1 and not session.calls["SendMessage"]
+
+    # Предзагрузка догружает остальное, повторный прогон ничего не шлёт
+    uploaded, missing = await main.upload_media(chat_id=1)
+    again, _ = await main.upload_media(chat_id=1)
+    print(f"  upload-media: загружено {uploaded}, нет файла {missing}, повторно {again}")
+    assert set(main.MEDIA_FILE_IDS) == present | {main.MEDIA_PLACEHOLDER}
+    assert missing == len(images) - len(present) and again == 0
+    assert max(session.uploads.values()) == 1
+
+    # Рестарт поднимает file_id из БД; заменённый файл загрузится заново
+    before = dict(main.MEDIA_FILE_IDS)
+    replaced = sorted(present)[0]
+    with open(os.path.join(main.IMAGES_DIR, replaced), "ab") as f:
+        f.write(b"new")
+    await main.load_media()
+    assert main.MEDIA_FILE_IDS == {image: file_id for image, file_id in before.items() if image != replaced}
+    print(f"  после рестарта file_id: {len(main.MEDIA_FILE_IDS)} из {len(before)} (один файл заменён)")
+
+
+async def bench_variants(images: int = 30, players: int = 200, flips: int = 3_000):
+    print(f"🎨 Перекрашенные картинки: {images} исходников × {len(main.PAINT_COLORS)} цветов, {flips} показов")
+    if importlib.util.find_spec("PIL") is None:
+        print("  пропуск: нет Pillow")
+        return
+    from PIL import Image
+    from loadtest import FakeSession, UpdateFactory
+
+    await fresh_db()
+    await seed_users(players)
+    main.IMAGES_DIR = tempfile.mkdtemp(prefix="cars_bench_images_")
+    main.VARIANTS_DIR = os.path.join(main.IMAGES_DIR, "variants")
+    sources = main.paintable_images()[:images]
+    for i, image in enumerate(sources):
+        Image.linear_gradient("L").resize((1024, 640)).convert("RGB").rotate(i * 12).save(os.path.join(main.IMAGES_DIR, image))
+
+    start = time.perf_counter()
+    rendered = await main.build_variants()
+    report("build-variants (пул процессов)", rendered, time.perf_counter() - start)
+    start = time.perf_counter()
+    again = await main.build_variants()
+    print(f"  повторная сборка: {again} за {(time.perf_counter() - start) * 1000:.0f} мс")
+    assert rendered == len(sources) * len(main.PAINT_COLORS) and again == 0
+
+    # Показы «Моих машин» с покраской: варианты только читаются, file_id — один раз на вариант
+    by_image = {}
+    for car in main.catalog().salon_cars:
+        by_image.setdefault(car.image, car.id)
+    rng = random.Random(13)
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.executemany(
+            "INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at, color) VALUES (?, ?, 0, 'Куплена', '', ?)",
+            [(uid, by_image[image], rng.choice(main.PAINT_COLORS)) for uid in range(1, players + 1)
+             for image in rng.sample([image for image in sources if image in by_image], 3)]
+        )
+        await db.commit()
+    await main.init_db()
+    session = main.bot.session = FakeSession()
+    make = UpdateFactory(main.bot)
+    files = len(os.listdir(main.VARIANTS_DIR))
+    digests = main.SOURCE_DIGESTS.copy()
+    start = time.perf_counter()
+    for _ in range(flips):
+        await main.dp.feed_update(main.bot, make.callback(rng.randint(1, players), f"menu_my_cars_{rng.randrange(3)}", photo="shown"))
+    report("menu_my_cars с вариантом", flips, time.perf_counter() - start)
+    assert main.SOURCE_DIGESTS == digests, "исходники хешируются на показе"
+    variant_uploads = [path for path in session.uploads if path.startswith(main.VARIANTS_DIR)]
+    print(f"  загружено вариантов: {len(variant_uploads)}, file_id: {len(main.MEDIA_FILE_IDS)}; {main.VARIANT_STATS}")
+    assert len(os.listdir(main.VARIANTS_DIR)) == files, "вариант нарисован на запросе"
+    assert variant_uploads and max(session.uploads.values()) == 1
+
+    # Покраска сразу показывает страницу этой машины с новым вариантом
+    main.HANDLER_STATS.clear()
+    main.VARIANT_USED.clear()
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        async with db.execute("SELECT car_id FROM user_cars WHERE user_id = 1 ORDER BY id DESC LIMIT 1") as cursor:
+            (car_id,) = await cursor.fetchone()
+    await main.dp.feed_update(main.bot, make.callback(1, f"set_color_{car_id}_Синий", photo="shown"))
+    image = main.catalog().cars_by_id[car_id].image
+    assert not main.HANDLER_STATS["set_color"].errors
+    assert list(main.VARIANT_USED) == [main.variant_name(image, "Синий")]
+
+    # Бюджет: остаётся то, что показывали последним
+    await main.flush_variant_usage()
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.execute("UPDATE media_variants SET used_at = used_at - 3600")
+        await db.commit()
+    recent = main.variant_name(sources[0], "Красный")
+    main.VARIANT_USED[recent] = int(time.time())
+    total = sum(os.path.getsize(os.path.join(main.VARIANTS_DIR, name)) for name in os.listdir(main.VARIANTS_DIR))
+    evicted = await main.prune_variants(total // 10)
+    left = os.listdir(main.VARIANTS_DIR)
+    print(f"  бюджет {total // 10 // 1024} КБ из {total // 1024} КБ: удалено {evicted}, осталось {len(left)}")
+    assert recent in left and sum(os.path.getsize(os.path.join(main.VARIANTS_DIR, name)) for name in left) <= total // 10
+    rebuilt = await main.build_variants()
+    print(f"  пересборка после чистки: {rebuilt} (варианты с file_id не рисуются заново)")
+
+
+# ========== БАНЫ ==========
+
+async def bench_bans(players: int = 20_000, banned: int = 5_000, calls: int = 200_000):
+    print(f"⛔ Баны: {banned} из {players} игроков забанены, {calls} проверок в middleware")
+    from loadtest import FakeSession, UpdateFactory
+
+    await fresh_db()
+    await seed_users(players)
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.executemany(
+            "INSERT INTO bans (user_id, until, banned_by, banned_at) VALUES (?, NULL, 0, 0)",
+            [(uid,) for uid in range(1, banned + 1)]
+        )
+        # Истёкший временный бан в память не поднимается
+        await db.execute("INSERT INTO bans (user_id, until, banned_by, banned_at) VALUES (?, 1, 0, 0)", (players,))
+        await db.commit()
+    start = time.perf_counter()
+    await main.load_bans()
+    report("load_bans при старте", banned, time.perf_counter() - start)
+    assert len(main.BANNED) == banned
+
+    middleware = main.BanMiddleware()
+    rng = random.Random(3)
+    users = [main.types.User(id=rng.randint(banned + 1, players), is_bot=False, first_name="x") for _ in range(1000)]
+
+    async def handler(event, data):
+        return None
+
+    data_items = [{"event_from_user": u} for u in users]
+    samples = {True: [], False: []}
+    for _ in range(5):
+        for through in (False, True):
+            start = time.perf_counter()
+            for i in range(calls // 5):
+                data = data_items[i % 1000]
+                if through:
+                    await middleware(handler, None, data)
+                else:
+                    await handler(None, data)
+            samples[through].append(time.perf_counter() - start)
+    overhead = (statistics.median(samples[True]) - statistics.median(samples[False])) / (calls // 5)
+    print(f"  накладные расходы BanMiddleware: {overhead * 1e9:.0f} нс на апдейт")
+
+    # Апдейты забаненного не доходят до обработчиков и БД, /start не пересоздаёт игрока
+    main.bot.session = FakeSession()
+    make = UpdateFactory(main.bot)
+    main.HANDLER_STATS.clear()
+    writes = dml_statements()
+    for data in ("menu_balance", "drop_car", "menu_my_cars_0"):
+        await main.dp.feed_update(main.bot, make.callback(1, data))
+    await main.dp.feed_update(main.bot, make.text(1, "/start"))
+    assert not main.HANDLER_STATS and dml_statements() == writes, "апдейт забаненного дошёл до обработчика"
+    assert main.BAN_STATS["dropped"] == 4
+
+    # Временный бан: действует до until, потом снимается сам; /unban пишет в БД и память сразу
+    now = int(time.time())
+    await main.ban_user(banned + 1, now + 60, 0)
+    assert main.is_banned(banned + 1, now) and not main.is_banned(banned + 1, now + 61)
+    await main.ban_user(banned + 2, None, 0)
+    assert await main.unban_user(banned + 2) and not main.is_banned(banned + 2)
+    await main.load_bans()  # перезапуск
+    assert len(main.BANNED) == banned + 1 and banned + 2 not in main.BANNED
+
+    # Аннулирование: машины возвращаются в лимиты, заявки и активации промокодов уходят вместе с игроком
+    target = banned + 3
+    car = main.catalog().salon_cars[0]
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.execute("UPDATE users SET balance = 1000000000 WHERE user_id = ?", (target,))
+        await db.execute("INSERT INTO promo_redemptions (code, user_id, redeemed_at) VALUES ('test', ?, 0)", (target,))
+        await db.commit()
+    assert await main.purchase_car(target, car, "salon_buy", "Куплена") == "ok"
+    placed = [(await main.place_order(target, car.id, side, price))[1]
+              for side, price in (("ask", car.price_usd * 10), ("bid", 1))]
+    assert all(order_id in main.MARKET_ORDERS for order_id in placed)
+    issued = lambda: main.CAR_MARKET[car.id]["issued"]
+    before = issued()
+    main.CREATOR_USERNAME, creator = "user1", main.CREATOR_USERNAME
+    await main.unban_user(1)
+    await main.dp.feed_update(main.bot, make.callback(1, f"admin_do_wipe_{target}"))
+    main.CREATOR_USERNAME = creator
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        leftovers = {}
+        for table, where in (("promo_redemptions", ""), ("market_orders", " AND status = 'open'"), ("user_cars", "")):
+            async with db.execute(f"SELECT COUNT(*) FROM {table} WHERE user_id = ?{where}", (target,)) as cursor:
+                leftovers[table] = (await cursor.fetchone())[0]
+        async with db.execute("SELECT issued_count FROM global_car_counts WHERE car_id = ?", (car.id,)) as cursor:
+            count = (await cursor.fetchone())[0]
+    print(f"  аннулирование: осталось {leftovers}, выпущено {car.name}: {count}")
+    assert not any(leftovers.values()) and count == 0 and issued() == before - 1
+    assert not [order_id for order_id in placed if order_id in main.MARKET_ORDERS]
+
+
+# ========== ЕДИНИЦА РАБОТЫ ==========
+
+async def bench_uow(players: int = 300):
+    print(f"🧾 Единица работы: {players} игроков одновременно покупают, открывают кейсы и смотрят экраны")
+    from loadtest import FakeSession, UpdateFactory
+
+    await fresh_db()
+    await seed_users(players)
+    houses = main.catalog().real_estate["houses"]
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.execute("UPDATE users SET balance = 10000000000")
+        # Доход копится у всех: покупка сначала зачисляет его в той же транзакции
+        await db.executemany(
+            "INSERT INTO user_real_estate (user_id, estate_id, purchased_at, collected_at) VALUES (?, ?, '', ?)",
+            [(uid, main.catalog().real_estate["income_property"][0]["id"], int(time.time()) - 3600)
+             for uid in range(1, players + 1)]
+        )
+        await db.commit()
+    await main.init_db()  # стартовые записи журнала
+
+    # Вложенный откат SAVEPOINT не задевает внешнюю запись, исключение откатывает весь блок
+    async with main.uow(write=True) as tx:
+        await tx.execute("UPDATE users SET username = 'outer' WHERE user_id = 1")
+        async with main.uow(write=True) as inner:
+            assert inner is tx, "вложенный uow открыл новое соединение"
+            await tx.execute("UPDATE users SET username = 'savepoint' WHERE user_id = 2")
+            await inner.rollback()
+        try:
+            async with main.uow(write=True):
+                await tx.execute("UPDATE users SET username = 'raised' WHERE user_id = 3")
+                raise LookupError
+        except LookupError:
+            pass
+    try:
+        async with main.uow(write=True) as tx:
+            await tx.execute("UPDATE users SET username = 'raised' WHERE user_id = 4")
+            raise LookupError
+    except LookupError:
+        pass
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        async with db.execute("SELECT user_id, username FROM users WHERE user_id <= 4 ORDER BY user_id") as cursor:
+            names = dict(await cursor.fetchall())
+    assert names == {1: "outer", 2: "user2", 3: "user3", 4: "user4"}, names
+
+    main.bot.session = FakeSession()
+    make = UpdateFactory(main.bot)
+    salon = main.catalog().salon_cars[0]
+    tuning = next(iter(main.catalog().tuning_brands.values()))[0]
+    scripts = {
+        uid: [
+            f"buy_salon_{salon.id}", f"buy_tuning_{tuning.id}", f"buy_estate_{houses[uid % len(houses)]['id']}",
+            f"luck_cat_{main.LUCK_CATEGORIES[uid % len(main.LUCK_CATEGORIES)]}",
+            # Двойное нажатие: кейс «Новый клиент» должен выдаться один раз
+            "new_client_case", "new_client_case",
+            "menu_my_cars_0", "realestate_houses", "menu_balance",
+        ]
+        for uid in range(1, players + 1)
+    }
+
+    async def play(uid: int):
+        for data in scripts[uid]:
+            await main.dp.feed_update(main.bot, make.callback(uid, data))
+
+    main.HANDLER_STATS.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*(play(uid) for uid in scripts))
+    report("сценарии игроков", sum(map(len, scripts.values())), time.perf_counter() - start)
+
+    for label, stats in sorted(main.HANDLER_STATS.items()):
+        if label.startswith("luck_cat"):
+            continue
+        print(f"  {label:<20} {stats.connections / stats.count:.2f} соединений на вызов, вложенных {stats.nested}")
+    assert not sum(stats.nested for stats in main.HANDLER_STATS.values()), "вложенные соединения"
+    assert not sum(stats.errors for stats in main.HANDLER_STATS.values()), "ошибки в обработчиках"
+
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        async with db.execute("SELECT user_id, COUNT(*) FROM ledger WHERE kind = ? GROUP BY user_id",
+                              (main.LEDGER_KINDS["new_client"],)) as cursor:
+            new_client = dict(await cursor.fetchall())
+        async with db.execute("""
+            SELECT COUNT(*) FROM global_car_counts
+            WHERE issued_count != (SELECT COUNT(*) FROM user_cars WHERE user_cars.car_id = global_car_counts.car_id)
+        """) as cursor:
+            drifted = (await cursor.fetchone())[0]
+    assert max(new_client.values(), default=0) == 1, "«Новый клиент» выдан дважды"
+    assert not drifted, "счётчики выпуска разошлись с гаражами"
+    assert not await main.verify_ledger(), "журнал не сходится с балансами"
+
+
+# ========== БЕСПЛАТНЫЕ ПОПЫТКИ ==========
+
+async def bench_drop_credits(taps: int = 50, credits: int = 5):
+    print(f"🎟 Бесплатные попытки: {taps} одновременных нажатий, {credits} попыток")
+    await fresh_db()
+    await seed_users(3, drop_credits=credits)
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.execute("UPDATE users SET last_drop_at = ? WHERE user_id = 1", (int(time.time()),))
+        await db.execute("UPDATE users SET drop_credits = 0 WHERE user_id = 3")
+        await db.commit()
+
+    # (игрок, ожидаемое число выпадений): таймер не готов / таймер готов / без попыток
+    cases = [(1, credits), (2, credits + 1), (3, 1)]
+    start = time.perf_counter()
+    results = await asyncio.gather(*(
+        main.grant_drops(user_id, 1) for user_id, _ in cases for _ in range(taps)
+    ))
+    report("нажатия «Выбить машину»", len(results), time.perf_counter() - start)
+
+    for i, (user_id, expected) in enumerate(cases):
+        statuses = [status for status, _ in results[i * taps:(i + 1) * taps]]
+        print(f"  игрок {user_id}: выпало {statuses.count('ok')}, отказов по таймеру {statuses.count('cooldown')}")
+        assert statuses.count("ok") == expected, f"игрок {user_id}: ожидалось {expected} выпадений"
+        assert await main.get_drop_credits(user_id) == 0
+
+
+# ========== ТАЙМЕРЫ ==========
+
+async def bench_cooldowns(players: int = 10_000, checks: int = 200_000, db_checks: int = 5_000):
+    print(f"⏳ Таймеры: {players} игроков, половина на таймере")
+    await fresh_db()
+    await seed_users(players)
+    now = int(time.time())
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        await db.execute(
+            "UPDATE users SET last_drop = ?, last_drop_at = ? WHERE user_id % 2 = 0",
+            (main.datetime.utcfromtimestamp(now).isoformat(), now)
+        )
+        await db.execute("UPDATE users SET notify_ready = 1 WHERE user_id % 4 = 0")
+        await db.commit()
+    await main.load_cooldowns()
+
+    # Как было: строка из БД + datetime.fromisoformat на каждое нажатие
+    start = time.perf_counter()
+    busy = 0
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        for i in range(db_checks):
+            async with db.execute("SELECT last_drop FROM users WHERE user_id = ?", (i % players + 1,)) as cursor:
+                row = await cursor.fetchone()
+            if row[0] and main.datetime.utcnow() - main.datetime.fromisoformat(row[0]) < main.timedelta(minutes=30):
+                busy += 1
+    report("из БД (ISO-строка)", db_checks, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    busy_memory = 0
+    for i in range(checks):
+        busy_memory += main.cooldown_remaining("drop", i % players + 1) > 0
+    report("из памяти (unix-время)", checks, time.perf_counter() - start)
+    assert busy_memory == checks // 2 and busy == db_checks // 2
+
+    start = time.perf_counter()
+    ready = main.pop_ready_cooldowns(now + main.COOLDOWN_PERIODS["drop"])
+    report("обход: снятие истёкших", players // 2, time.perf_counter() - start)
+    print(f"  напоминаний к отправке: {len(ready)} (пачками по {main.NOTIFY_BATCH_SIZE})")
+    assert len(ready) == players // 4 and not main.COOLDOWNS["drop"]
+
+
+# ========== КАТАЛОГ: СЛОВАРИ И ЗАПИСИ ==========
+
+def measure_alloc(build):
+    """Возвращает (объект, сколько байт он занял) по tracemalloc"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, size
+
+async def bench_catalog(lookups: int = 1_000_000):
+    print(f"🚗 Каталог: словари против записей Car и колонок array('q'), {lookups} обращений")
+    with open(main.CATALOG_PATH, encoding="utf-8") as f:
+        data = json.load(f)
+    entries = data["drop"] + data["salon"] + data["luck_case"] + [car for cars in data["tuning"].values() for car in cars]
+
+    dicts, dict_bytes = measure_alloc(lambda: [dict(entry) for entry in entries])
+    records, record_bytes = measure_alloc(lambda: [main.make_car(entry) for entry in entries])
+    snapshot = main.catalog()
+    column_bytes = sum(column.itemsize * len(column) for column in (snapshot.prices, snapshot.limits))
+    print(f"  память на {len(entries)} машин: словари {dict_bytes / 1024:.1f} КБ, Car {record_bytes / 1024:.1f} КБ, "
+          f"колонки цен и лимитов {column_bytes / 1024:.1f} КБ")
+
+    ids = [car.id for car in records]
+    dicts_by_id = {car["id"]: car for car in dicts}
+    cycle = [ids[i % len(ids)] for i in range(lookups)]
+
+    start = time.perf_counter()
+    total = 0
+    for car_id in cycle:
+        total += dicts_by_id[car_id]["price_usd"]
+    report('dict: car["price_usd"]', lookups, time.perf_counter() - start)
+
+    by_id = snapshot.cars_by_id
+    start = time.perf_counter()
+    total_records = 0
+    for car_id in cycle:
+        total_records += by_id[car_id].price_usd
+    report("Car: car.price_usd", lookups, time.perf_counter() - start)
+
+    prices = snapshot.prices
+    start = time.perf_counter()
+    total_columns = 0
+    for car_id in cycle:
+        total_columns += prices[car_id]
+    report("array('q'): prices[car_id]", lookups, time.perf_counter() - start)
+    assert total == total_records == total_columns
+
+    # Проверка остатков для выпадения, как в grant_drops
+    issued = {car_id: car_id % 3 for car_id in ids}
+    drop_dicts = data["drop"]
+    rounds = lookups // len(drop_dicts)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        available = [car for car in drop_dicts if car["max_global"] - issued.get(car["id"], 0) > 0]
+    report("остатки: словари", rounds, time.perf_counter() - start)
+    limits = snapshot.limits
+    start = time.perf_counter()
+    for _ in range(rounds):
+        available_ids = [car_id for car_id in snapshot.drop_ids if limits[car_id] - issued.get(car_id, 0) > 0]
+    report("остатки: колонки", rounds, time.perf_counter() - start)
+    assert [car["id"] for car in available] == available_ids
+
+
+# ========== ПЕРЕЗАГРУЗКА КАТАЛОГА ПОД НАГРУЗКОЙ ==========
+
+async def bench_reload(seconds: float = 3.0, workers: int = 50, reload_every: float = 0.05):
+    print(f"🔄 Перезагрузка каталога: {workers} обработчиков, подмена раз в {reload_every * 1000:.0f} мс")
+    await fresh_db()
+    car_ids = list(main.catalog().cars_by_id)
+
+    async def handler(index: int) -> int:
+        # Как обработчик: берём снимок, читаем машину и цену, уступаем циклу
+        snapshot = main.catalog()
+        car = snapshot.cars_by_id.get(car_ids[index % len(car_ids)], main.UNKNOWN_CAR)
+        await asyncio.sleep(0)
+        return main.house_price(car) if car is not main.UNKNOWN_CAR else 0
+
+    async def load(stop: asyncio.Event, latencies: List[float]):
+        index = 0
+        while not stop.is_set():
+            start = time.perf_counter()
+            await handler(index)
+            latencies.append(time.perf_counter() - start)
+            index += 1
+
+    async def run_phase(name: str, reload):
+        stop = asyncio.Event()
+        latencies: List[float] = []
+        tasks = [asyncio.create_task(load(stop, latencies)) for _ in range(workers)]
+        reloads: List[float] = []
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(reload_every)
+            if reload:
+                start = time.perf_counter()
+                await reload()
+                reloads.append(time.perf_counter() - start)
+        stop.set()
+        await asyncio.gather(*tasks)
+        latencies.sort()
+        p50, p99 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+        took = f", подмена {statistics.median(reloads) * 1000:5.2f} мс" if reloads else ""
+        print(f"  {name:<30} запросов {len(latencies):>8}, подмен {len(reloads):>3}: "
+              f"p50 {p50 * 1e6:7.1f} мкс, p99 {p99 * 1e6:7.1f} мкс, max {latencies[-1] * 1000:6.2f} мс{took}")
+
+    async def blocking_reload():
+        main._CATALOG = main.load_catalog()
+
+    # Второй файл с другими ставками дохода: такая подмена переписывает estate_rates под DB_WRITE_LOCK
+    with open(main.CATALOG_PATH, encoding="utf-8") as f:
+        data = json.load(f)
+    for estate in data["real_estate"]["income_property"]:
+        estate["income_per_10_sec"] += 1
+    fd, rates_path = tempfile.mkstemp(suffix=".json", prefix="catalog_rates_")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    flip = [rates_path, main.CATALOG_PATH]
+
+    async def rates_reload():
+        flip.reverse()
+        await main.reload_catalog(flip[0])
+
+    try:
+        await run_phase("без перезагрузки", None)
+        await run_phase("reload_catalog (в потоке)", main.reload_catalog)
+        await run_phase("reload_catalog (новые ставки)", rates_reload)
+        await run_phase("чтение в цикле событий", blocking_reload)
+
+        # Кнопки страниц салона, оставшиеся от прошлого каталога: в группе «Обычное» машин стало меньше
+        from loadtest import FakeSession, UpdateFactory
+        data["salon"] = data["salon"][:18]
+        with open(rates_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        await main.reload_catalog(rates_path)
+        session = main.bot.session = FakeSession()
+        make = UpdateFactory(main.bot)
+        await seed_users(1)
+        for page in (2, 14):
+            await main.dp.feed_update(main.bot, make.callback(1, f"salon_1_{page}"))
+        data["salon"] = data["salon"][:15]
+        with open(rates_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        await main.reload_catalog(rates_path)
+        await main.dp.feed_update(main.bot, make.callback(1, "salon_1_0"))
+        print(f"  старые кнопки салона после перезагрузки: {dict(session.calls)}")
+        assert session.calls["AnswerCallbackQuery"] == 3
+    finally:
+        os.remove(rates_path)
+        main._CATALOG = main.load_catalog()
+
+
+# ========== НАКЛАДНЫЕ РАСХОДЫ ИНСТРУМЕНТИРОВАНИЯ ==========
+
+async def bench_instrument(grants: int = 4_000):
+    print(f"📊 Инструментирование: {grants} выдач через middleware, чередуя с голым aiosqlite (медиана)")
+    await fresh_db()
+    await seed_users(2, drop_credits=grants)
+    connect_db = main.connect_db
+    middleware = main.InstrumentMiddleware()
+    callback = main.CallbackQuery(
+        id="1", chat_instance="1", data="drop_car",
+        from_user=main.types.User(id=2, is_bot=False, first_name="Bench"),
+    )
+
+    async def handler(event, data):
+        return await main.grant_drops(event.from_user.id, 1)
+
+    def plain_connect():
+        return aiosqlite.connect(main.DB_PATH)
+
+    latencies = {True: [], False: []}
+    for i in range(grants):
+        instrumented = bool(i % 2)
+        main.connect_db = connect_db if instrumented else plain_connect
+        start = time.perf_counter()
+        if instrumented:
+            await middleware(handler, callback, {})
+        else:
+            await main.grant_drops(1, 1)
+        latencies[instrumented].append(time.perf_counter() - start)
+    main.connect_db = connect_db
+
+    plain = statistics.median(latencies[False])
+    measured = statistics.median(latencies[True])
+    print(f"  без счётчиков: {plain * 1000:.3f} мс, со счётчиками: {measured * 1000:.3f} мс")
+    print(f"  накладные расходы: {(measured - plain) / plain * 100:+.1f}% (цель < 2%), "
+          f"{(measured - plain) * 1e6:.0f} мкс на обновление без запросов к Bot API")
+    stats = main.HANDLER_STATS["drop_car"]
+    print(f"  drop_car: {stats.count} вызовов, {stats.queries / stats.count:.1f} запросов "
+          f"и {stats.connections / stats.count:.1f} соединений на вызов, p95 ≤ {stats.quantile(0.95) * 1000:g} мс")
+
+
+# ========== ХОЛОДНЫЙ СТАРТ ==========
+
+STARTUP_PROBE = """
+import time, resource
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.catalog()
+loaded = time.perf_counter()
+print(imported - start, loaded - imported, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+def import_self_time(module: str = "main") -> float:
+    """Собственное время импорта модуля по python -X importtime, в секундах"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=dict(os.environ), cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    for line in result.stderr.splitlines():
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[0].split(":")[1]) / 1e6
+    raise RuntimeError(result.stderr[-500:])
+
+async def bench_startup(runs: int = 5):
+    print(f"🚀 Холодный старт: {runs} запусков в отдельных процессах")
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", STARTUP_PROBE], capture_output=True, text=True, cwd=cwd, env=dict(os.environ))
+        samples.append([float(value) for value in result.stdout.split()])
+    imported, loaded, rss = (statistics.median(column) for column in zip(*samples))
+    print(f"  import main (вместе с aiogram): {imported * 1000:.1f} мс, RSS {rss / 1024:.1f} МБ")
+    print(f"  собственное время main.py: {statistics.median(import_self_time() for _ in range(runs)) * 1000:.1f} мс")
+    print(f"  первое обращение к catalog(): {loaded * 1000:.2f} мс")
+
+
+BENCHMARKS = {
+    "drops": bench_drops,
+    "market": bench_market,
+    "pricing": bench_pricing,
+    "ledger": bench_ledger,
+    "promo": bench_promo,
+    "exchange": bench_exchange,
+    "offers": bench_offers,
+    "estate_income": bench_estate_income,
+    "views": bench_views,
+    "uow": bench_uow,
+    "known_users": bench_known_users,
+    "ownership": bench_ownership,
+    "media": bench_media,
+    "variants": bench_variants,
+    "bans": bench_bans,
+    "drop_credits": bench_drop_credits,
+    "cooldowns": bench_cooldowns,
+    "startup": bench_startup,
+    "catalog": bench_catalog,
+    "reload": bench_reload,
+    "instrument": bench_instrument,
+}
+
+
+async def run(names):
+    for name in names or BENCHMARKS:
+        await BENCHMARKS[name]()
+        if os.path.basename(main.DB_PATH).startswith("cars_bench_") and os.path.exists(main.DB_PATH):
+            os.remove(main.DB_PATH)
+
+
+if __name__ == "__main__":
+    asyncio.run(run(sys.argv[1:]))
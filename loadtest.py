@@ -0,0 +1,512 @@
+# loadtest.py — Нагрузочный прогон бота целиком: диспетчер aiogram + фейковый Bot API
+#
+# Запуск:  python loadtest.py --users 100000 --updates 20000 --concurrency 200 [--json out.json]
+#
+# Апдейты идут через dp.feed_update, то есть через те же фильтры, FSM, middleware
+# и обработчики, что и в проде. Вместо api.telegram.org — FakeSession, которая
+# отвечает мгновенно (или с задержкой --api-latency-ms) и считает вызовы.
+# Игроки, машины, недвижимость и выпадения (RNG бота) детерминированы через --seed:
+# при --concurrency 1 повторный прогон на свежей БД даёт тот же draws_digest.
+# С --db PATH база сохраняется и при повторном запуске не пересоздаётся.
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import tempfile
+from itertools import count
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+
+import aiosqlite
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import InputFile, Message, Update
+import main
+
+
+# ========== ФЕЙКОВЫЙ BOT API ==========
+
+class FakeSession(BaseSession):
+    """Сессия aiogram без сети: Message на send_*/edit_*, True на всё остальное.
+    Фото из файла считается в uploads и получает новый file_id, фото по file_id — тот же"""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.uploads: Counter = Counter()
+        self.message_ids = count(1_000_000)
+        self.file_ids = count(1)
+
+    def photo_of(self, method: TelegramMethod) -> Optional[str]:
+        media = getattr(method, "photo", None) or getattr(getattr(method, "media", None), "media", None)
+        if isinstance(media, InputFile):
+            self.uploads[getattr(media, "path", media.filename)] += 1
+            return f"fake-file-{next(self.file_ids)}"
+        return media if isinstance(media, str) else None
+
+    async def close(self):
+        pass
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        returning = method.__returning__
+        if returning is Message or Message in getattr(returning, "__args__", ()):
+            chat_id = getattr(method, "chat_id", 0)
+            payload = {
+                "message_id": getattr(method, "message_id", None) or next(self.message_ids),
+                "date": datetime.now(timezone.utc),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": getattr(method, "text", None),
+            }
+            file_id = self.photo_of(method)
+            if file_id:
+                payload["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 720}]
+            return Message.model_validate(payload, context={"bot": bot})
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+
+# ========== СИНТЕТИЧЕСКАЯ ПОПУЛЯЦИЯ ==========
+
+SEED_CHUNK = 50_000
+CURRENCIES = ["USD"] * 6 + ["RUB"] * 3 + ["EUR"]
+
+
+def chunks(rows, size: int = SEED_CHUNK):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def seed_population(users: int, seed: int):
+    """Игроки с балансами, машинами в пределах лимитов и недвижимостью"""
+    rng = random.Random(seed)
+    snapshot = main.catalog()
+    car_ids = [car.id for car in snapshot.all_cars]
+    stock = {car_id: snapshot.limits[car_id] for car_id in car_ids}
+    estate_ids = [estate["id"] for estates in snapshot.real_estate.values() for estate in estates]
+    now = main.now_iso()
+
+    def user_rows():
+        for uid in range(1, users + 1):
+            yield (uid, f"user{uid}", f"Игрок {uid}", int(rng.paretovariate(1.2) * 50_000),
+                   rng.choice(CURRENCIES), rng.randint(0, 3))
+
+    def car_rows():
+        for uid in range(1, users + 1):
+            for _ in range(rng.randint(0, 6)):
+                car_id = rng.choice(car_ids)
+                if stock[car_id] > 0:
+                    stock[car_id] -= 1
+                    yield (uid, car_id, "Выпала", now)
+
+    def estate_rows():
+        for uid in range(1, users + 1):
+            if estate_ids and rng.random() < 0.1:
+                yield (uid, rng.choice(estate_ids), now, int(time.time()) - rng.randint(0, 3600))
+
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        for batch in chunks(user_rows()):
+            await db.executemany(
+                "INSERT INTO users (user_id, username, display_name, balance, currency, drop_credits) VALUES (?, ?, ?, ?, ?, ?)",
+                batch
+            )
+        for batch in chunks(car_rows()):
+            await db.executemany(
+                "INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at) VALUES (?, ?, 0, ?, ?)",
+                batch
+            )
+        for batch in chunks(estate_rows()):
+            await db.executemany(
+                "INSERT OR IGNORE INTO user_real_estate (user_id, estate_id, purchased_at, collected_at) VALUES (?, ?, ?, ?)",
+                batch
+            )
+        await db.executemany(
+            "INSERT OR REPLACE INTO global_car_counts (car_id, issued_count) VALUES (?, ?)",
+            [(car_id, snapshot.limits[car_id] - stock[car_id]) for car_id in car_ids]
+        )
+        await db.commit()
+
+
+async def load_garages(users: int) -> Dict[int, List[int]]:
+    """Кто чем владеет (id строк user_cars и версии) — чтобы сценарии обмена выбирали реальные машины"""
+    garages: Dict[int, List[tuple]] = defaultdict(list)
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        async with db.execute("SELECT user_id, id, version FROM user_cars WHERE user_id <= ?", (users,)) as cursor:
+            async for user_id, row_id, version in cursor:
+                garages[user_id].append((row_id, version))
+    return garages
+
+
+# ========== СЦЕНАРИИ ==========
+
+class UpdateFactory:
+    """Собирает Update, уже привязанные к боту, чтобы feed_update не перемонтировал их через JSON"""
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.ids = count(1)
+        self.bot_user = {"id": bot.id, "is_bot": True, "first_name": "Cars"}
+
+    @staticmethod
+    def user(uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"Игрок {uid}", "username": f"user{uid}"}
+
+    def callback(self, uid: int, data: str, photo: Optional[str] = None) -> Update:
+        update_id = next(self.ids)
+        # photo — нажатие под страницей с картинкой (у сообщения фото вместо текста)
+        shown = {"photo": [{"file_id": photo, "file_unique_id": photo, "width": 1280, "height": 720}]} if photo else {"text": "🚘"}
+        return Update.model_validate({
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self.user(uid),
+                "chat_instance": str(uid),
+                "data": data,
+                "message": {
+                    "message_id": update_id,
+                    "date": datetime.now(timezone.utc),
+                    "chat": {"id": uid, "type": "private"},
+                    "from": self.bot_user,
+                    **shown,
+                },
+            },
+        }, context={"bot": self.bot})
+
+    def text(self, uid: int, text: str) -> Update:
+        update_id = next(self.ids)
+        return Update.model_validate({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": datetime.now(timezone.utc),
+                "chat": {"id": uid, "type": "private"},
+                "from": self.user(uid),
+                "text": text,
+            },
+        }, context={"bot": self.bot})
+
+
+class Population:
+    def __init__(self, users: int, garages: Dict[int, List[tuple]], rng: random.Random):
+        self.users = users
+        self.garages = garages
+        self.owners = list(garages)
+        self.rng = rng
+
+    def player(self) -> int:
+        return self.rng.randint(1, self.users)
+
+    def owner(self) -> Optional[int]:
+        return self.rng.choice(self.owners) if self.owners else None
+
+
+def scenario_drop(pop: Population, make: UpdateFactory) -> list:
+    return [make.callback(pop.player(), "drop_car")]
+
+
+def scenario_pages(pop: Population, make: UpdateFactory) -> list:
+    uid = pop.player()
+    group = pop.rng.randint(0, 1)
+    flips = [make.callback(uid, "menu_salon"), make.callback(uid, f"salon_group_{group}")]
+    for page in range(1, pop.rng.randint(2, 6)):
+        flips.append(make.callback(uid, f"salon_{group}_{page}"))
+    flips.append(make.callback(uid, "menu_my_cars_0"))
+    flips.append(make.callback(uid, f"menu_all_cars_{pop.rng.randint(0, 5)}"))
+    return flips
+
+
+def scenario_cases(pop: Population, make: UpdateFactory) -> list:
+    uid = pop.player()
+    category = pop.rng.choice(main.LUCK_CATEGORIES)
+    return [make.callback(uid, "menu_luck_case"), make.callback(uid, f"luck_cat_{category}"),
+            make.callback(uid, "new_client_case")]
+
+
+def scenario_buy(pop: Population, make: UpdateFactory) -> list:
+    uid = pop.player()
+    car = pop.rng.choice(main.catalog().salon_cars[:30])
+    return [make.callback(uid, "menu_salon"), make.callback(uid, f"buy_salon_{car.id}")]
+
+
+def scenario_balance(pop: Population, make: UpdateFactory) -> list:
+    return [make.callback(pop.player(), "menu_balance")]
+
+
+def scenario_leaders(pop: Population, make: UpdateFactory) -> list:
+    return [make.callback(pop.player(), "menu_leaders")]
+
+
+def scenario_estate(pop: Population, make: UpdateFactory) -> list:
+    uid = pop.player()
+    return [make.callback(uid, "menu_realestate"), make.callback(uid, "realestate_houses")]
+
+
+def scenario_market(pop: Population, make: UpdateFactory) -> list:
+    car = pop.rng.choice(main.catalog().all_cars)
+    return [make.callback(pop.player(), f"market_car_{car.id}")]
+
+
+def scenario_exchange(pop: Population, make: UpdateFactory) -> list:
+    """Полный обмен: выбор машины → ввод партнёра → выбор его машины → подтверждение партнёром"""
+    initiator, partner = pop.owner(), pop.owner()
+    if initiator is None or initiator == partner:
+        return scenario_balance(pop, make)
+    row_id, _ = pop.rng.choice(pop.garages[initiator])
+    partner_row_id, _ = pop.rng.choice(pop.garages[partner])
+
+    async def confirm() -> Update:
+        # id предложения появляется только после exchange_select — достаём его перед отправкой
+        async with aiosqlite.connect(main.DB_PATH) as db:
+            async with db.execute(
+                "SELECT MAX(id) FROM exchange_offers WHERE initiator_id = ? AND recipient_id = ?", (initiator, partner)
+            ) as cursor:
+                offer_id = (await cursor.fetchone())[0]
+        # Предложение не создано (строку успели продать или обменять) — партнёр жмёт устаревшую кнопку
+        return make.callback(partner, f"exchange_confirm_{offer_id or 0}")
+
+    return [
+        make.callback(initiator, f"exchange_start_{row_id}"),
+        make.text(initiator, f"user{partner}"),
+        make.callback(initiator, f"exchange_select_{partner_row_id}"),
+        make.callback(partner, "offers_in_0"),
+        confirm,
+    ]
+
+
+SCENARIOS = {
+    "drop": (scenario_drop, 25),
+    "pages": (scenario_pages, 25),
+    "balance": (scenario_balance, 12),
+    "cases": (scenario_cases, 3),
+    "buy": (scenario_buy, 10),
+    "estate": (scenario_estate, 8),
+    "market": (scenario_market, 7),
+    "exchange": (scenario_exchange, 5),
+    "leaders": (scenario_leaders, 5),
+}
+
+
+# ========== ПРОГОН ==========
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def latency_summary(values: List[float]) -> dict:
+    return {
+        "p50": round(percentile(values, 0.50) * 1000, 3),
+        "p95": round(percentile(values, 0.95) * 1000, 3),
+        "p99": round(percentile(values, 0.99) * 1000, 3),
+        "max": round(max(values, default=0.0) * 1000, 3),
+    }
+
+
+def db_counters() -> dict:
+    return {
+        "queries": sum(stats.queries for stats in main.HANDLER_STATS.values()),
+        "connections": sum(stats.connections for stats in main.HANDLER_STATS.values()),
+    }
+
+
+async def run_load(args) -> dict:
+    rng = random.Random(args.seed)
+    session = FakeSession(args.api_latency_ms / 1000)
+    main.bot.session = session
+    make = UpdateFactory(main.bot)
+
+    garages = await load_garages(args.users)
+    pop = Population(args.users, garages, rng)
+    names = list(SCENARIOS)
+    weights = [SCENARIOS[name][1] for name in names]
+
+    # Очередь сценариев заранее: генерация Update не должна попадать в замер
+    queue: asyncio.Queue = asyncio.Queue()
+    planned = 0
+    while planned < args.updates:
+        name = rng.choices(names, weights)[0]
+        updates = SCENARIOS[name][0](pop, make)
+        queue.put_nowait((name, updates))
+        planned += len(updates)
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Counter = Counter()
+
+    async def worker():
+        while True:
+            try:
+                name, updates = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            for update in updates:
+                if callable(update):
+                    update = await update()
+                start = time.perf_counter()
+                try:
+                    await main.dp.feed_update(main.bot, update)
+                except Exception as e:
+                    errors[f"{name}: {type(e).__name__}: {e}"[:200]] += 1
+                latencies[name].append(time.perf_counter() - start)
+
+    main.HANDLER_STATS.clear()
+    session.calls.clear()
+    before = db_counters()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    duration = time.perf_counter() - start
+    after = db_counters()
+
+    # Фоновые задачи, запущенные обработчиками, в замер не входят
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+
+    mismatches = await main.verify_draws(main.RNG.seed_id)
+    total = sum(len(values) for values in latencies.values())
+    every = [value for values in latencies.values() for value in values]
+    scenario_stats = {}
+    for name in names:
+        values = latencies.get(name, [])
+        if values:
+            scenario_stats[name] = {"updates": len(values), **latency_summary(values)}
+    # Запросы по handler-меткам: сценарии делят обработчики, поэтому считаем по меткам, а не по сценариям
+    handler_queries = {
+        label: {
+            "calls": stats.count,
+            "queries_per_call": round(stats.queries / stats.count, 2) if stats.count else 0,
+            "p99_ms": stats.quantile(0.99) * 1000,
+        }
+        for label, stats in sorted(main.HANDLER_STATS.items()) if stats.count
+    }
+    return {
+        "users": args.users,
+        "updates": total,
+        "concurrency": args.concurrency,
+        "api_latency_ms": args.api_latency_ms,
+        "seed": args.seed,
+        "duration_s": round(duration, 3),
+        "updates_per_s": round(total / duration, 1) if duration else 0,
+        "latency_ms": latency_summary(every),
+        "db_queries_per_update": round((after["queries"] - before["queries"]) / total, 2) if total else 0,
+        "db_connections_per_update": round((after["connections"] - before["connections"]) / total, 2) if total else 0,
+        "api_calls_per_update": round(sum(session.calls.values()) / total, 2) if total else 0,
+        "api_calls": dict(session.calls.most_common()),
+        "draws": await draws_digest(main.RNG.seed_id),
+        "draw_mismatches": len(mismatches),
+        "errors": sum(errors.values()),
+        "error_samples": dict(errors.most_common(10)),
+        "scenarios": scenario_stats,
+        "handlers": handler_queries,
+    }
+
+
+async def draws_digest(seed_id: int) -> dict:
+    """Отпечаток всех выпадений прогона — для сравнения повторов одного seed"""
+    digest = hashlib.blake2b(digest_size=16)
+    async with aiosqlite.connect(main.DB_PATH) as db:
+        async with db.execute(
+            "SELECT stream, counter, pick, user_id, car_id FROM rng_draws WHERE seed_id = ? ORDER BY stream, counter",
+            (seed_id,)
+        ) as cursor:
+            rows = await cursor.fetchall()
+    for row in rows:
+        digest.update(repr(row).encode())
+    return {"count": len(rows), "digest": digest.hexdigest()}
+
+
+def print_report(result: dict):
+    lat = result["latency_ms"]
+    print(f"👥 {result['users']} игроков, {result['updates']} апдейтов, {result['concurrency']} параллельно, "
+          f"Bot API +{result['api_latency_ms']} мс")
+    print(f"  {result['updates_per_s']:.1f} апд/с за {result['duration_s']:.2f} с")
+    print(f"  задержка: p50 {lat['p50']:.2f} мс  p95 {lat['p95']:.2f} мс  p99 {lat['p99']:.2f} мс  max {lat['max']:.2f} мс")
+    print(f"  на апдейт: {result['db_queries_per_update']} SQL, {result['db_connections_per_update']} соединений, "
+          f"{result['api_calls_per_update']} вызовов Bot API")
+    print("  сценарий         апдейтов     p50 мс     p95 мс     p99 мс")
+    for name, stats in result["scenarios"].items():
+        print(f"  {name:<16} {stats['updates']:>8} {stats['p50']:>10.2f} {stats['p95']:>10.2f} {stats['p99']:>10.2f}")
+    print("  обработчик                 вызовов   SQL/вызов   p99 ≤ мс")
+    for label, stats in result["handlers"].items():
+        print(f"  {label:<26} {stats['calls']:>7} {stats['queries_per_call']:>11} {stats['p99_ms']:>10g}")
+    print(f"  выпадений: {result['draws']['count']} (отпечаток {result['draws']['digest']}), "
+          f"не сходится с seed: {result['draw_mismatches']}")
+    if result["errors"]:
+        print(f"  ⚠️ ошибок: {result['errors']}")
+        for text, hits in result["error_samples"].items():
+            print(f"    {hits:>5} × {text}")
+
+
+async def prepare_db(args) -> bool:
+    """Возвращает True, если файл БД временный и его надо удалить после прогона"""
+    if args.db:
+        main.DB_PATH = args.db
+        fresh = not os.path.exists(args.db)
+    else:
+        fd, main.DB_PATH = tempfile.mkstemp(suffix=".db", prefix="cars_load_")
+        os.close(fd)
+        fresh = True
+    await main.init_db()
+    await main.init_rng(f"loadtest-{args.seed}")
+    if fresh:
+        start = time.perf_counter()
+        await seed_population(args.users, args.seed)
+        await main.init_db()  # стартовые записи журнала для новых игроков
+        print(f"🌱 {args.users} игроков сгенерировано за {time.perf_counter() - start:.1f} с")
+    await main.load_order_book()
+    await main.load_market_values()
+    await main.load_cooldowns()
+    await main.load_known_users()
+    await main.load_bans()
+    return not args.db
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота через dp.feed_update")
+    parser.add_argument("--users", type=int, default=10_000, help="размер популяции (10000 / 100000 / 1000000)")
+    parser.add_argument("--updates", type=int, default=5_000, help="сколько апдейтов прогнать")
+    parser.add_argument("--concurrency", type=int, default=100, help="одновременных игроков")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="задержка фейкового Bot API")
+    parser.add_argument("--seed", type=int, default=1, help="seed популяции и смеси сценариев")
+    parser.add_argument("--db", help="сохранить/переиспользовать БД популяции по этому пути")
+    parser.add_argument("--json", help="записать результат в JSON (для сравнения в CI)")
+    return parser.parse_args(argv)
+
+
+async def amain(args) -> dict:
+    temporary = await prepare_db(args)
+    try:
+        return await run_load(args)
+    finally:
+        if temporary and os.path.exists(main.DB_PATH):
+            os.remove(main.DB_PATH)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = asyncio.run(amain(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if result["errors"] or result["draw_mismatches"] else 0)
@@ -1,20 +1,41 @@
 # main.py — БЛОК 1: Импорты, настройка, инициализация БД
 import os
+import sys
+import math
+import time
+import heapq
+import json
+import zlib
+import struct
 import asyncio
+import hashlib
+import secrets
+import importlib.util
+import sqlite3
 import aiosqlite
 import logging
-from datetime import datetime, timedelta
-from typing import List, Dict, Optional
-
-from aiogram import Bot, Dispatcher, types, F
+import logging.handlers
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, NamedTuple, Optional
+
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
 from aiogram.types import (
-    Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+    Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton,
+    BufferedInputFile, FSInputFile, InputMediaPhoto
 )
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiohttp import web
 
 # 🔒 Токен берётся из переменной окружения (Replit Secrets)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -28,22 +49,26 @@ dp = Dispatcher(storage=storage)
 
 # 📊 Пути и константы
 DB_PATH = "cars_bot.db"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — без HTTP-эндпоинта /metrics
+SQL_DEBUG = os.getenv("SQL_DEBUG") == "1"  # отладка: в журнал пишется каждый запрос
+SLOW_QUERY_MS = 0 if SQL_DEBUG else float(os.getenv("SLOW_QUERY_MS", "50"))
+SLOW_QUERY_LOG = "slow_queries.jsonl"
+
+# ✍️ SQLite допускает одного писателя: транзакции BEGIN IMMEDIATE ждут своей очереди здесь,
+# а не в busy-таймауте SQLite (он «спит» и под нагрузкой падает с «database is locked»)
+DB_WRITE_LOCK = asyncio.Lock()
 
 # 💱 Курсы валют (примерные, можно обновлять)
 USD_TO_RUB = 80
 USD_TO_EUR = 0.93
 
-# 🎨 Доступные цвета для покраски
-PAINT_COLORS = [
-    "Красный", "Синий", "Чёрный", "Белый", "Жёлтый",
-    "Зелёный", "Фиолетовый", "Оранжевый", "Серый", "Бронзовый"
-]
-
-# 📦 Глобальный список всех машин (будет заполнен в БЛОКЕ 2)
-ALL_CARS: List[Dict] = []
-
-# 🏠 Список недвижимости (будет заполнен позже)
-REAL_ESTATE = {}
+# 🎨 Доступные цвета для покраски (RGB — для перекрашенных картинок, БЛОК 14)
+PAINT_RGB = {
+    "Красный": (200, 30, 30), "Синий": (30, 70, 200), "Чёрный": (25, 25, 25), "Белый": (235, 235, 235),
+    "Жёлтый": (240, 200, 20), "Зелёный": (30, 150, 60), "Фиолетовый": (120, 40, 170),
+    "Оранжевый": (240, 120, 20), "Серый": (128, 128, 128), "Бронзовый": (160, 110, 50),
+}
+PAINT_COLORS = list(PAINT_RGB)
 
 # 🔐 Админ (только @sky_for_pagani2)
 CREATOR_USERNAME = "sky_for_pagani2"
@@ -62,9 +87,21 @@ def format_number(n: int) -> str:
 def now_iso() -> str:
     return datetime.utcnow().isoformat()
 
+# 🧱 Утилита: добавить колонку в существующую таблицу (миграция старых БД)
+async def add_column_if_missing(db: aiosqlite.Connection, table: str, column: str, decl: str) -> bool:
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        columns = {row[1] for row in await cursor.fetchall()}
+    if column in columns:
+        return False
+    await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
+
 # 🛠️ Инициализация базы данных
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with connect_db() as db:
+        # WAL: запись журнала и страниц одной дозаписью, читатели не блокируют писателя
+        await db.execute("PRAGMA journal_mode=WAL")
+
         # Таблица пользователей
         await db.execute("""
             CREATE TABLE IF NOT EXISTS users (
@@ -81,9 +118,23 @@ async def init_db():
                 promo_test_used BOOLEAN DEFAULT 0,
                 promo_test2_used BOOLEAN DEFAULT 0,
                 promo_bt_used BOOLEAN DEFAULT 0,
-                promo_betatest_used BOOLEAN DEFAULT 0
+                promo_betatest_used BOOLEAN DEFAULT 0,
+                drop_credits INTEGER DEFAULT 0,
+                last_drop_at INTEGER,
+                last_luck_case_at INTEGER,
+                notify_ready BOOLEAN DEFAULT 0
             )
         """)
+        if await add_column_if_missing(db, "users", "drop_credits", "INTEGER DEFAULT 0"):
+            # Раньше BetaTest навсегда отключал таймер — выдаём обещанные 5 попыток
+            await db.execute("UPDATE users SET drop_credits = 5 WHERE promo_betatest_used = 1")
+        # Таймеры — целые секунды unix; старые ISO-строки переносим один раз
+        for column, legacy in (("last_drop_at", "last_drop"), ("last_luck_case_at", "last_luck_case")):
+            if await add_column_if_missing(db, "users", column, "INTEGER"):
+                await db.execute(
+                    f"UPDATE users SET {column} = CAST(strftime('%s', {legacy}) AS INTEGER) WHERE {legacy} IS NOT NULL"
+                )
+        await add_column_if_missing(db, "users", "notify_ready", "BOOLEAN DEFAULT 0")
 
         # Таблица машин игроков
         await db.execute("""
@@ -97,6 +148,9 @@ async def init_db():
                 color TEXT DEFAULT 'Стандартный'
             )
         """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_user_cars_owner ON user_cars (user_id, car_id)")
+        # Версия строки растёт при каждой смене владельца или цвета — по ней обмен проверяет, что машина та же
+        await add_column_if_missing(db, "user_cars", "version", "INTEGER NOT NULL DEFAULT 0")
 
         # Глобальные лимиты на машины
         await db.execute("""
@@ -112,9 +166,164 @@ async def init_db():
                 user_id INTEGER,
                 estate_id TEXT,
                 purchased_at TEXT,
+                last_collected TEXT,
+                collected_at INTEGER,
                 PRIMARY KEY (user_id, estate_id)
             )
         """)
+        await add_column_if_missing(db, "user_real_estate", "last_collected", "TEXT")
+        # Отметка начисления — целые секунды unix; старые ISO-строки переносим один раз
+        if await add_column_if_missing(db, "user_real_estate", "collected_at", "INTEGER"):
+            await db.execute("""
+                UPDATE user_real_estate SET collected_at = CAST(strftime('%s', last_collected) AS INTEGER)
+                WHERE last_collected IS NOT NULL
+            """)
+        # Ставки дохода из каталога — для начисления одним запросом
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS estate_rates (
+                estate_id TEXT PRIMARY KEY,
+                income_per_10_sec INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        await sync_estate_rates(db)
+
+        # Биржа: заявки игроков на покупку (bid) и продажу (ask)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS market_orders (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                car_id INTEGER,
+                side TEXT,
+                price INTEGER,
+                user_car_id INTEGER,
+                status TEXT DEFAULT 'open',
+                created_at TEXT,
+                filled_price INTEGER,
+                filled_at TEXT
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_market_orders_open ON market_orders (status, car_id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_market_orders_car_row ON market_orders (user_car_id)")
+
+        # Журнал операций: только INSERT, никогда UPDATE/DELETE
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS ledger (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                kind INTEGER NOT NULL,
+                amount INTEGER NOT NULL DEFAULT 0,
+                car_id INTEGER,
+                ts INTEGER NOT NULL
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger (user_id, id)")
+
+        # Промокоды и их активации
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS promo_codes (
+                code TEXT PRIMARY KEY,
+                reward_type TEXT NOT NULL,
+                reward_value INTEGER NOT NULL,
+                max_uses INTEGER,
+                used_count INTEGER NOT NULL DEFAULT 0,
+                expires_at INTEGER,
+                created_at INTEGER
+            )
+        """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS promo_redemptions (
+                code TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                redeemed_at INTEGER,
+                PRIMARY KEY (code, user_id)
+            ) WITHOUT ROWID
+        """)
+        await seed_promo_codes(db)
+
+        # Предложения обмена: входящие ищутся по (получатель, статус, срок), истёкшие — по (статус, срок)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS exchange_offers (
+                id INTEGER PRIMARY KEY,
+                initiator_id INTEGER NOT NULL,
+                recipient_id INTEGER NOT NULL,
+                cash INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL DEFAULT 'open',
+                created_at INTEGER,
+                expires_at INTEGER NOT NULL
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_exchange_offers_inbox ON exchange_offers (recipient_id, status, expires_at)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_exchange_offers_outbox ON exchange_offers (initiator_id, status, expires_at)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_exchange_offers_expiry ON exchange_offers (status, expires_at)")
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS exchange_offer_cars (
+                offer_id INTEGER NOT NULL,
+                user_car_id INTEGER NOT NULL,
+                version INTEGER NOT NULL,
+                side TEXT NOT NULL,
+                PRIMARY KEY (offer_id, user_car_id)
+            ) WITHOUT ROWID
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_exchange_offer_cars_row ON exchange_offer_cars (user_car_id)")
+
+        # Аудит генератора случайностей: seed каждого процесса и каждое выпадение
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS rng_seeds (
+                id INTEGER PRIMARY KEY,
+                seed TEXT NOT NULL,
+                created_at INTEGER
+            )
+        """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS rng_draws (
+                id INTEGER PRIMARY KEY,
+                seed_id INTEGER,
+                stream TEXT NOT NULL,
+                counter INTEGER NOT NULL,
+                pool_size INTEGER NOT NULL,
+                pool_hash INTEGER NOT NULL,
+                pick INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                car_id INTEGER NOT NULL,
+                ts INTEGER NOT NULL
+            )
+        """)
+        # file_id загруженных в Telegram картинок; size и mtime — чтобы заметить замену файла
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS media_files (
+                image TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                uploaded_at INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        # Перекрашенные картинки на диске: used_at — последний показ, по нему LRU
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS media_variants (
+                name TEXT PRIMARY KEY,
+                image TEXT NOT NULL,
+                color TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                used_at INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        # Баны: until — unix-время окончания, NULL — навсегда
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS bans (
+                user_id INTEGER PRIMARY KEY,
+                until INTEGER,
+                reason TEXT,
+                banned_by INTEGER,
+                banned_at INTEGER NOT NULL
+            )
+        """)
+        # Игрокам, которые были до журнала, — стартовая запись с текущим балансом
+        await db.execute("""
+            INSERT INTO ledger (user_id, kind, amount, ts)
+            SELECT user_id, ?, balance, ? FROM users
+            WHERE NOT EXISTS (SELECT 1 FROM ledger WHERE ledger.user_id = users.user_id)
+        """, (LEDGER_KINDS["opening"], int(time.time())))
 
         await db.commit()
 
@@ -122,553 +331,424 @@ async def init_db():
 @dp.startup()
 async def on_startup():
     await init_db()
+    await init_rng()
+    await load_order_book()
+    await load_market_values()
+    await load_cooldowns()
+    await load_known_users()
+    await load_bans()
+    await load_media()
+    asyncio.create_task(cooldown_sweeper())
+    asyncio.create_task(catalog_watcher())
+    asyncio.create_task(offer_sweeper())
+    asyncio.create_task(estate_settler())
+    asyncio.create_task(name_flusher())
+    if MEDIA_CHAT_ID:
+        asyncio.create_task(media_preloader())
+    asyncio.create_task(variant_usage_flusher())
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT)
     print("✅ База данных инициализирована. Бот запущен.")
 
+@dp.shutdown()
+async def on_shutdown():
+    await flush_names()
+    await flush_variant_usage()
+
 # 🧪 Тестовая команда (для отладки)
 @dp.message(Command("ping"))
 async def ping(message: Message):
     await message.answer("pong! Бот жив и сохраняет данные в cars_bot.db")
-  # main.py — БЛОК 2: Все машины
-
-# 🎁 ВСЕ ВЫПАДАЮЩИЕ МАШИНЫ (DROP) — 110 штук (сокращённый пул)
-DROP_CARS = [
-    # Mercedes (15)
-    {"id": 1, "name": "Mercedes-Benz 190E 2.5-16 Evolution II", "price_usd": 150_000, "year": 1991, "type": "drop", "max_global": 502, "image": "190e_evo2.png"},
-    {"id": 2, "name": "Mercedes-Benz CLK GTR", "price_usd": 4_500_000, "year": 1998, "type": "drop", "max_global": 35, "image": "clk_gtr.png"},
-    {"id": 3, "name": "Mercedes-Benz SLR McLaren 722", "price_usd": 1_200_000, "year": 2006, "type": "drop", "max_global": 150, "image": "slr_722.png"},
-    {"id": 4, "name": "Mercedes-Benz SLS AMG Black Series", "price_usd": 300_000, "year": 2013, "type": "drop", "max_global": 350, "image": "sls_black.png"},
-    {"id": 5, "name": "Mercedes-Benz G 63 AMG 6x6", "price_usd": 500_000, "year": 2013, "type": "drop", "max_global": 100, "image": "g63_6x6.png"},
-    {"id": 6, "name": "Mercedes-Benz AMG GT Black Series", "price_usd": 350_000, "year": 2021, "type": "drop", "max_global": 730, "image": "gt_black.png"},
-    {"id": 7, "name": "Mercedes-Benz 300 SL Gullwing", "price_usd": 1_800_000, "year": 1954, "type": "drop", "max_global": 1400, "image": "300sl_gullwing.png"},
-    {"id": 8, "name": "Mercedes-Benz 500 E", "price_usd": 80_000, "year": 1991, "type": "drop", "max_global": 10_000, "image": "500e.png"},
-    {"id": 9, "name": "Mercedes-Benz C 63 AMG Black Series", "price_usd": 120_000, "year": 2011, "type": "drop", "max_global": 250, "image": "c63_black.png"},
-    {"id": 10, "name": "Mercedes-Benz E 63 AMG W212", "price_usd": 90_000, "year": 2013, "type": "drop", "max_global": 800, "image": "e63_w212.png"},
-    {"id": 11, "name": "Mercedes-Benz R129 SL 600", "price_usd": 70_000, "year": 1995, "type": "drop", "max_global": 2000, "image": "sl600.png"},
-    {"id": 12, "name": "Mercedes-Benz 190E Cosworth", "price_usd": 200_000, "year": 1988, "type": "drop", "max_global": 502, "image": "190e_cosworth.png"},
-    {"id": 13, "name": "Mercedes-Benz CLK DTM AMG", "price_usd": 600_000, "year": 2004, "type": "drop", "max_global": 100, "image": "clk_dtm.png"},
-    {"id": 14, "name": "Mercedes-Benz A 45 AMG", "price_usd": 55_000, "year": 2013, "type": "drop", "max_global": 5000, "image": "a45_amg.png"},
-    {"id": 15, "name": "Mercedes-Benz Unimog U5000", "price_usd": 200_000, "year": 2010, "type": "drop", "max_global": 1000, "image": "unimog.png"},
-
-    # BMW (15)
-    {"id": 16, "name": "BMW M1", "price_usd": 550_000, "year": 1978, "type": "drop", "max_global": 453, "image": "bmw_m1.png"},
-    {"id": 17, "name": "BMW E30 M3 Sport Evolution", "price_usd": 200_000, "year": 1990, "type": "drop", "max_global": 600, "image": "e30_m3.png"},
-    {"id": 18, "name": "BMW E46 M3 CSL", "price_usd": 180_000, "year": 2003, "type": "drop", "max_global": 1383, "image": "e46_m3_csl.png"},
-    {"id": 19, "name": "BMW 850 CSi", "price_usd": 120_000, "year": 1992, "type": "drop", "max_global": 1510, "image": "850csi.png"},
-    {"id": 20, "name": "BMW Z8", "price_usd": 350_000, "year": 2000, "type": "drop", "max_global": 5703, "image": "bmw_z8.png"},
-    {"id": 21, "name": "BMW M3 GTR (E46)", "price_usd": 1_500_000, "year": 2001, "type": "drop", "max_global": 10, "image": "m3_gtr.png"},
-    {"id": 22, "name": "BMW 1 Series M Coupe", "price_usd": 70_000, "year": 2011, "type": "drop", "max_global": 7400, "image": "1m_coupe.png"},
-    {"id": 23, "name": "BMW M4 CSL", "price_usd": 150_000, "year": 2022, "type": "drop", "max_global": 1000, "image": "m4_csl.png"},
-    {"id": 24, "name": "BMW Z3 M Coupe", "price_usd": 60_000, "year": 1998, "type": "drop", "max_global": 5000, "image": "z3_mcoup.png"},
-    {"id": 25, "name": "BMW i8", "price_usd": 100_000, "year": 2014, "type": "drop", "max_global": 20_000, "image": "bmw_i8.png"},
-    {"id": 26, "name": "BMW M5 CS", "price_usd": 140_000, "year": 2021, "type": "drop", "max_global": 1000, "image": "m5_cs.png"},
-    {"id": 27, "name": "BMW Alpina B7", "price_usd": 130_000, "year": 2020, "type": "drop", "max_global": 2000, "image": "alpina_b7.png"},
-    {"id": 28, "name": "BMW 3.0 CSL '70s", "price_usd": 600_000, "year": 1973, "type": "drop", "max_global": 1265, "image": "30csl_70s.png"},
-    {"id": 29, "name": "BMW M2 Competition", "price_usd": 60_000, "year": 2018, "type": "drop", "max_global": 5000, "image": "m2_comp.png"},
-    {"id": 30, "name": "BMW X5 M", "price_usd": 90_000, "year": 2020, "type": "drop", "max_global": 10_000, "image": "x5m.png"},
-
-    # Nissan (8)
-    {"id": 31, "name": "Nissan Skyline GT-R R34", "price_usd": 200_000, "year": 1999, "type": "drop", "max_global": 11_548, "image": "r34.png"},
-    {"id": 32, "name": "Nissan GT-R Nismo", "price_usd": 220_000, "year": 2015, "type": "drop", "max_global": 15_000, "image": "gtr_nismo.png"},
-    {"id": 33, "name": "Nissan 300ZX Twin Turbo", "price_usd": 50_000, "year": 1990, "type": "drop", "max_global": 15_000, "image": "300zx.png"},
-    {"id": 34, "name": "Nissan Silvia S15", "price_usd": 40_000, "year": 1999, "type": "drop", "max_global": 6000, "image": "s15.png"},
-    {"id": 35, "name": "Nissan Fairlady Z (Z33)", "price_usd": 35_000, "year": 2003, "type": "drop", "max_global": 20_000, "image": "z33.png"},
-    {"id": 36, "name": "Nissan Laurel C33", "price_usd": 20_000, "year": 1990, "type": "drop", "max_global": 10_000, "image": "laurel.png"},
-    {"id": 37, "name": "Nissan Stagea", "price_usd": 25_000, "year": 1996, "type": "drop", "max_global": 8000, "image": "stagea.png"},
-    {"id": 38, "name": "Nissan Cima Y34", "price_usd": 30_000, "year": 1996, "type": "drop", "max_global": 5000, "image": "cima.png"},
-
-    # Toyota (12)
-    {"id": 39, "name": "Toyota Supra MK4", "price_usd": 80_000, "year": 1993, "type": "drop", "max_global": 50_000, "image": "supra_mk4.png"},
-    {"id": 40, "name": "Toyota GR Supra", "price_usd": 60_000, "year": 2019, "type": "drop", "max_global": 100_000, "image": "gr_supra.png"},
-    {"id": 41, "name": "Toyota Celica GT-Four (ST205)", "price_usd": 40_000, "year": 1994, "type": "drop", "max_global": 15_000, "image": "celica.png"},
-    {"id": 42, "name": "Toyota Land Cruiser FJ40", "price_usd": 90_000, "year": 1975, "type": "drop", "max_global": 20_000, "image": "fj40.png"},
-    {"id": 43, "name": "Toyota 2000GT", "price_usd": 1_200_000, "year": 1967, "type": "drop", "max_global": 351, "image": "2000gt.png"},
-    {"id": 44, "name": "Toyota MR2 SW20", "price_usd": 25_000, "year": 1993, "type": "drop", "max_global": 20_000, "image": "mr2.png"},
-    {"id": 45, "name": "Toyota Celsior UCF10", "price_usd": 30_000, "year": 1990, "type": "drop", "max_global": 10_000, "image": "celsior.png"},
-    {"id": 46, "name": "Toyota Altezza RS200", "price_usd": 20_000, "year": 1998, "type": "drop", "max_global": 8000, "image": "altezza.png"},
-    {"id": 47, "name": "Toyota Chaser JZX100", "price_usd": 25_000, "year": 1996, "type": "drop", "max_global": 12_000, "image": "chaser.png"},
-    {"id": 48, "name": "Toyota Aristo V300", "price_usd": 30_000, "year": 1997, "type": "drop", "max_global": 8000, "image": "aristo.png"},
-    {"id": 49, "name": "Toyota Soarer JZZ30", "price_usd": 35_000, "year": 1991, "type": "drop", "max_global": 10_000, "image": "soarer.png"},
-    {"id": 50, "name": "Toyota Century G50", "price_usd": 200_000, "year": 2018, "type": "drop", "max_global": 5000, "image": "century.png"},
-
-    # Lexus (5)
-    {"id": 51, "name": "Lexus LFA", "price_usd": 400_000, "year": 2010, "type": "drop", "max_global": 500, "image": "lexus_lfa.png"},
-    {"id": 52, "name": "Lexus IS F", "price_usd": 45_000, "year": 2007, "type": "drop", "max_global": 10_000, "image": "isf.png"},
-    {"id": 53, "name": "Lexus RC F", "price_usd": 75_000, "year": 2014, "type": "drop", "max_global": 15_000, "image": "rcf.png"},
-    {"id": 54, "name": "Lexus SC 430", "price_usd": 25_000, "year": 2001, "type": "drop", "max_global": 20_000, "image": "sc430.png"},
-    {"id": 55, "name": "Lexus GX 470", "price_usd": 40_000, "year": 2002, "type": "drop", "max_global": 100_000, "image": "gx470.png"},
-
-    # Cadillac (4)
-    {"id": 56, "name": "Cadillac CTS-V", "price_usd": 80_000, "year": 2009, "type": "drop", "max_global": 10_000, "image": "ctsv.png"},
-    {"id": 57, "name": "Cadillac Escalade ESV", "price_usd": 100_000, "year": 2021, "type": "drop", "max_global": 50_000, "image": "escalade.png"},
-    {"id": 58, "name": "Cadillac Eldorado", "price_usd": 30_000, "year": 1959, "type": "drop", "max_global": 20_000, "image": "eldorado.png"},
-    {"id": 59, "name": "Cadillac ATS-V", "price_usd": 60_000, "year": 2016, "type": "drop", "max_global": 5000, "image": "atsv.png"},
-
-    # Русские авто (6)
-    {"id": 60, "name": "Lada Niva Legend", "price_usd": 15_000, "year": 2021, "type": "drop", "max_global": 1_000_000, "image": "niva.png"},
-    {"id": 61, "name": "UAZ 469", "price_usd": 20_000, "year": 1970, "type": "drop", "max_global": 500_000, "image": "uaz469.png"},
-    {"id": 62, "name": "Moskvich 412", "price_usd": 10_000, "year": 1970, "type": "drop", "max_global": 200_000, "image": "moskvich.png"},
-    {"id": 63, "name": "GAZ Chaika", "price_usd": 50_000, "year": 1960, "type": "drop", "max_global": 3000, "image": "chaika.png"},
-    {"id": 64, "name": "ZIL-114", "price_usd": 100_000, "year": 1970, "type": "drop", "max_global": 150, "image": "zil114.png"},
-    {"id": 65, "name": "Marussia B2", "price_usd": 200_000, "year": 2012, "type": "drop", "max_global": 30, "image": "marussia.png"},
-
-    # Китайские (5)
-    {"id": 66, "name": "Hongqi L5", "price_usd": 800_000, "year": 2014, "type": "drop", "max_global": 500, "image": "hongqi_l5.png"},
-    {"id": 67, "name": "NIO EP9", "price_usd": 1_500_000, "year": 2016, "type": "drop", "max_global": 10, "image": "nio_ep9.png"},
-    {"id": 68, "name": "BYD Han", "price_usd": 60_000, "year": 2020, "type": "drop", "max_global": 100_000, "image": "byd_han.png"},
-    {"id": 69, "name": "Geely Coolray", "price_usd": 25_000, "year": 2019, "type": "drop", "max_global": 500_000, "image": "coolray.png"},
-    {"id": 70, "name": "Chery Tiggo 8", "price_usd": 20_000, "year": 2018, "type": "drop", "max_global": 300_000, "image": "tiggo8.png"},
-
-    # Прочие бренды (40)
-    {"id": 71, "name": "Fiat 500 Abarth", "price_usd": 25_000, "year": 2008, "type": "drop", "max_global": 100_000, "image": "fiat_500.png"},
-    {"id": 72, "name": "Renault Alpine A110", "price_usd": 70_000, "year": 2017, "type": "drop", "max_global": 5000, "image": "alpine_a110.png"},
-    {"id": 73, "name": "Jaguar XJR-15", "price_usd": 1_000_000, "year": 1991, "type": "drop", "max_global": 53, "image": "xjr15.png"},
-    {"id": 74, "name": "Mazda RX-7 FD", "price_usd": 40_000, "year": 1992, "type": "drop", "max_global": 68_000, "image": "rx7.png"},
-    {"id": 75, "name": "Subaru Impreza WRX STI", "price_usd": 45_000, "year": 2004, "type": "drop", "max_global": 100_000, "image": "sti.png"},
-    {"id": 76, "name": "Mitsubishi Lancer Evolution IX", "price_usd": 40_000, "year": 2005, "type": "drop", "max_global": 25_000, "image": "evo9.png"},
-    {"id": 77, "name": "Dodge Viper ACR", "price_usd": 150_000, "year": 2016, "type": "drop", "max_global": 1000, "image": "viper_acr.png"},
-    {"id": 78, "name": "Chevrolet Corvette C7 Z06", "price_usd": 200_000, "year": 2013, "type": "drop", "max_global": 20_000, "image": "corvette.png"},
-    {"id": 79, "name": "Ford Mustang GT", "price_usd": 50_000, "year": 2015, "type": "drop", "max_global": 200_000, "image": "mustang_gt.png"},
-    {"id": 80, "name": "Aston Martin V8 Vantage", "price_usd": 120_000, "year": 2005, "type": "drop", "max_global": 22_000, "image": "vantage.png"},
-    {"id": 81, "name": "Lotus Elise", "price_usd": 60_000, "year": 2000, "type": "drop", "max_global": 20_000, "image": "elise.png"},
-    {"id": 82, "name": "Maserati MC12", "price_usd": 900_000, "year": 2004, "type": "drop", "max_global": 50, "image": "mc12.png"},
-    {"id": 83, "name": "Alfa Romeo 8C Competizione", "price_usd": 200_000, "year": 2007, "type": "drop", "max_global": 500, "image": "8c.png"},
-    {"id": 84, "name": "Ferrari 308 GTB", "price_usd": 100_000, "year": 1975, "type": "drop", "max_global": 5000, "image": "308.png"},
-    {"id": 85, "name": "Porsche 911 Carrera RS", "price_usd": 500_000, "year": 1973, "type": "drop", "max_global": 1580, "image": "911_rs.png"},
-    {"id": 86, "name": "Volvo 240 Turbo", "price_usd": 30_000, "year": 1983, "type": "drop", "max_global": 50_000, "image": "volvo240.png"},
-    {"id": 87, "name": "Saab 9-3 Viggen", "price_usd": 25_000, "year": 1999, "type": "drop", "max_global": 10_000, "image": "saab_viggen.png"},
-    {"id": 88, "name": "Opel Calibra", "price_usd": 20_000, "year": 1990, "type": "drop", "max_global": 100_000, "image": "calibra.png"},
-    {"id": 89, "name": "Peugeot 205 GTI", "price_usd": 35_000, "year": 1984, "type": "drop", "max_global": 50_000, "image": "205gti.png"},
-    {"id": 90, "name": "Mini Cooper S R53", "price_usd": 25_000, "year": 2002, "type": "drop", "max_global": 100_000, "image": "mini_r53.png"},
-    {"id": 91, "name": "Kia Stinger GT", "price_usd": 50_000, "year": 2017, "type": "drop", "max_global": 50_000, "image": "stinger.png"},
-    {"id": 92, "name": "Hyundai Genesis Coupe", "price_usd": 30_000, "year": 2010, "type": "drop", "max_global": 100_000, "image": "genesis_coupe.png"},
-    {"id": 93, "name": "Suzuki Swift Sport", "price_usd": 20_000, "year": 2017, "type": "drop", "max_global": 200_000, "image": "swift_sport.png"},
-    {"id": 94, "name": "Dacia Duster", "price_usd": 15_000, "year": 2010, "type": "drop", "max_global": 1_000_000, "image": "duster.png"},
-    {"id": 95, "name": "Tata Nano", "price_usd": 2_500, "year": 2008, "type": "drop", "max_global": 1_000_000, "image": "nano.png"},
-    {"id": 96, "name": "Holden Commodore HSV", "price_usd": 80_000, "year": 2015, "type": "drop", "max_global": 10_000, "image": "commodore.png"},
-    {"id": 97, "name": "TVR Griffith", "price_usd": 150_000, "year": 1996, "type": "drop", "max_global": 2000, "image": "tvr_griffith.png"},
-    {"id": 98, "name": "Morgan Plus Six", "price_usd": 100_000, "year": 2019, "type": "drop", "max_global": 500, "image": "morgan.png"},
-    {"id": 99, "name": "Caterham Seven", "price_usd": 60_000, "year": 2020, "type": "drop", "max_global": 1000, "image": "caterham.png"},
-    {"id": 100, "name": "Noble M600", "price_usd": 350_000, "year": 2010, "type": "drop", "max_global": 300, "image": "noble_m600.png"},
-    {"id": 101, "name": "Ruf CTR Yellowbird", "price_usd": 1_000_000, "year": 1987, "type": "drop", "max_global": 25, "image": "ruf_yellowbird.png"},
-    {"id": 102, "name": "Ginetta G55", "price_usd": 80_000, "year": 2011, "type": "drop", "max_global": 500, "image": "ginetta.png"},
-    {"id": 103, "name": "BAC Mono", "price_usd": 180_000, "year": 2011, "type": "drop", "max_global": 300, "image": "bac_mono.png"},
-    {"id": 104, "name": "Ariel Atom", "price_usd": 80_000, "year": 2015, "type": "drop", "max_global": 1000, "image": "ariel_atom.png"},
-    {"id": 105, "name": "Radical SR3", "price_usd": 150_000, "year": 2003, "type": "drop", "max_global": 500, "image": "radical_sr3.png"},
-    {"id": 106, "name": "Donkervoort D8 GTO", "price_usd": 100_000, "year": 2013, "type": "drop", "max_global": 500, "image": "donkervoort.png"},
-    {"id": 107, "name": "Lancia Delta Integrale", "price_usd": 100_000, "year": 1987, "type": "drop", "max_global": 5000, "image": "delta_integrale.png"},
-    {"id": 108, "name": "Fiat X1/9", "price_usd": 15_000, "year": 1972, "type": "drop", "max_global": 100_000, "image": "x19.png"},
-    {"id": 109, "name": "Triumph TR6", "price_usd": 50_000, "year": 1969, "type": "drop", "max_global": 10_000, "image": "tr6.png"},
-    {"id": 110, "name": "MG B GT", "price_usd": 30_000, "year": 1965, "type": "drop", "max_global": 20_000, "image": "mgb_gt.png"},
-]
-
-# 🛍️ АВТОСАЛОН — 30+ машин
-SALON_CARS = [
-    {"id": 111, "name": "Pagani Huayra", "price_usd": 2_400_000, "year": 2011, "type": "salon", "max_global": 100, "image": "huayra.png"},
-    {"id": 112, "name": "Pagani Utopia", "price_usd": 2_600_000, "year": 2022, "type": "salon", "max_global": 99, "image": "utopia.png"},
-    {"id": 113, "name": "Mercedes-AMG Project ONE", "price_usd": 2_700_000, "year": 2022, "type": "salon", "max_global": 275, "image": "project_one.png"},
-    {"id": 114, "name": "Mercedes-Benz SLR McLaren Stirling Moss", "price_usd": 1_300_000, "year": 2009, "type": "salon", "max_global": 6, "image": "stirling_moss.png"},
-    {"id": 115, "name": "Mercedes-Benz SLR McLaren 722", "price_usd": 1_200_000, "year": 2006, "type": "salon", "max_global": 150, "image": "slr_722_salon.png"},
-    {"id": 116, "name": "Rolls-Royce Boat Tail", "price_usd": 28_000_000, "year": 2021, "type": "salon", "max_global": 5, "image": "boat_tail.png"},
-    {"id": 117, "name": "Brabham BT62", "price_usd": 1_200_000, "year": 2018, "type": "salon", "max_global": 70, "image": "bt62.png"},
-    {"id": 118, "name": "Bugatti Chiron", "price_usd": 3_000_000, "year": 2016, "type": "salon", "max_global": 500, "image": "chiron.png"},
-    {"id": 119, "name": "Bugatti Tourbillon", "price_usd": 4_000_000, "year": 2024, "type": "salon", "max_global": 250, "image": "tourbillon.png"},
-    {"id": 120, "name": "Bugatti Chiron Super Sport", "price_usd": 3_800_000, "year": 2021, "type": "salon", "max_global": 30, "image": "chiron_ss.png"},
-    {"id": 121, "name": "Bugatti Veyron", "price_usd": 1_700_000, "year": 2005, "type": "salon", "max_global": 450, "image": "veyron.png"},
-    {"id": 122, "name": "Hispano-Suiza Carmen", "price_usd": 1_700_000, "year": 2019, "type": "salon", "max_global": 19, "image": "carmen.png"},
-    {"id": 123, "name": "Spania GTA Spano", "price_usd": 1_200_000, "year": 2013, "type": "salon", "max_global": 99, "image": "spano.png"},
-    {"id": 124, "name": "Koenigsegg Regera", "price_usd": 2_000_000, "year": 2015, "type": "salon", "max_global": 85, "image": "regera.png"},
-    {"id": 125, "name": "Rolls-Royce Droptail", "price_usd": 30_000_000, "year": 2023, "type": "salon", "max_global": 3, "image": "droptail.png"},
-    # Вторая подгруппа — "обычные" редкие
-    {"id": 126, "name": "Spyker C8 Preliator", "price_usd": 1_500_000, "year": 2016, "type": "salon", "max_global": 50, "image": "spyker.png"},
-    {"id": 127, "name": "Gumpert Apollo IE", "price_usd": 3_000_000, "year": 2019, "type": "salon", "max_global": 10, "image": "apollo_ie.png"},
-    {"id": 128, "name": "Zenvo TSR-S", "price_usd": 2_000_000, "year": 2019, "type": "salon", "max_global": 5, "image": "zenvo.png"},
-    {"id": 129, "name": "Ares Design Project1", "price_usd": 1_700_000, "year": 2020, "type": "salon", "max_global": 99, "image": "ares_p1.png"},
-    {"id": 130, "name": "Vanda Electrics Dendrobium", "price_usd": 3_000_000, "year": 2023, "type": "salon", "max_global": 10, "image": "dendrobium.png"},
-    {"id": 131, "name": "De Tomaso P900", "price_usd": 2_000_000, "year": 2023, "type": "salon", "max_global": 18, "image": "p900.png"},
-    {"id": 132, "name": "Czinger 21C", "price_usd": 1_700_000, "year": 2022, "type": "salon", "max_global": 80, "image": "czinger_21c.png"},
-    {"id": 133, "name": "SSC Tuatara", "price_usd": 1_900_000, "year": 2020, "type": "salon", "max_global": 100, "image": "tuatara.png"},
-    {"id": 134, "name": "Hennessey Venom F5", "price_usd": 2_100_000, "year": 2021, "type": "salon", "max_global": 24, "image": "venom_f5.png"},
-    {"id": 135, "name": "Rimac Nevera", "price_usd": 2_400_000, "year": 2021, "type": "salon", "max_global": 150, "image": "nevera.png"},
-    {"id": 136, "name": "Pininfarina Battista", "price_usd": 2_200_000, "year": 2019, "type": "salon", "max_global": 150, "image": "battista.png"},
-    {"id": 137, "name": "Lotus Evija", "price_usd": 2_300_000, "year": 2020, "type": "salon", "max_global": 130, "image": "evija.png"},
-    {"id": 138, "name": "Ferrari Daytona SP3", "price_usd": 2_200_000, "year": 2021, "type": "salon", "max_global": 599, "image": "daytona_sp3.png"},
-    {"id": 139, "name": "Lamborghini Sián FKP 37",
-    {"id": 140, "name": "McLaren Speedtail", "price_usd": 2_250_000, "year": 2019, "type": "salon", "max_global": 106, "image": "speedtail.png"},
-]
+# main.py — БЛОК 2: Каталог машин и недвижимости
+
+# 📦 Машины и недвижимость лежат в catalog.json рядом с ботом: правка каталога — без правки кода.
+# Файл читается при первом обращении к catalog() и проверяется целиком.
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json")
+CATALOG_SECTIONS = ("drop", "salon", "luck_case", "tuning", "real_estate")
+ESTATE_FIELDS = ("id", "name", "price_usd", "image")
+
+class Car(NamedTuple):
+    """Машина каталога: неизменяемая запись без __dict__, поля читаются как car.price_usd"""
+    id: int
+    name: str
+    price_usd: int
+    year: int
+    type: str
+    max_global: int
+    image: str
+    category: Optional[str] = None
+
+CAR_FIELDS = Car._fields
+UNKNOWN_CAR = Car(id=0, name="Неизвестная машина", price_usd=0, year="???", type="", max_global=0, image="")
+
+def make_car(entry: Dict) -> Car:
+    missing = [field for field in CAR_FIELDS if field not in entry and field not in Car._field_defaults]
+    unknown = [field for field in entry if field not in CAR_FIELDS]
+    if missing or unknown:
+        raise ValueError(f"catalog: машина {entry.get('id')}: нет полей {missing}, лишние поля {unknown}")
+    return Car(**entry)
+
+class Catalog:
+    """
+    Снимок каталога: списки по источникам, индекс машин по id
+    и колонки array('q') цен и лимитов, где индекс — id машины.
+    """
+    __slots__ = (
+        "version", "drop_cars", "salon_cars", "luck_cars", "tuning_brands", "real_estate",
+        "all_cars", "cars_by_id", "prices", "limits", "drop_ids", "id_mask", "mtime",
+    )
 
-# ✨ АКЦИЯ УДАЧИ — 70+ машин (разделены по категориям ниже)
-LUCK_CASE_CARS = [
-    {"id": 201, "name": "Rolls Royce Phantom II Jonckheere Aerodynamic Coupe", "price_usd": 8_000_000, "year": 1934, "type": "luck_case", "max_global": 1, "image": "phantom_jonckheere.png", "category": "Ретро Иконы"},
-    {"id": 202, "name": "Nissan Z Nismo GT4", "price_usd": 250_000, "year": 2023, "type": "luck_case", "max_global": 100, "image": "z_nismo.png", "category": "Гоночные машины"},
-    {"id": 203, "name": "W Motors Lykan Hypersport", "price_usd": 3_400_000, "year": 2013, "type": "luck_case", "max_global": 7, "image": "lykan.png", "category": "Гиперкары"},
-    {"id": 204, "name": "W Motors Fenyr Supersport", "price_usd": 2_000_000, "year": 2016, "type": "luck_case", "max_global": 25, "image": "fenyr.png", "category": "Гиперкары"},
-    {"id": 205, "name": "Ford Mustang GTD", "price_usd": 300_000, "year": 2023, "type": "luck_case", "max_global": 1000, "image": "mustang_gtd.png", "category": "Гоночные машины"},
-    {"id": 206, "name": "Ford Mustang RTR Spec5", "price_usd": 150_000, "year": 2020, "type": "luck_case", "max_global": 500, "image": "rtr_spec5.png", "category": "Трековые авто"},
-    {"id": 207, "name": "Ford Mustang Mach-E 1400", "price_usd": 1_000_000, "year": 2020, "type": "luck_case", "max_global": 1, "image": "mach_e_1400.png", "category": "Концепты"},
-    {"id": 208, "name": "Ford GT40 MkI", "price_usd": 10_000_000, "year": 1966, "type": "luck_case", "max_global": 12, "image": "gt40.png", "category": "Гоночные машины"},
-    {"id": 209, "name": "Bugatti Type 57SC Atlantic", "price_usd": 40_000_000, "year": 1936, "type": "luck_case", "max_global": 3, "image": "type57sc.png", "category": "Ретро Иконы"},
-    {"id": 210, "name": "Lexus LFA", "price_usd": 400_000, "year": 2010, "type": "luck_case", "max_global": 500, "image": "lfa_luck.png", "category": "Гиперкары"},
-    {"id": 211, "name": "Bugatti Mistral", "price_usd": 5_000_000, "year": 2022, "type": "luck_case", "max_global": 99, "image": "mistral.png", "category": "Гиперкары"},
-    {"id": 212, "name": "Bugatti EB110 Super Sport", "price_usd": 3_000_000, "year": 1992, "type": "luck_case", "max_global": 30, "image": "eb110.png", "category": "Гиперкары"},
-    {"id": 213, "name": "Bugatti Chiron Super Sport 300+", "price_usd": 3_900_000, "year": 2019, "type": "luck_case", "max_global": 30, "image": "ss300.png", "category": "Гиперкары"},
-    {"id": 214, "name": "Koenigsegg CC850", "price_usd": 3_200_000, "year": 2022, "type": "luck_case", "max_global": 175, "image": "cc850.png", "category": "Гиперкары"},
-    {"id": 215, "name": "Koenigsegg CCX", "price_usd": 900_000, "year": 2006, "type": "luck_case", "max_global": 50, "image": "ccx.png", "category": "Гиперкары"},
-    {"id": 216, "name": "Koenigsegg Regera Ghost Package", "price_usd": 2_500_000, "year": 2021, "type": "luck_case", "max_global": 10, "image": "regera_ghost.png", "category": "Гиперкары"},
-    {"id": 217, "name": "Koenigsegg Agera RS", "price_usd": 2_500_000, "year": 2015, "type": "luck_case", "max_global": 25, "image": "agera_rs.png", "category": "Гиперкары"},
-    {"id": 218, "name": "Koenigsegg One:1", "price_usd": 2_700_000, "year": 2014, "type": "luck_case", "max_global": 2, "image": "one1.png", "category": "Гиперкары"},
-    {"id": 219, "name": "Koenigsegg Jesko Attack", "price_usd": 3_000_000, "year": 2022, "type": "luck_case", "max_global": 125, "image": "jesko_attack.png", "category": "Гиперкары"},
-    {"id": 220, "name": "Koenigsegg Jesko Absolute", "price_usd": 2_800_000, "year": 2022, "type": "luck_case", "max_global": 125, "image": "jesko_absolute.png", "category": "Гиперкары"},
-    {"id": 221, "name": "Koenigsegg CCXR Trevita", "price_usd": 4_800_000, "year": 2009, "type": "luck_case", "max_global": 3, "image": "trevita.png", "category": "Гиперкары"},
-    {"id": 222, "name": "Pagani Zonda F", "price_usd": 1_500_000, "year": 2005, "type": "luck_case", "max_global": 20, "image": "zonda_f.png", "category": "Гиперкары"},
-    {"id": 223, "name": "Pagani Zonda R", "price_usd": 2_000_000, "year": 2009, "type": "luck_case", "max_global": 15, "image": "zonda_r.png", "category": "Трековые авто"},
-    {"id": 224, "name": "Pagani Zonda Cinque", "price_usd": 1_800_000, "year": 2009, "type": "luck_case", "max_global": 5, "image": "zonda_cinque.png", "category": "Гиперкары"},
-    {"id": 225, "name": "Pagani Zonda C12", "price_usd": 1_200_000, "year": 1999, "type": "luck_case", "max_global": 30, "image": "zonda_c12.png", "category": "Гиперкары"},
-    {"id": 226, "name": "Pagani Huayra R", "price_usd": 3_500_000, "year": 2020, "type": "luck_case", "max_global": 30, "image": "huayra_r.png", "category": "Трековые авто"},
-    {"id": 227, "name": "Pagani Huayra BC", "price_usd": 2_800_000, "year": 2016, "type": "luck_case", "max_global": 20, "image": "huayra_bc.png", "category": "Гиперкары"},
-    {"id": 228, "name": "Bentley Continental GT3", "price_usd": 500_000, "year": 2013, "type": "luck_case", "max_global": 100, "image": "gt3.png", "category": "Гоночные машины"},
-    {"id": 229, "name": "Hennessey Venom F5 Roadster", "price_usd": 3_000_000, "year": 2022, "type": "luck_case", "max_global": 12, "image": "venom_f5_roadster.png", "category": "Гиперкары"},
-    {"id": 230, "name": "Jaguar E-Type Series 3 V12 Roadster", "price_usd": 300_000, "year": 1971, "type": "luck_case", "max_global": 1000, "image": "etype.png", "category": "Ретро Иконы"},
-    {"id": 231, "name": "Porsche 911 GT1", "price_usd": 15_000_000, "year": 1996, "type": "luck_case", "max_global": 20, "image": "911_gt1.png", "category": "Гоночные машины"},
-    {"id": 232, "name": "Porsche 963 LMDh #5", "price_usd": 2_000_000, "year": 2023, "type": "luck_case", "max_global": 1, "image": "963_5.png", "category": "Гоночные машины"},
-    {"id": 233, "name": "Porsche Mission R", "price_usd": 1_000_000, "year": 2021, "type": "luck_case", "max_global": 10, "image": "mission_r.png", "category": "Концепты"},
-    {"id": 234, "name": "Porsche 917K #23", "price_usd": 20_000_000, "year": 1970, "type": "luck_case", "max_global": 1, "image": "917k_23.png", "category": "Гоночные машины"},
-    {"id": 235, "name": "Porsche 917K", "price_usd": 18_000_000, "year": 1970, "type": "luck_case", "max_global": 10, "image": "917k.png", "category": "Гоночные машины"},
-    {"id": 236, "name": "Porsche 917/20 Pink Pig", "price_usd": 18_500_000, "year": 1971, "type": "luck_case", "max_global": 1, "image": "pink_pig.png", "category": "Гоночные машины"},
-    {"id": 237, "name": "Porsche 911 Turbo S (991.2)", "price_usd": 180_000, "year": 2017, "type": "luck_case", "max_global": 10_000, "image": "911_turbo_s.png", "category": "Гиперкары"},
-    {"id": 238, "name": "Porsche 959 Bruce Canepa", "price_usd": 1_200_000, "year": 1986, "type": "luck_case", "max_global": 50, "image": "959_canepa.png", "category": "Ретро Иконы"},
-    {"id": 239, "name": "Porsche 911 GT3 RS", "price_usd": 220_000, "year": 2022, "type": "luck_case", "max_global": 2000, "image": "gt3_rs.png", "category": "Трековые авто"},
-    {"id": 240, "name": "Porsche 935 Martini Racing", "price_usd": 800_000, "year": 2019, "type": "luck_case", "max_global": 77, "image": "935_martini.png", "category": "Гоночные машины"},
-    {"id": 241, "name": "Porsche 956B", "price_usd": 12_000_000, "year": 1983, "type": "luck_case", "max_global": 20, "image": "956b.png", "category": "Гоночные машины"},
-    {"id": 242, "name": "Ram 1500 TRX", "price_usd": 80_000, "year": 2021, "type": "luck_case", "max_global": 5000, "image": "ram_trx.png", "category": "Необычные"},
-    {"id": 243, "name": "Mercedes-Benz E320 W210 4Matic", "price_usd": 10_000, "year": 1997, "type": "luck_case", "max_global": 10_000, "image": "e320_w210.png", "category": "Обычные машины"},
-    {"id": 244, "name": "Mercedes-Benz O303", "price_usd": 200_000, "year": 1980, "type": "luck_case", "max_global": 1000, "image": "o303.png", "category": "Необычные"},
-    {"id": 245, "name": "Mercedes CLK LM", "price_usd": 3_000_000, "year": 1998, "type": "luck_case", "max_global": 25, "image": "clk_lm.png", "category": "Гоночные машины"},
-    {"id": 246, "name": "McLaren 650S", "price_usd": 300_000, "year": 2013, "type": "luck_case", "max_global": 5000, "image": "650s.png", "category": "Гиперкары"},
-    {"id": 247, "name": "McLaren 650S GT3", "price_usd": 600_000, "year": 2015, "type": "luck_case", "max_global": 50, "image": "650s_gt3.png", "category": "Гоночные машины"},
-    {"id": 248, "name": "McLaren MP4/4", "price_usd": 8_000_000, "year": 1988, "type": "luck_case", "max_global": 1, "image": "mp44.png", "category": "Гоночные машины"},
-    {"id": 249, "name": "McLaren P1 MADMAC", "price_usd": 5_000_000, "year": 2020, "type": "luck_case", "max_global": 1, "image": "p1_madmac.png", "category": "Гиперкары"},
-    {"id": 250, "name": "McLaren P1", "price_usd": 1_500_000, "year": 2013, "type": "luck_case", "max_global": 375, "image": "p1.png", "category": "Гиперкары"},
-    {"id": 251, "name": "McLaren Senna", "price_usd": 1_000_000, "year": 2018, "type": "luck_case", "max_global": 500, "image": "senna.png", "category": "Трековые авто"},
-    {"id": 252, "name": "McLaren Senna GTR", "price_usd": 1_500_000, "year": 2019, "type": "luck_case", "max_global": 75, "image": "senna_gtr.png", "category": "Трековые авто"},
-    {"id": 253, "name": "McLaren 600LT", "price_usd": 250_000, "year": 2018, "type": "luck_case", "max_global": 1000, "image": "600lt.png", "category": "Гиперкары"},
-    {"id": 254, "name": "McLaren Speedtail", "price_usd": 2_250_000, "year": 2019, "type": "luck_case", "max_global": 106, "image": "speedtail_luck.png", "category": "Гиперкары"},
-    {"id": 255, "name": "McLaren MCL38", "price_usd": 1_000_000, "year": 2024, "type": "luck_case", "max_global": 1, "image": "mcl38.png", "category": "Гоночные машины"},
-    {"id": 256, "name": "Ferrari Daytona SP3", "price_usd": 2_200_000, "year": 2021, "type": "luck_case", "max_global": 499, "image": "daytona_sp3_luck.png", "category": "Гиперкары"},
-    {"id": 257, "name": "Ferrari F40 LM", "price_usd": 4_000_000, "year": 1988, "type": "luck_case", "max_global": 10, "image": "f40_lm.png", "category": "Гоночные машины"},
-    {"id": 258, "name": "Ferrari F8 Tributo", "price_usd": 280_000, "year": 2019, "type": "luck_case", "max_global": 4000, "image": "f8.png", "category": "Гиперкары"},
-    {"id": 259, "name": "Ferrari 12Cilindri Spider", "price_usd": 400_000, "year": 2024, "type": "luck_case", "max_global": 500, "image": "12cilindri.png", "category": "Гиперкары"},
-    {"id": 260, "name": "Ferrari F50", "price_usd": 2_200_000, "year": 1995, "type": "luck_case", "max_global": 349, "image": "f50.png", "category": "Гиперкары"},
-    {"id": 261, "name": "Ferrari FXX Evolution", "price_usd": 2_500_000, "year": 2009, "type": "luck_case", "max_global": 30, "image": "fxx_evo.png", "category": "Трековые авто"},
-    {"id": 262, "name": "Ferrari KC23", "price_usd": 3_000_000, "year": 2023, "type": "luck_case", "max_global": 1, "image": "kc23.png", "category": "Концепты"},
-    {"id": 263, "name": "Lamborghini Countach LPI 800-4", "price_usd": 2_600_000, "year": 2021, "type": "luck_case", "max_global": 112, "image": "countach_lpi.png", "category": "Гиперкары"},
-    {"id": 264, "name": "Lamborghini Murciélago LP 670-4 SuperVeloce", "price_usd": 500_000, "year": 2009, "type": "luck_case", "max_global": 350, "image": "murcielago_sv.png", "category": "Гиперкары"},
-    {"id": 265, "name": "Lamborghini Countach 1989", "price_usd": 800_000, "year": 1989, "type": "luck_case", "max_global": 10, "image": "countach_89.png", "category": "Ретро Иконы"},
-    {"id": 266, "name": "Lamborghini Aventador S LP 740-4", "price_usd": 500_000, "year": 2016, "type": "luck_case", "max_global": 1000, "image": "aventador_s.png", "category": "Гиперкары"},
-    {"id": 267, "name": "Lamborghini Veneno Roadster", "price_usd": 8_000_000, "year": 2014, "type": "luck_case", "max_global": 9, "image": "veneno_roadster.png", "category": "Гиперкары"},
-    {"id": 268, "name": "Lamborghini Sián FKP 37 Ad Personam", "price_usd": 4_000_000, "year": 2019, "type": "luck_case", "max_global": 1, "image": "sian_adp.png", "category": "Гиперкары"},
-    {"id": 269, "name": "Lamborghini Huracán STO", "price_usd": 350_000, "year": 2021, "type": "luck_case", "max_global": 1000, "image": "huracan_sto.png", "category": "Трековые авто"},
-    {"id": 270, "name": "Lamborghini SC63 LMDh", "price_usd": 1_500_000, "year": 2023, "type": "luck_case", "max_global": 1, "image": "sc63.png", "category": "Гоночные машины"},
-    {"id": 271, "name": "Apollo Intensa Emozione Orange Dragon", "price_usd": 7_000_000, "year": 2018, "type": "luck_case", "max_global": 2, "image": "apollo_orange.png", "category": "Гиперкары"},
-    {"id": 272, "name": "Apollo Intensa Emozione", "price_usd": 3_000_000, "year": 2018, "type": "luck_case", "max_global": 10, "image": "apollo_ie_luck.png", "category": "Гиперкары"},
-    {"id": 273, "name": "Apollo Project Evo", "price_usd": 3_500_000, "year": 2022, "type": "luck_case", "max_global": 30, "image": "apollo_evo.png", "category": "Трековые авто"},
-    {"id": 274, "name": "Pininfarina Battista Nino Farina", "price_usd": 2_500_000, "year": 2023, "type": "luck_case", "max_global": 4, "image": "battista_nino.png", "category": "Гиперкары"},
-]
-# main.py — БЛОК 2 (обновлённый фрагмент)
-
-TUNING_BRANDS = {
-    "RuDesign": [
-        {"id": 301, "name": "Bugatti Chiron Super Sport 110 ANS Ettore Bugatti", "price_usd": 10_000_000, "year": 2021, "type": "tuning", "max_global": 110, "image": "chiron_110_ans.png"},
-        {"id": 302, "name": "Bugatti Tourbillon Equipe Porcelainé", "price_usd": 6_700_000, "year": 2024, "type": "tuning", "max_global": 250, "image": "tourbillon_porcelain.png"},
-        {"id": 303, "name": "Pagani Huayra RPL", "price_usd": 4_000_000, "year": 2023, "type": "tuning", "max_global": 15, "image": "huayra_rpl.png"},
-        {"id": 304, "name": "Pagani Huayra Barchetta Codalunga", "price_usd": 12_000_000, "year": 2021, "type": "tuning", "max_global": 5, "image": "barchetta_codalunga.png"},
-        {"id": 305, "name": "Pagani Utopia Authentić", "price_usd": 4_000_000, "year": 2022, "type": "tuning", "max_global": 99, "image": "utopia_authentic.png"},
-        {"id": 306, "name": "Pagani Huayra Epitome Cabriolét", "price_usd": 12_000_000, "year": 2023, "type": "tuning", "max_global": 8, "image": "epitome_cabriolet.png"},
-        {"id": 307, "name": "Pagani Huayra BC: Imola Cabriolét", "price_usd": 8_200_000, "year": 2022, "type": "tuning", "max_global": 8, "image": "imola_cabriolet.png"},
-        {"id": 308, "name": "Mercedes-Hispano G-Klasse Sagrera", "price_usd": 970_000, "year": 2023, "type": "tuning", "max_global": 50, "image": "g_klasse_sagrera.png"},
-        {"id": 309, "name": "Mercedes-Benz Hispano-Suiza", "price_usd": 1_000_000, "year": 2022, "type": "tuning", "max_global": 20, "image": "mercedes_hispano.png"},
-        {"id": 310, "name": "Mercedes-Hispano G-Carmen Two-door", "price_usd": 1_100_000, "year": 2023, "type": "tuning", "max_global": 30, "image": "g_carmen.png"},
-        {"id": 311, "name": "Aspark Owl LongTail", "price_usd": 3_700_000, "year": 2023, "type": "tuning", "max_global": 7, "image": "owl_longtail.png"},
-        {"id": 312, "name": "Saleen S7 BetMobili *2025 Enjoy Halloween Two", "price_usd": 9_000_000, "year": 2025, "type": "tuning", "max_global": 1, "image": "saleen_halloween.png"},
-        {"id": 313, "name": "Brabham BT62 Xtreme Modema", "price_usd": 2_000_000, "year": 2023, "type": "tuning", "max_global": 20, "image": "bt62_xtreme.png"},
-    ],
-    
-    "Mansory": [
-        {"id": 314, "name": "Mansory Ford GT Le Mansory", "price_usd": 800_000, "year": 2018, "type": "tuning", "max_global": 10, "image": "ford_gt_mansory.png"},
-        {"id": 315, "name": "Mansory Torofeo", "price_usd": 450_000, "year": 2020, "type": "tuning", "max_global": 100, "image": "torofeo.png"},
-        {"id": 316, "name": "Mansory Carbonado EVO Roadster", "price_usd": 500_000, "year": 2021, "type": "tuning", "max_global": 150, "image": "carbonado_evo.png"},
-        {"id": 317, "name": "Mansory Venatus", "price_usd": 400_000, "year": 2019, "type": "tuning", "max_global": 200, "image": "venatus.png"},
-        {"id": 318, "name": "Mansory Cabrera", "price_usd": 350_000, "year": 2018, "type": "tuning", "max_global": 250, "image": "cabrera.png"},
-        {"id": 319, "name": "Mansory Cyrus", "price_usd": 380_000, "year": 2020, "type": "tuning", "max_global": 180, "image": "cyrus.png"},
-        {"id": 320, "name": "Mansory Centuria", "price_usd": 420_000, "year": 2021, "type": "tuning", "max_global": 120, "image": "centuria.png"},
-        {"id": 321, "name": "Mansory Vivre", "price_usd": 300_000, "year": 2019, "type": "tuning", "max_global": 300, "image": "vivre.png"},
-    ],
-    
-    "PAGANsky DesignACHE": [
-        {"id": 322, "name": "Ford GT 'LeMen'", "price_usd": 2_000_000, "year": 2022, "type": "tuning", "max_global": 25, "image": "ford_gt_lemen.png"},
-        {"id": 323, "name": "Pagani Huayra Codalunga Speedster PAGANskeì Preparation", "price_usd": 9_600_000, "year": 2022, "type": "tuning", "max_global": 5, "image": "codalunga_speedster.png"},
-        {"id": 324, "name": "Porsche 918 Co'up (Coupe) SFP", "price_usd": 3_100_000, "year": 2021, "type": "tuning", "max_global": 10, "image": "porsche_918_sfp.png"},
-        {"id": 325, "name": "Rolls Royce Boattail Jonckheere Aerodynamic Coupe 'Moderna'", "price_usd": 52_920_000, "year": 2023, "type": "tuning", "max_global": 1, "image": "boattail_moderna.png"},
-        {"id": 326, "name": "Mercedes-AMG Project: One/two Landalet", "price_usd": 4_300_000, "year": 2023, "type": "tuning", "max_global": 50, "image": "project_one_landalet.png"},
-        {"id": 327, "name": "Ferrari F80 GEMBALLA MIG U-3", "price_usd": 8_000_000, "year": 2024, "type": "tuning", "max_global": 3, "image": "f80_gemballa.png"},
-        {"id": 328, "name": "Ferrari F80 APERTA LA SWEDEN", "price_usd": 5_000_000, "year": 2024, "type": "tuning", "max_global": 5, "image": "f80_aperta.png"},
-        {"id": 329, "name": "McLaren Senna F1 'Champion Ayrton Senna'", "price_usd": 3_000_000, "year": 2021, "type": "tuning", "max_global": 10, "image": "senna_f1_champion.png"},
-    ],
-    
-    "Zagato": [
-        {"id": 330, "name": "Aston Martin DB4 GT Zagato", "price_usd": 7_000_000, "year": 1961, "type": "tuning", "max_global": 19, "image": "db4_zagato.png"},
-        {"id": 331, "name": "Aston Martin DB7 Zagato", "price_usd": 600_000, "year": 2002, "type": "tuning", "max_global": 99, "image": "db7_zagato.png"},
-        {"id": 332, "name": "Aston Martin V12 Zagato", "price_usd": 500_000, "year": 2011, "type": "tuning", "max_global": 150, "image": "v12_zagato.png"},
-        {"id": 333, "name": "Aston Martin Vanquish Zagato", "price_usd": 1_200_000, "year": 2016, "type": "tuning", "max_global": 325, "image": "vanquish_zagato.png"},
-        {"id": 334, "name": "Alfa Romeo Giulietta SZ Zagato", "price_usd": 1_000_000, "year": 1960, "type": "tuning", "max_global": 250, "image": "giulietta_sz.png"},
-        {"id": 335, "name": "Alfa Romeo SZ Zagato", "price_usd": 350_000, "year": 1989, "type": "tuning", "max_global": 1000, "image": "alfa_sz.png"},
-        {"id": 336, "name": "Lancia Hyena Zagato", "price_usd": 400_000, "year": 1992, "type": "tuning", "max_global": 25, "image": "lancia_hyena.png"},
-        {"id": 337, "name": "Lancia Fulvia Coupe Zagato", "price_usd": 300_000, "year": 1968, "type": "tuning", "max_global": 100, "image": "fulvia_zagato.png"},
-        {"id": 338, "name": "Fiat 8V Zagato", "price_usd": 2_000_000, "year": 1954, "type": "tuning", "max_global": 30, "image": "fiat_8v_zagato.png"},
-        {"id": 339, "name": "Maserati A6G 2000 Coupe Zagato", "price_usd": 1_500_000, "year": 1956, "type": "tuning", "max_global": 20, "image": "a6g_zagato.png"},
-        {"id": 340, "name": "Maserati Biturbo Spyder Zagato", "price_usd": 200_000, "year": 1986, "type": "tuning", "max_global": 100, "image": "biturbo_zagato.png"},
-        {"id": 341, "name": "Spyker C12 Zagato", "price_usd": 1_200_000, "year": 2008, "type": "tuning", "max_global": 30, "image": "spyker_c12_zagato.png"},
-        {"id": 342, "name": "Lamborghini P147 Zagato", "price_usd": 1_800_000, "year": 2020, "type": "tuning", "max_global": 10, "image": "p147_zagato.png"},
-    ],
-    
-    "ItalDesign": [
-        {"id": 343, "name": "Italdesign Parcour", "price_usd": 1_300_000, "year": 2013, "type": "tuning", "max_global": 1, "image": "parcour.png"},
-        {"id": 344, "name": "Italdesign Zerouno", "price_usd": 1_600_000, "year": 2017, "type": "tuning", "max_global": 5, "image": "zerouno.png"},
-    ],
-    
-    "Gemballa": [
-        {"id": 345, "name": "Ferrari Enzo Gemballa MIG U-1", "price_usd": 4_000_000, "year": 2003, "type": "tuning", "max_global": 1, "image": "enzo_gemballa_mig.png"},
-        {"id": 346, "name": "Porsche Carrera GT Mirage", "price_usd": 1_200_000, "year": 2005, "type": "tuning", "max_global": 25, "image": "carrera_gt_mirage.png"},
-        {"id": 347, "name": "Ferrari Testarossa Gemballa", "price_usd": 800_000, "year": 1985, "type": "tuning", "max_global": 10, "image": "testarossa_gemballa.png"},
-    ],
-    
-    "RUF": [
-        {"id": 348, "name": "RUF CTR Yellowbird", "price_usd": 1_000_000, "year": 1987, "type": "tuning", "max_global": 25, "image": "ctr_yellowbird.png"},
-        {"id": 349, "name": "RUF CTR3", "price_usd": 900_000, "year": 2007, "type": "tuning", "max_global": 50, "image": "ctr3.png"},
-        {"id": 350, "name": "RUF RT 12", "price_usd": 700_000, "year": 2010, "type": "tuning", "max_global": 100, "image": "rt12.png"},
-        {"id": 351, "name": "RUF SCR 4.2", "price_usd": 650_000, "year": 2018, "type": "tuning", "max_global": 150, "image": "scr_42.png"},
-    ],
-    
-    "Hennessey": [
-        {"id": 352, "name": "Hennessey Venom F5", "price_usd": 2_100_000, "year": 2021, "type": "tuning", "max_global": 24, "image": "venom_f5.png"},
-        {"id": 353, "name": "Hennessey Venom F5 Roadster", "price_usd": 3_000_000, "year": 2022, "type": "tuning", "max_global": 12, "image": "venom_f5_roadster.png"},
-        {"id": 354, "name": "Hennessey Exorcist ZR1", "price_usd": 300_000, "year": 2018, "type": "tuning", "max_global": 100, "image": "exorcist.png"},
-        {"id": 355, "name": "Hennessey Mammoth 1000 TRX", "price_usd": 250_000, "year": 2021, "type": "tuning", "max_global": 200, "image": "mammoth_trx.png"},
-    ],
-    
-    "9FF": [
-        {"id": 356, "name": "9FF GT9-R", "price_usd": 1_000_000, "year": 2008, "type": "tuning", "max_global": 20, "image": "gt9r.png"},
-        {"id": 357, "name": "9FF GT9 CS", "price_usd": 900_000, "year": 2010, "type": "tuning", "max_global": 30, "image": "gt9_cs.png"},
-        {"id": 358, "name": "9FF T9", "price_usd": 500_000, "year": 2006, "type": "tuning", "max_global": 50, "image": "t9.png"},
-        {"id": 359, "name": "9FF Carrera GTR", "price_usd": 600_000, "year": 2012, "type": "tuning", "max_global": 40, "image": "carrera_gtr.png"},
-    ],
-    
-    "Brabus": [
-        {"id": 360, "name": "Brabus Rocket 900", "price_usd": 500_000, "year": 2020, "type": "tuning", "max_global": 25, "image": "rocket_900.png"},
-        {"id": 361, "name": "Brabus G900", "price_usd": 600_000, "year": 2021, "type": "tuning", "max_global": 30, "image": "g900.png"},
-        {"id": 362, "name": "Brabus 850 6.0 Biturbo", "price_usd": 450_000, "year": 2019, "type": "tuning", "max_global": 100, "image": "850_biturbo.png"},
-        {"id": 363, "name": "Brabus S700", "price_usd": 400_000, "year": 2022, "type": "tuning", "max_global": 120, "image": "s700.png"},
-    ],
-    
-    "Carlex": [
-        {"id": 364, "name": "Carlex DeTomaso P72", "price_usd": 1_200_000, "year": 2020, "type": "tuning", "max_global": 1, "image": "p72_carlex.png"},
-        {"id": 365, "name": "Carlex DeTomaso P900", "price_usd": 2_000_000, "year": 2023, "type": "tuning", "max_global": 18, "image": "p900_carlex.png"},
-        {"id": 366, "name": "Carlex SCG 003S", "price_usd": 600_000, "year": 2015, "type": "tuning", "max_global": 3, "image": "scg_003s_carlex.png"},
-        {"id": 367, "name": "Carlex SCG 003 Race Car", "price_usd": 5_000_000, "year": 2016, "type": "tuning", "max_global": 2, "image": "scg_003_race_carlex.png"},
-    ],
-    
-    "Saleen": [
-        {"id": 368, "name": "Saleen S7 Twin Turbo", "price_usd": 800_000, "year": 2005, "type": "tuning", "max_global": 300, "image": "s7_twin_turbo.png"},
-        {"id": 369, "name": "Saleen S1", "price_usd": 100_000, "year": 2018, "type": "tuning", "max_global": 500, "image": "s1.png"},
-        {"id": 370, "name": "Saleen S5S Raptor", "price_usd": 250_000, "year": 2007, "type": "tuning", "max_global": 50, "image": "s5s_raptor.png"},
-        {"id": 371, "name": "Saleen F150", "price_usd": 80_000, "year": 2020, "type": "tuning", "max_global": 1000, "image": "f150_saleen.png"},
-    ],
-}
-# main.py — БЛОК 3: Недвижимость
-
-REAL_ESTATE = {
-    "houses": [
-        {
-            "id": "house_1",
-            "name": "Дом The Vineyards Resort",
-            "location": "Bulgaria, Aheloi",
-            "price_usd": 210_000,
-            "image": "vineyards_resort.jpg"
-        },
-        {
-            "id": "house_2",
-            "name": "Дом Updown Court",
-            "location": "England, Windlesham",
-            "price_usd": 140_000_000,
-            "image": "updown_court.jpg"
-        },
-        {
-            "id": "house_3",
-            "name": "Особняк Daniel’s Lane",
-            "location": "USA, NY",
-            "price_usd": 100_000_000,
-            "image": "daniels_lane.jpg"
+    def __init__(self, data: Dict, mtime: float = 0.0):
+        missing = [section for section in CATALOG_SECTIONS if section not in data]
+        if missing:
+            raise ValueError(f"catalog: нет разделов {missing}")
+        self.version = data.get("version", 0)
+        self.mtime = mtime
+        self.drop_cars: List[Car] = [make_car(entry) for entry in data["drop"]]
+        self.salon_cars: List[Car] = [make_car(entry) for entry in data["salon"]]
+        self.luck_cars: List[Car] = [make_car(entry) for entry in data["luck_case"]]
+        self.tuning_brands: Dict[str, List[Car]] = {
+            brand: [make_car(entry) for entry in entries] for brand, entries in data["tuning"].items()
         }
-    ],
-    "villas": [
-        {
-            "id": "villa_1",
-            "name": "Вилла Coastlands House",
-            "location": "USA, California",
-            "price_usd": 2_000_000,
-            "image": "coastlands_house.jpg"
-        },
-        {
-            "id": "villa_2",
-            "name": "Вилла Swiss Gold House",
-            "location": "Швейцария",
-            "price_usd": 12_000_000,
-            "image": "swiss_gold_house.jpg"
-        },
-        {
-            "id": "villa_3",
-            "name": "Вилла Villa Leopolda",
-            "location": "Франция",
-            "price_usd": 506_000_000,
-            "image": "villa_leopolda.jpg"
-        }
-    ],
-    "apartments": [
-        {
-            "id": "apt_1",
-            "name": "Квартира Yaroslavl City",
-            "location": "РФ, Ярославль",
-            "price_usd": 1_050_000,
-            "image": "yaroslavl_city.jpg"
-        },
-        {
-            "id": "apt_2",
-            "name": "Таун-хаус Boka Place Porto Montenegro",
-            "location": "Chernogoria, Tivan",
-            "price_usd": 910_000,
-            "image": "boka_place.jpg"
-        }
-    ],
-    "income_property": [
-        {
-            "id": "income_1",
-            "name": "Небоскреб Commerzbank Tower",
-            "location": "Франкфурт-на-Майне, Германия",
-            "price_usd": 1_200_000_000,
-            "income_per_10_sec": 120_000,
-            "image": "commerzbank_tower.jpg"
-        },
-        {
-            "id": "income_2",
-            "name": "Небоскреб-апартаменты Messeturm",
-            "location": "Франкфурт-на-Майне, Германия",
-            "price_usd": 3_700_000_000,
-            "income_per_10_sec": 200_000,
-            "image": "messeturm.jpg"
-        },
-        {
-            "id": "income_3",
-            "name": "Небоскреб-штабквартира Post Tower",
-            "location": "Бонн, Германия",
-            "price_usd": 1_800_000_000,
-            "income_per_10_sec": 100_000,
-            "image": "post_tower.jpg"
-        },
-        {
-            "id": "income_4",
-            "name": "Отель-небоскреб Park Inn by Radisson Berlin Alexanderplatz",
-            "location": "Берлин, Германия",
-            "price_usd": 3_200_000_000,
-            "income_per_10_sec": 500_000,
-            "image": "park_inn_berlin.jpg"
-        },
-        {
-            "id": "income_5",
-            "name": "Небоскреб Лахта-Центр",
-            "location": "РФ, С.-Петербург",
-            "price_usd": 2_400_000_000,
-            "income_per_10_sec": 80_000,
-            "image": "lahhta_center.jpg"
-        },
-        {
-            "id": "income_6",
-            "name": "ТЦ Wenge",
-            "location": "РФ, Ярославль",
-            "price_usd": 6_000_000,
-            "income_per_10_sec": 6_000,
-            "image": "wenge_mall.jpg"
-        },
-        {
-            "id": "income_7",
-            "name": "Пентхаус Antalia",
-            "location": "Мумбаи",
-            "price_usd": 1_000_000_000,
-            "income_per_10_sec": 30_000,
-            "image": "antalia_penthouse.jpg"
-        }
-    ]
-}
+        self.real_estate: Dict[str, List[Dict]] = data["real_estate"]
+        self.all_cars: List[Car] = (
+            self.drop_cars + self.salon_cars + self.luck_cars
+            + [car for cars in self.tuning_brands.values() for car in cars]
+        )
+        self.cars_by_id: Dict[int, Car] = {car.id: car for car in self.all_cars}
+
+        if len(self.cars_by_id) != len(self.all_cars):
+            ids = [car.id for car in self.all_cars]
+            duplicates = sorted({car_id for car_id in ids if ids.count(car_id) > 1})
+            raise ValueError(f"catalog: повторяющиеся id машин: {duplicates}")
+        estate_ids = [estate["id"] for estates in self.real_estate.values() for estate in estates]
+        if len(set(estate_ids)) != len(estate_ids):
+            raise ValueError("catalog: повторяющиеся id недвижимости")
+        for estates in self.real_estate.values():
+            for estate in estates:
+                missing = [field for field in ESTATE_FIELDS if field not in estate]
+                if missing:
+                    raise ValueError(f"catalog: у недвижимости {estate.get('id')} нет полей {missing}")
+
+        # Колонки по id: 8 байт на машину вместо словаря, без строковых ключей
+        size = max(self.cars_by_id) + 1
+        self.prices = array("q", bytes(8 * size))
+        self.limits = array("q", bytes(8 * size))
+        for car in self.all_cars:
+            self.prices[car.id] = car.price_usd
+            self.limits[car.id] = car.max_global
+        self.drop_ids = array("q", [car.id for car in self.drop_cars])
+        # Биты всех id каталога — для подсчёта коллекции по маске игрока
+        self.id_mask = 0
+        for car in self.all_cars:
+            self.id_mask |= 1 << car.id
+
+def load_catalog(path: str = CATALOG_PATH) -> Catalog:
+    mtime = os.stat(path).st_mtime
+    with open(path, encoding="utf-8") as f:
+        return Catalog(json.load(f), mtime)
+
+_CATALOG: Optional[Catalog] = None
+CATALOG_RELOAD_LOCK = asyncio.Lock()
+CATALOG_WATCH_INTERVAL = 10  # секунд между проверками catalog.json на изменения
+
+def catalog() -> Catalog:
+    """
+    Текущий снимок каталога. Снимок не меняется после сборки, а подменяется целиком,
+    поэтому синхронный код между await всегда видит одну версию.
+    """
+    global _CATALOG
+    if _CATALOG is None:
+        _CATALOG = load_catalog()
+    return _CATALOG
+
+async def reload_catalog(path: str = CATALOG_PATH) -> Catalog:
+    """
+    Читает и проверяет catalog.json в отдельном потоке, затем подменяет снимок одним присваиванием.
+    Если файл битый — бросает ValueError/OSError, а бот продолжает работать на старом снимке.
+    """
+    global _CATALOG
+    async with CATALOG_RELOAD_LOCK:
+        previous = catalog()
+        snapshot = await asyncio.to_thread(load_catalog, path)
+        _CATALOG = snapshot
+    refresh_market_values()
+    # Ставки переписываются только если их поменяли: обычная правка каталога не берёт DB_WRITE_LOCK
+    rates = estate_rate_rows(snapshot)
+    if rates != estate_rate_rows(previous):
+        async with uow(write=True) as tx:
+            await sync_estate_rates(tx, rates)
+    return snapshot
+
+async def catalog_watcher():
+    """Перечитывает каталог, когда catalog.json меняется на диске"""
+    seen_mtime = catalog().mtime
+    while True:
+        await asyncio.sleep(CATALOG_WATCH_INTERVAL)
+        try:
+            mtime = os.stat(CATALOG_PATH).st_mtime
+        except OSError:
+            continue
+        if mtime == seen_mtime:
+            continue
+        seen_mtime = mtime
+        try:
+            snapshot = await reload_catalog()
+        except (OSError, ValueError) as e:
+            logging.error("catalog.json не загружен, остаётся версия %s: %s", catalog().version, e)
+            continue
+        logging.info("Каталог обновлён: версия %s, машин %s", snapshot.version, len(snapshot.all_cars))
+
 # main.py — БЛОК 4: Главное меню и команды
 
 # ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
 
+# 👤 ensure_user стоит почти в каждом обработчике. id всех игроков лежат в памяти (поднимаются
+# при старте) вместе с отпечатком username и имени: в БД идёт только новый игрок, а смена имени
+# копится в PENDING_NAMES и записывается одним executemany раз в NAME_FLUSH_INTERVAL секунд.
+NAME_FLUSH_INTERVAL = 30
+KNOWN_USERS: Dict[int, int] = {}        # user_id -> отпечаток (username, имя)
+PENDING_NAMES: Dict[int, tuple] = {}    # user_id -> (username, имя), ещё не записанные
+USER_CACHE_STATS = {"avoided": 0, "inserted": 0, "renamed": 0}
+
+def name_fingerprint(username: Optional[str], full_name: Optional[str]) -> int:
+    return zlib.crc32(f"{username or ''}\0{full_name or ''}".encode())
+
+async def load_known_users():
+    """Поднимает в память id и отпечатки имён всех игроков"""
+    KNOWN_USERS.clear()
+    async with connect_db() as db:
+        async with db.execute("SELECT user_id, username, display_name FROM users") as cursor:
+            while rows := await cursor.fetchmany(10_000):
+                for user_id, username, display_name in rows:
+                    KNOWN_USERS[user_id] = name_fingerprint(username, display_name)
+
+def forget_user(user_id: int):
+    KNOWN_USERS.pop(user_id, None)
+    PENDING_NAMES.pop(user_id, None)
+
 async def ensure_user(user: types.User):
-    """Гарантирует, что пользователь есть в БД"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT OR IGNORE INTO users 
-            (user_id, username, display_name, currency) 
-            VALUES (?, ?, ?, ?)
+    """Гарантирует, что пользователь есть в БД; известного игрока — без запроса"""
+    fingerprint = name_fingerprint(user.username, user.full_name)
+    known = KNOWN_USERS.get(user.id)
+    if known is not None:
+        USER_CACHE_STATS["avoided"] += 1
+        if known != fingerprint:
+            KNOWN_USERS[user.id] = fingerprint
+            PENDING_NAMES[user.id] = (user.username, user.full_name)
+        return
+    async with uow(write=True) as tx:
+        await tx.execute("""
+            INSERT INTO users (user_id, username, display_name, currency) VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, display_name = excluded.display_name
         """, (user.id, user.username, user.full_name, "USD"))
-        await db.commit()
+    KNOWN_USERS[user.id] = fingerprint
+    PENDING_NAMES.pop(user.id, None)
+    USER_CACHE_STATS["inserted"] += 1
+
+async def flush_names() -> int:
+    """Записывает накопленные смены username и имени одной транзакцией"""
+    if not PENDING_NAMES:
+        return 0
+    batch = list(PENDING_NAMES.items())
+    PENDING_NAMES.clear()
+    try:
+        async with uow(write=True) as tx:
+            await tx.executemany(
+                "UPDATE users SET username = ?, display_name = ? WHERE user_id = ?",
+                [(username, full_name, user_id) for user_id, (username, full_name) in batch]
+            )
+    except Exception:
+        # Вернём в очередь то, что не перезаписано более свежим именем
+        for user_id, names in batch:
+            PENDING_NAMES.setdefault(user_id, names)
+        raise
+    USER_CACHE_STATS["renamed"] += len(batch)
+    return len(batch)
+
+async def name_flusher():
+    while True:
+        await asyncio.sleep(NAME_FLUSH_INTERVAL)
+        try:
+            await flush_names()
+        except Exception:
+            logging.exception("Не удалось записать новые имена игроков")
+
+class BalanceView(NamedTuple):
+    balance: int         # вместе с доходом, который ещё не зачислен
+    currency: str
+    estate_income: int   # заработано на недвижимости, включая незачисленное
+
+async def project_balance(user_id: int) -> BalanceView:
+    """Баланс с накопленным доходом от недвижимости — только чтение, для экранов"""
+    now = int(time.time())
+    async with uow() as tx:
+        async with tx.execute("""
+            SELECT balance, currency, real_estate_income, (
+                SELECT COALESCE(SUM((? - collected_at) / ? * income_per_10_sec), 0)
+                FROM user_real_estate JOIN estate_rates ON estate_rates.estate_id = user_real_estate.estate_id
+                WHERE user_real_estate.user_id = users.user_id AND collected_at <= ?
+            ) FROM users WHERE user_id = ?
+        """, (now, ESTATE_INCOME_PERIOD, now - ESTATE_INCOME_PERIOD, user_id)) as cursor:
+            row = await cursor.fetchone()
+    if not row:
+        return BalanceView(0, "USD", 0)
+    balance, currency, estate_income, pending = row
+    return BalanceView(balance + pending, currency or "USD", (estate_income or 0) + pending)
 
 async def get_balance_with_income(user_id: int) -> int:
-    """Возвращает баланс + доход от недвижимости (и сразу зачисляет его)"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Сначала получим текущий баланс
-        async with db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)) as cursor:
+    """Зачисляет игроку накопленный доход от недвижимости и возвращает баланс — перед списанием денег"""
+    async with uow(write=True) as tx:
+        await settle_estate_income(tx, user_id - 1, user_id, int(time.time()))
+        async with tx.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)) as cursor:
             row = await cursor.fetchone()
-            if not row:
-                return 0
-            balance = row[0]
-
-        # Рассчитаем и начислим доход от недвижимости
-        total_income = 0
-        now = datetime.utcnow()
-        async with db.execute("""
-            SELECT estate_id, last_collected FROM user_real_estate WHERE user_id = ?
-        """, (user_id,)) as cursor:
-            rows = await cursor.fetchall()
-
-        for estate_id, last_collected_str in rows:
-            estate = None
-            for category in REAL_ESTATE.values():
-                for item in category:
-                    if item["id"] == estate_id:
-                        estate = item
-                        break
-                if estate: break
-            if not estate or "income_per_10_sec" not in estate:
-                continue
-
-            last_collected = datetime.fromisoformat(last_collected_str)
-            seconds_passed = (now - last_collected).total_seconds()
-            intervals = int(seconds_passed // 10)
-            income = intervals * estate["income_per_10_sec"]
-            
-            if income > 0:
-                total_income += income
-                new_collected = last_collected + timedelta(seconds=intervals * 10)
-                await db.execute("""
-                    UPDATE user_real_estate SET last_collected = ? WHERE user_id = ? AND estate_id = ?
-                """, (new_collected.isoformat(), user_id, estate_id))
-
-        # Обновим баланс и real_estate_income
-        new_balance = balance + total_income
-        await db.execute("""
-            UPDATE users SET balance = ?, real_estate_income = ? WHERE user_id = ?
-        """, (new_balance, total_income, user_id))
-        await db.commit()
-        return new_balance
+    return row[0] if row else 0
+
+async def purchase_car(user_id: int, car: Car, kind: str, source: str) -> str:
+    """
+    Покупка машины из салона или ателье одной транзакцией: зачисление дохода,
+    проверка баланса и лимита, списание, запись в гараж. ok / no_money / sold_out
+    """
+    async with uow(write=True) as tx:
+        balance = await get_balance_with_income(user_id)
+        if balance < car.price_usd:
+            return "no_money"
+        if not await take_from_limit(tx, car):
+            return "sold_out"
+        await tx.execute("UPDATE users SET balance = balance - ? WHERE user_id = ?", (car.price_usd, user_id))
+        await tx.execute("""
+            INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (user_id, car.id, await has_car(user_id, car.id), source, now_iso()))
+        await write_ledger(tx, [ledger_row(user_id, kind, -car.price_usd, car.id)])
+        tx.on_commit(lambda: mark_owned(user_id, [car.id]))
+    note_issued(car.id)
+    return "ok"
+
+async def take_from_limit(tx: "UnitOfWork", car: Car) -> bool:
+    """Засчитывает выпуск экземпляра, если глобальный лимит не исчерпан. Только внутри uow(write=True)"""
+    cursor = await tx.execute("""
+        INSERT INTO global_car_counts (car_id, issued_count) SELECT ?, 1 WHERE ? > 0
+        ON CONFLICT(car_id) DO UPDATE SET issued_count = issued_count + 1 WHERE issued_count < ?
+    """, (car.id, car.max_global, car.max_global))
+    return cursor.rowcount == 1
+
+# ========== КОЛЛЕКЦИЯ ИГРОКА (БИТОВАЯ МАСКА) ==========
+
+# 🧩 В каталоге ~300 машин, поэтому «есть ли машина у игрока» — бит car_id в одном int (до 64 байт).
+# Маска живёт в LRU на OWNED_CACHE_SIZE игроков. Одиночная проверка has_car без маски в кэше —
+# точечный запрос по индексу (user_id, car_id); маска строится, только когда игрока проверяют часто
+# (OWNED_WARM_AFTER промахов) или нужна вся коллекция. Выдачи ставят биты, передача и продажа
+# снимают биты машин, которых у игрока не осталось (settle_owned в транзакции, unmark_owned после коммита,
+# ещё под DB_WRITE_LOCK). Маска, которая менялась, пока строилась, в кэш не кладётся.
+OWNED_CACHE: "OrderedDict[int, int]" = OrderedDict()
+OWNED_CACHE_SIZE = 100_000
+OWNED_WARM_AFTER = 3
+OWNED_MISSES: Dict[int, int] = {}   # user_id -> промахи has_car без маски
+OWNED_BUILDS: Dict[int, List] = {}  # user_id -> [сколько построений идёт, менялась ли коллекция]
+OWNED_STATS = {"hits": 0, "builds": 0, "point": 0}
+
+async def read_owned_mask(db, user_id: int) -> int:
+    mask = 0
+    async with db.execute("SELECT DISTINCT car_id FROM user_cars WHERE user_id = ?", (user_id,)) as cursor:
+        for (car_id,) in await cursor.fetchall():
+            mask |= 1 << car_id
+    return mask
+
+async def owned_mask(user_id: int, db=None) -> int:
+    """Маска машин игрока. db — соединение открытой транзакции, если вызов из неё"""
+    mask = OWNED_CACHE.get(user_id)
+    if mask is not None:
+        OWNED_CACHE.move_to_end(user_id)
+        OWNED_STATS["hits"] += 1
+        return mask
+
+    build = OWNED_BUILDS.setdefault(user_id, [0, False])
+    build[0] += 1
+    try:
+        if db is None:
+            async with uow() as tx:
+                mask = await read_owned_mask(tx, user_id)
+        else:
+            mask = await read_owned_mask(db, user_id)
+    finally:
+        build[0] -= 1
+        if not build[0]:
+            del OWNED_BUILDS[user_id]
+    OWNED_STATS["builds"] += 1
+    if not build[1]:
+        OWNED_CACHE[user_id] = mask
+        if len(OWNED_CACHE) > OWNED_CACHE_SIZE:
+            OWNED_CACHE.popitem(last=False)
+    return mask
+
+async def has_car(user_id: int, car_id: int, db=None) -> bool:
+    mask = OWNED_CACHE.get(user_id)
+    if mask is None:
+        misses = OWNED_MISSES.get(user_id, 0) + 1
+        if misses < OWNED_WARM_AFTER:
+            if len(OWNED_MISSES) >= OWNED_CACHE_SIZE:
+                OWNED_MISSES.clear()
+            OWNED_MISSES[user_id] = misses
+            OWNED_STATS["point"] += 1
+            return await owns_car(db, user_id, car_id) if db is not None else await owns_car_now(user_id, car_id)
+        OWNED_MISSES.pop(user_id, None)
+    return bool(await owned_mask(user_id, db) >> car_id & 1)
+
+async def owns_car(db, user_id: int, car_id: int) -> bool:
+    async with db.execute("SELECT 1 FROM user_cars WHERE user_id = ? AND car_id = ? LIMIT 1", (user_id, car_id)) as cursor:
+        return await cursor.fetchone() is not None
+
+async def owns_car_now(user_id: int, car_id: int) -> bool:
+    async with uow() as tx:
+        return await owns_car(tx, user_id, car_id)
+
+def mark_owned(user_id: int, car_ids):
+    """Игрок получил машины — вызывается после коммита"""
+    build = OWNED_BUILDS.get(user_id)
+    if build:
+        build[1] = True
+    mask = OWNED_CACHE.get(user_id)
+    if mask is not None:
+        for car_id in car_ids:
+            mask |= 1 << car_id
+        OWNED_CACHE[user_id] = mask
+
+async def settle_owned(db, user_id: int, car_ids) -> Optional[List[int]]:
+    """
+    В транзакции, после того как машины car_ids ушли из гаража: каких из них у игрока не осталось.
+    None — маски нет в кэше, обновлять нечего (и запросы не нужны).
+    """
+    if user_id not in OWNED_CACHE:
+        return None
+    return [car_id for car_id in set(car_ids) if not await owns_car(db, user_id, car_id)]
+
+def unmark_owned(user_id: int, gone: Optional[List[int]]):
+    """После коммита: снимает биты из settle_owned. Маска, появившаяся без settle_owned, сбрасывается"""
+    build = OWNED_BUILDS.get(user_id)
+    if build:
+        build[1] = True
+    mask = OWNED_CACHE.get(user_id)
+    if mask is None:
+        return
+    if gone is None:
+        del OWNED_CACHE[user_id]
+        return
+    for car_id in gone:
+        mask &= ~(1 << car_id)
+    OWNED_CACHE[user_id] = mask
+
+def forget_owned(user_id: int):
+    """Игрок отдал или продал машину — маска перестроится при следующем обращении"""
+    build = OWNED_BUILDS.get(user_id)
+    if build:
+        build[1] = True
+    OWNED_CACHE.pop(user_id, None)
+
+def collection_progress(mask: int) -> tuple:
+    """(собрано моделей из текущего каталога, всего моделей)"""
+    snapshot = catalog()
+    return (mask & snapshot.id_mask).bit_count(), len(snapshot.all_cars)
 
 def format_price(price: int, currency: str) -> str:
     """Форматирует цену в выбранной валюте"""
@@ -679,23 +759,140 @@ def format_price(price: int, currency: str) -> str:
     else:
         return f"${format_number(price)}"
 
+# ========== ЖУРНАЛ ОПЕРАЦИЙ (LEDGER) ==========
+
+# Типы событий хранятся в БД целыми числами — не меняйте существующие коды!
+LEDGER_KINDS = {
+    "opening": 0,        # стартовый баланс игрока, появившегося до журнала
+    "drop": 1,
+    "luck_case": 2,
+    "new_client": 3,
+    "salon_buy": 4,
+    "tuning_buy": 5,
+    "estate_buy": 6,
+    "estate_income": 7,
+    "promo": 8,
+    "admin_money": 9,
+    "admin_car": 10,
+    "house_sell": 11,
+    "market_buy": 12,
+    "market_sell": 13,
+    "trade_in": 14,
+    "trade_out": 15,
+    "wipe": 16,
+}
+LEDGER_KIND_NAMES = {code: name for name, code in LEDGER_KINDS.items()}
+
+def ledger_row(user_id: int, kind: str, amount: int = 0, car_id: Optional[int] = None) -> tuple:
+    """Строка журнала: (user_id, код события, изменение баланса, машина, unix-время)"""
+    return (user_id, LEDGER_KINDS[kind], amount, car_id, int(time.time()))
+
+async def write_ledger(db: aiosqlite.Connection, rows: List[tuple]):
+    """Пакетная запись в журнал — в той же транзакции, что и само изменение"""
+    await db.executemany(
+        "INSERT INTO ledger (user_id, kind, amount, car_id, ts) VALUES (?, ?, ?, ?, ?)", rows
+    )
+
+async def verify_ledger(user_id: Optional[int] = None) -> List[tuple]:
+    """
+    Пересобирает балансы из журнала и сравнивает с users.balance.
+    Возвращает расхождения: (user_id, баланс в users, баланс по журналу).
+    """
+    where = "WHERE users.user_id = ?" if user_id is not None else ""
+    params = (user_id,) if user_id is not None else ()
+    async with connect_db() as db:
+        async with db.execute(f"""
+            SELECT users.user_id, users.balance,
+                   (SELECT COALESCE(SUM(amount), 0) FROM ledger WHERE ledger.user_id = users.user_id) AS replayed
+            FROM users {where}
+        """, params) as cursor:
+            return [row for row in await cursor.fetchall() if row[1] != row[2]]
+
+# ========== КЭШ ОТРИСОВКИ (пропуск одинаковых edit_text) ==========
+
+# (chat_id, message_id) -> отпечаток последнего отрисованного текста и клавиатуры
+RENDER_CACHE: "OrderedDict[tuple, int]" = OrderedDict()
+RENDER_CACHE_SIZE = 10_000
+RENDER_STATS = {"sent": 0, "skipped": 0, "not_modified": 0}
+
+def render_fingerprint(text: str, reply_markup: Optional[InlineKeyboardMarkup]) -> int:
+    """Отпечаток сообщения: хеш текста и разметки клавиатуры"""
+    markup = reply_markup.model_dump_json(exclude_none=True) if reply_markup else ""
+    return hash((text, markup))
+
+def forget_render(chat_id: int, message_id: int):
+    """Сбрасывает отпечаток (например, если сообщение изменено в обход edit_message)"""
+    RENDER_CACHE.pop((chat_id, message_id), None)
+
+def remember_render(key: tuple, fingerprint: int):
+    RENDER_CACHE[key] = fingerprint
+    RENDER_CACHE.move_to_end(key)
+    if len(RENDER_CACHE) > RENDER_CACHE_SIZE:
+        RENDER_CACHE.popitem(last=False)
+
+def render_skipped(key: tuple, fingerprint: int) -> bool:
+    if RENDER_CACHE.get(key) != fingerprint:
+        return False
+    RENDER_CACHE.move_to_end(key)
+    RENDER_STATS["skipped"] += 1
+    return True
+
+async def replace_message(message: Message, sent: Message):
+    """Новое сообщение вместо старого: старое удаляем, его отпечаток забываем"""
+    forget_render(message.chat.id, message.message_id)
+    try:
+        await message.delete()
+    except TelegramBadRequest:
+        pass  # сообщение старше 48 часов или уже удалено
+
+async def edit_message(message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+    """edit_text, который не ходит в Bot API, если текст и клавиатура не изменились"""
+    key = (message.chat.id, message.message_id)
+    fingerprint = render_fingerprint(text, reply_markup)
+    if render_skipped(key, fingerprint):
+        return
+
+    if message.photo:
+        if len(text) <= CAPTION_LIMIT and media_enabled():
+            # Остаёмся фото-сообщением: заглушка и текст в подписи — один edit_media вместо отправки и удаления
+            await edit_media_message(message, MEDIA_PLACEHOLDER, text, reply_markup)
+            return
+        # edit_text у фото не работает — присылаем текст заново
+        sent = await message.answer(text, reply_markup=reply_markup)
+        await replace_message(message, sent)
+        RENDER_STATS["sent"] += 1
+        remember_render((sent.chat.id, sent.message_id), fingerprint)
+        return
+
+    try:
+        await message.edit_text(text, reply_markup=reply_markup)
+        RENDER_STATS["sent"] += 1
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+        RENDER_STATS["not_modified"] += 1
+    remember_render(key, fingerprint)
+
 # ========== ГЛАВНОЕ МЕНЮ ==========
 
-async def main_menu(message: Message):
+async def main_menu(message: Message, text: str = "🚘 Добро пожаловать в Car's by RuDesign!"):
     keyboard = InlineKeyboardBuilder()
     keyboard.button(text="🚗 Автосалон", callback_data="menu_salon")
     keyboard.button(text="💰 Мои средства", callback_data="menu_balance")
     keyboard.button(text="🚘 Мои машины", callback_data="menu_my_cars_0")
     keyboard.button(text="🎁 Выбить машину", callback_data="drop_car")
+    keyboard.button(text="🎁 Выбить x5", callback_data="drop_bulk_5")
+    keyboard.button(text="🎁 Выбить x10", callback_data="drop_bulk_10")
     keyboard.button(text="✨ Акция удачи", callback_data="menu_luck_case")
     keyboard.button(text="🔧 Тюнинг ателье", callback_data="menu_tuning")
     keyboard.button(text="🏠 Недвижимость", callback_data="menu_realestate")
+    keyboard.button(text="🔄 Обмены", callback_data="offers_in_0")
     keyboard.button(text="🏆 Лидеры", callback_data="menu_leaders")
     keyboard.button(text="🌍 Все машины", callback_data="menu_all_cars_0")
     keyboard.button(text="⚙️ Ещё авто", callback_data="menu_extra")
     keyboard.button(text="🧰 Консоль", callback_data="menu_console")
     keyboard.adjust(2)
-    await message.answer("🚘 Добро пожаловать в Car's by RuDesign!", reply_markup=keyboard.as_markup())
+    await message.answer(text, reply_markup=keyboard.as_markup())
 
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
@@ -708,23 +905,17 @@ async def cmd_start(message: Message):
 async def menu_balance(callback: CallbackQuery):
     user_id = callback.from_user.id
     await ensure_user(callback.from_user)
-    balance = await get_balance_with_income(user_id)
-    
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT currency, real_estate_income FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            currency = row[0]
-            real_estate_income = row[1] or 0
+    view = await project_balance(user_id)
 
-    text = f"💰 Ваш баланс: {format_price(balance, currency)}\n"
-    if real_estate_income > 0:
-        text += f"📈 Заработано на недвижимости: {format_price(real_estate_income, currency)}\n"
+    text = f"💰 Ваш баланс: {format_price(view.balance, view.currency)}\n"
+    if view.estate_income > 0:
+        text += f"📈 Заработано на недвижимости: {format_price(view.estate_income, view.currency)}\n"
     text += "\nВыберите действие:"
 
     keyboard = InlineKeyboardBuilder()
     keyboard.button(text="💱 Отображение валюты", callback_data="menu_currency")
     keyboard.button(text="⬅️ Назад", callback_data="back_to_main")
-    await callback.message.edit_text(text, reply_markup=keyboard.as_markup())
+    await edit_message(callback.message, text, reply_markup=keyboard.as_markup())
     await callback.answer()
 
 @dp.callback_query(F.data == "menu_currency")
@@ -735,15 +926,14 @@ async def menu_currency(callback: CallbackQuery):
     keyboard.button(text="€ EUR", callback_data="set_currency_EUR")
     keyboard.button(text="⬅️ Назад", callback_data="menu_balance")
     keyboard.adjust(3)
-    await callback.message.edit_text("Выберите валюту для отображения:", reply_markup=keyboard.as_markup())
+    await edit_message(callback.message, "Выберите валюту для отображения:", reply_markup=keyboard.as_markup())
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("set_currency_"))
 async def set_currency(callback: CallbackQuery):
     currency = callback.data.split("_")[2]
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET currency = ? WHERE user_id = ?", (currency, callback.from_user.id))
-        await db.commit()
+    async with uow(write=True) as tx:
+        await tx.execute("UPDATE users SET currency = ? WHERE user_id = ?", (currency, callback.from_user.id))
     await callback.answer(f"Валюта установлена: {currency}")
     await menu_balance(callback)
 
@@ -758,14 +948,14 @@ async def menu_salon(callback: CallbackQuery):
         keyboard.button(text=group, callback_data=f"salon_group_{i}")
     keyboard.button(text="⬅️ Назад", callback_data="back_to_main")
     keyboard.adjust(1)
-    await callback.message.edit_text("Выберите категорию:", reply_markup=keyboard.as_markup())
+    await edit_message(callback.message, "Выберите категорию:", reply_markup=keyboard.as_markup())
     await callback.answer()
 
 def get_salon_cars(group_index: int) -> list:
     if group_index == 0:  # Гиперкары
-        return SALON_CARS[:15]
+        return catalog().salon_cars[:15]
     else:  # Обычное
-        return SALON_CARS[15:30]
+        return catalog().salon_cars[15:30]
 
 @dp.callback_query(F.data.startswith("salon_group_"))
 async def salon_group(callback: CallbackQuery):
@@ -777,29 +967,34 @@ async def salon_group(callback: CallbackQuery):
     await show_car_page(callback, cars, 0, f"salon_{group_index}", "салон")
 
 async def show_car_page(callback: CallbackQuery, cars: list, page: int, prefix: str, source_type: str):
+    if not cars:
+        await callback.answer("В этой группе больше нет машин", show_alert=True)
+        return
+    # Кнопка могла остаться от старого каталога, где машин в группе было больше
+    page = min(max(page, 0), len(cars) - 1)
     car = cars[page]
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with connect_db() as db:
         async with db.execute("SELECT currency FROM users WHERE user_id = ?", (callback.from_user.id,)) as cursor:
             row = await cursor.fetchone()
             currency = row[0] if row else "USD"
 
     text = (
-        f"🚘 {car['name']}\n"
-        f"📅 Год: {car['year']}\n"
-        f"💰 Цена: {format_price(car['price_usd'], currency)}\n"
-        f"🔢 Лимит: {car['max_global']} шт. в мире"
+        f"🚘 {car.name}\n"
+        f"📅 Год: {car.year}\n"
+        f"💰 Цена: {format_price(car.price_usd, currency)}\n"
+        f"🔢 Лимит: {car.max_global} шт. в мире"
     )
 
     keyboard = InlineKeyboardBuilder()
     if page > 0:
         keyboard.button(text="⬅️ Назад", callback_data=f"{prefix}_{page-1}")
-    keyboard.button(text="🛒 Купить", callback_data=f"buy_{source_type}_{car['id']}")
+    keyboard.button(text="🛒 Купить", callback_data=f"buy_{source_type}_{car.id}")
     if page < len(cars) - 1:
         keyboard.button(text="Дальше ➡️", callback_data=f"{prefix}_{page+1}")
     keyboard.button(text="↩️ Меню", callback_data="menu_salon")
     keyboard.adjust(2 if (page > 0 and page < len(cars)-1) else 1, 1, 1)
 
-    await callback.message.edit_text(text, reply_markup=keyboard.as_markup())
+    await edit_media_message(callback.message, car.image, text, reply_markup=keyboard.as_markup())
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("salon_0_") | F.data.startswith("salon_1_"))
@@ -815,50 +1010,18 @@ async def salon_page(callback: CallbackQuery):
 @dp.callback_query(F.data.startswith("buy_salon_"))
 async def buy_salon_car(callback: CallbackQuery):
     car_id = int(callback.data.split("_")[2])
-    car = next((c for c in SALON_CARS if c["id"] == car_id), None)
+    car = next((c for c in catalog().salon_cars if c.id == car_id), None)
     if not car:
         await callback.answer("Машина не найдена", show_alert=True)
         return
 
-    user_id = callback.from_user.id
-    balance = await get_balance_with_income(user_id)
-    
-    if balance < car["price_usd"]:
+    status = await purchase_car(callback.from_user.id, car, "salon_buy", "Куплена")
+    if status == "no_money":
         await callback.answer("❌ Недостаточно средств!", show_alert=True)
         return
-
-    # Проверим глобальный лимит
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT issued_count FROM global_car_counts WHERE car_id = ?", (car_id,)) as cursor:
-            row = await cursor.fetchone()
-            issued = row[0] if row else 0
-
-        if issued >= car["max_global"]:
-            await callback.answer("❌ Машина больше не доступна — лимит исчерпан!", show_alert=True)
-            return
-
-        # Списываем деньги
-        new_balance = balance - car["price_usd"]
-        await db.execute("UPDATE users SET balance = ? WHERE user_id = ?", (new_balance, user_id))
-
-        # Проверим, есть ли уже у игрока эта машина
-        async with db.execute("SELECT 1 FROM user_cars WHERE user_id = ? AND car_id = ?", (user_id, car_id)) as cursor:
-            is_duplicate = await cursor.fetchone() is not None
-
-        # Добавим в коллекцию
-        await db.execute("""
-            INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, car_id, is_duplicate, "Куплена", now_iso()))
-
-        # Обновим глобальный счётчик
-        await db.execute("""
-            INSERT INTO global_car_counts (car_id, issued_count)
-            VALUES (?, 1)
-            ON CONFLICT(car_id) DO UPDATE SET issued_count = issued_count + 1
-        """)
-
-        await db.commit()
+    if status == "sold_out":
+        await callback.answer("❌ Машина больше не доступна — лимит исчерпан!", show_alert=True)
+        return
 
     await callback.answer("✅ Покупка совершена! Машина добавлена в коллекцию.", show_alert=True)
     await main_menu(callback.message)
@@ -878,44 +1041,50 @@ async def back_to_main(callback: CallbackQuery):
 @dp.callback_query(F.data.startswith("menu_my_cars_"))
 async def menu_my_cars(callback: CallbackQuery):
     page = int(callback.data.split("_")[3])
+    if await show_my_cars_page(callback, page):
+        await callback.answer()
+
+async def show_my_cars_page(callback: CallbackQuery, page: int, focus_car_id: Optional[int] = None) -> bool:
+    """Страница гаража; focus_car_id — открыть страницу этой машины. False — машин нет (ответ уже дан)"""
     user_id = callback.from_user.id
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT car_id, is_duplicate, source, color FROM user_cars WHERE user_id = ?
+    async with uow() as tx:
+        async with tx.execute("""
+            SELECT id, car_id, is_duplicate, source, color FROM user_cars WHERE user_id = ?
         """, (user_id,)) as cursor:
             cars = await cursor.fetchall()
+        async with tx.execute("SELECT currency FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            row = await cursor.fetchone()
+            currency = row[0] if row else "USD"
 
     if not cars:
         await callback.answer("У вас пока нет машин!", show_alert=True)
         await main_menu(callback.message)
-        return
+        return False
 
     cars_per_page = 1
     total_pages = len(cars)
+    if focus_car_id is not None:
+        page = next((i for i, row in enumerate(cars) if row[1] == focus_car_id), 0)
     if page >= total_pages:
         page = 0
 
-    car_id, is_duplicate, source, color = cars[page]
+    user_car_id, car_id, is_duplicate, source, color = cars[page]
 
     # Найдём данные машины
-    car = next((c for c in ALL_CARS if c["id"] == car_id), None)
+    car = catalog().cars_by_id.get(car_id)
     if not car:
-        car = {"name": "Неизвестная машина", "year": "???", "price_usd": 0}
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT currency FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            currency = row[0] if row else "USD"
+        car = UNKNOWN_CAR
 
     duplicate_text = " (Дубликат)" if is_duplicate else ""
     source_text = source or "Неизвестно"
     color_text = f"\n🎨 Цвет: {color}" if color and color != "Стандартный" else ""
 
     text = (
-        f"🚘 {car['name']}{duplicate_text}\n"
-        f"📅 Год: {car['year']}\n"
-        f"💰 Цена: {format_price(car['price_usd'], currency)}\n"
+        f"🚘 {car.name}{duplicate_text}\n"
+        f"📅 Год: {car.year}\n"
+        f"💰 Цена: {format_price(car.price_usd, currency)}\n"
+        f"📈 Рыночная стоимость: {format_price(market_value(car_id), currency)}\n"
         f"📌 Источник: {source_text}"
         f"{color_text}"
     )
@@ -925,7 +1094,7 @@ async def menu_my_cars(callback: CallbackQuery):
         keyboard.button(text="⬅️ Назад", callback_data=f"menu_my_cars_{page-1}")
     
     # Кнопка "Обменять" всегда доступна
-    keyboard.button(text="🔄 Обменять", callback_data=f"exchange_start_{car_id}")
+    keyboard.button(text="🔄 Обменять", callback_data=f"exchange_start_{user_car_id}")
     
     # Кнопка "Выбрать цвет" — только для салона и тюнинга
     if source in ("Куплена", "Тюнинг"):
@@ -937,8 +1106,8 @@ async def menu_my_cars(callback: CallbackQuery):
     keyboard.button(text="↩️ Меню", callback_data="back_to_main")
     keyboard.adjust(2 if (page > 0 and page < total_pages - 1) else 1, 1, 1)
 
-    await callback.message.edit_text(text, reply_markup=keyboard.as_markup())
-    await callback.answer()
+    await edit_media_message(callback.message, car.image, text, reply_markup=keyboard.as_markup(), color=color)
+    return True
 
 # ========== ПОКРАСКА ==========
 
@@ -950,7 +1119,7 @@ async def paint_menu(callback: CallbackQuery):
         keyboard.button(text=color, callback_data=f"set_color_{car_id}_{color}")
     keyboard.button(text="↩️ Назад", callback_data=f"menu_my_cars_0")
     keyboard.adjust(2)
-    await callback.message.edit_text("Выберите цвет:", reply_markup=keyboard.as_markup())
+    await edit_message(callback.message, "Выберите цвет:", reply_markup=keyboard.as_markup())
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("set_color_"))
@@ -958,114 +1127,119 @@ async def set_color(callback: CallbackQuery):
     parts = callback.data.split("_")
     car_id = int(parts[2])
     color = "_".join(parts[3:])  # на случай цветов с пробелами
+    if color not in PAINT_RGB:
+        await callback.answer("❌ Такого цвета нет.", show_alert=True)
+        return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            UPDATE user_cars SET color = ? WHERE user_id = ? AND car_id = ?
+    async with uow(write=True) as tx:
+        async with tx.execute(
+            "SELECT id FROM user_cars WHERE user_id = ? AND car_id = ?", (callback.from_user.id, car_id)
+        ) as cursor:
+            repainted = [row[0] for row in await cursor.fetchall()]
+        await tx.execute("""
+            UPDATE user_cars SET color = ?, version = version + 1 WHERE user_id = ? AND car_id = ?
         """, (color, callback.from_user.id, car_id))
-        await db.commit()
+        await invalidate_offers_for_rows(tx, repainted)
 
-    await callback.answer(f"✅ Цвет изменён на: {color}")
-    await menu_my_cars(callback)
+    # Сразу показываем перекрашенную машину (с готовым вариантом картинки, если он есть)
+    if await show_my_cars_page(callback, 0, focus_car_id=car_id):
+        await callback.answer(f"✅ Цвет изменён на: {color}")
 
 # ========== АКЦИЯ УДАЧИ (С ПОДКАТЕГОРИЯМИ) ==========
 
 LUCK_CATEGORIES = ["Гиперкары", "Трековые авто", "Концепты", "Обычные машины", "Гоночные машины", "Необычные", "Ретро Иконы"]
 
 def get_luck_cars_by_category(category: str) -> list:
-    return [car for car in LUCK_CASE_CARS if car.get("category") == category]
+    return [car for car in catalog().luck_cars if car.category == category]
 
 @dp.callback_query(F.data == "menu_luck_case")
 async def menu_luck_case(callback: CallbackQuery):
     # Проверим таймер (1 раз в 24 часа)
-    user_id = callback.from_user.id
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT last_luck_case FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            last_used = row[0] if row and row[0] else None
-
-    if last_used:
-        last_used_dt = datetime.fromisoformat(last_used)
-        if datetime.utcnow() - last_used_dt < timedelta(hours=24):
-            await callback.answer("⏳ Акция удачи доступна раз в 24 часа!", show_alert=True)
-            return
+    if cooldown_remaining("luck_case", callback.from_user.id):
+        await callback.answer(cooldown_text("luck_case", callback.from_user.id), show_alert=True)
+        return
 
     keyboard = InlineKeyboardBuilder()
     for cat in LUCK_CATEGORIES:
         keyboard.button(text=cat, callback_data=f"luck_cat_{cat}")
     keyboard.button(text="↩️ Меню", callback_data="back_to_main")
     keyboard.adjust(2)
-    await callback.message.edit_text("Выберите категорию для Акции удачи:", reply_markup=keyboard.as_markup())
+    await edit_message(callback.message, "Выберите категорию для Акции удачи:", reply_markup=keyboard.as_markup())
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("luck_cat_"))
 async def luck_category_select(callback: CallbackQuery):
     category = callback.data.replace("luck_cat_", "")
+    if cooldown_remaining("luck_case", callback.from_user.id):
+        await callback.answer(cooldown_text("luck_case", callback.from_user.id), show_alert=True)
+        return
     cars = get_luck_cars_by_category(category)
     if not cars:
         await callback.answer("В этой категории нет машин!", show_alert=True)
         return
 
     # Выберем случайную машину
-    import random
-    car = random.choice(cars)
-
-    # Проверим глобальный лимит
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT issued_count FROM global_car_counts WHERE car_id = ?", (car["id"],)) as cursor:
-            row = await cursor.fetchone()
-            issued = row[0] if row else 0
-
-        if issued >= car["max_global"]:
-            await callback.answer("❌ Эта машина больше не доступна — лимит исчерпан!", show_alert=True)
-            return
+    car, audit = RNG.choice("luck_case", cars)
 
-        # Проверим, есть ли уже у игрока
-        user_id = callback.from_user.id
-        async with db.execute("SELECT 1 FROM user_cars WHERE user_id = ? AND car_id = ?", (user_id, car["id"])) as cursor:
-            is_duplicate = await cursor.fetchone() is not None
-
-        if is_duplicate:
-            await callback.answer("❌ У вас уже есть эта машина! В Акции удачи дубликаты запрещены.", show_alert=True)
-            return
-
-        # Добавим машину и доход
-        balance = await get_balance_with_income(user_id)
-        new_balance = balance + car["price_usd"]
-        await db.execute("UPDATE users SET balance = ?, last_luck_case = ? WHERE user_id = ?", (new_balance, now_iso(), user_id))
-        await db.execute("""
-            INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at)
-            VALUES (?, ?, 0, ?, ?)
-        """, (user_id, car["id"], "Акция удачи", now_iso()))
-        await db.execute("""
-            INSERT INTO global_car_counts (car_id, issued_count)
-            VALUES (?, 1)
-            ON CONFLICT(car_id) DO UPDATE SET issued_count = issued_count + 1
-        """)
-        await db.commit()
+    # Лимит, дубликат, таймер и выдача — одной транзакцией
+    user_id = callback.from_user.id
+    started_at = int(time.time())
+    async with uow(write=True) as tx:
+        if await has_car(user_id, car.id):
+            status = "duplicate"
+        elif not await take_from_limit(tx, car):
+            status = "sold_out"
+        else:
+            # Добавим доход и запустим таймер — условным UPDATE, чтобы повторное нажатие не прошло
+            cursor = await tx.execute("""
+                UPDATE users SET balance = balance + ?, last_luck_case_at = ?
+                WHERE user_id = ? AND (last_luck_case_at IS NULL OR last_luck_case_at <= ?)
+            """, (car.price_usd, started_at, user_id, started_at - COOLDOWN_PERIODS["luck_case"]))
+            if cursor.rowcount == 0:
+                await tx.rollback()
+                status = "cooldown"
+            else:
+                status = "ok"
+                await tx.execute("""
+                    INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at)
+                    VALUES (?, ?, 0, ?, ?)
+                """, (user_id, car.id, "Акция удачи", now_iso()))
+                await write_ledger(tx, [ledger_row(user_id, "luck_case", car.price_usd, car.id)])
+                await write_draws(tx, [draw_row(audit, user_id, car.id)])
+                tx.on_commit(lambda: mark_owned(user_id, [car.id]))
+
+    if status == "sold_out":
+        await callback.answer("❌ Эта машина больше не доступна — лимит исчерпан!", show_alert=True)
+        return
+    if status == "duplicate":
+        await callback.answer("❌ У вас уже есть эта машина! В Акции удачи дубликаты запрещены.", show_alert=True)
+        return
+    if status == "cooldown":
+        await callback.answer("⏳ Акция удачи доступна раз в 24 часа!", show_alert=True)
+        return
+    note_issued(car.id)
+    start_cooldown("luck_case", user_id, started_at)
 
-    await callback.answer(f"🎉 Поздравляем! Вы получили: {car['name']} за ${format_number(car['price_usd'])}!", show_alert=True)
+    await callback.answer(f"🎉 Поздравляем! Вы получили: {car.name} за ${format_number(car.price_usd)}!", show_alert=True)
     await main_menu(callback.message)
 
 # ========== ТЮНИНГ АТЕЛЬЕ ==========
 
-TUNING_ATELIERS = list(TUNING_BRANDS.keys())
-
 @dp.callback_query(F.data == "menu_tuning")
 async def menu_tuning(callback: CallbackQuery):
     keyboard = InlineKeyboardBuilder()
-    for atelier in TUNING_ATELIERS:
+    for atelier in catalog().tuning_brands:
         keyboard.button(text=atelier, callback_data=f"tuning_atelier_{atelier}")
     keyboard.button(text="🎁 Новый клиент", callback_data="new_client_case")
     keyboard.button(text="↩️ Меню", callback_data="back_to_main")
     keyboard.adjust(2)
-    await callback.message.edit_text("Выберите ателье:", reply_markup=keyboard.as_markup())
+    await edit_message(callback.message, "Выберите ателье:", reply_markup=keyboard.as_markup())
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("tuning_atelier_"))
 async def tuning_atelier(callback: CallbackQuery):
     atelier = callback.data.replace("tuning_atelier_", "")
-    cars = TUNING_BRANDS.get(atelier, [])
+    cars = catalog().tuning_brands.get(atelier, [])
     if not cars:
         await callback.answer("Ателье временно пусто", show_alert=True)
         return
@@ -1075,32 +1249,35 @@ async def tuning_atelier(callback: CallbackQuery):
     await show_tuning_car(callback, atelier, 0)
 
 async def show_tuning_car(callback: CallbackQuery, atelier: str, page: int):
-    cars = TUNING_BRANDS[atelier]
-    car = cars[page]
+    cars = catalog().tuning_brands.get(atelier)
+    if not cars:
+        await callback.answer("Ателье больше нет в каталоге", show_alert=True)
+        return
+    car = cars[min(page, len(cars) - 1)]
     user_id = callback.from_user.id
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with connect_db() as db:
         async with db.execute("SELECT currency FROM users WHERE user_id = ?", (user_id,)) as cursor:
             row = await cursor.fetchone()
             currency = row[0] if row else "USD"
 
     text = (
-        f"🔧 {car['name']} от {atelier}\n"
-        f"📅 Год: {car['year']}\n"
-        f"💰 Цена: {format_price(car['price_usd'], currency)}\n"
-        f"🔢 Лимит: {car['max_global']} шт."
+        f"🔧 {car.name} от {atelier}\n"
+        f"📅 Год: {car.year}\n"
+        f"💰 Цена: {format_price(car.price_usd, currency)}\n"
+        f"🔢 Лимит: {car.max_global} шт."
     )
 
     keyboard = InlineKeyboardBuilder()
     if page > 0:
         keyboard.button(text="⬅️ Назад", callback_data=f"tuning_page_{atelier}_{page-1}")
-    keyboard.button(text="🛒 Купить", callback_data=f"buy_tuning_{car['id']}")
+    keyboard.button(text="🛒 Купить", callback_data=f"buy_tuning_{car.id}")
     if page < len(cars) - 1:
         keyboard.button(text="Дальше ➡️", callback_data=f"tuning_page_{atelier}_{page+1}")
     keyboard.button(text="↩️ Назад", callback_data="menu_tuning")
     keyboard.adjust(2 if (page > 0 and page < len(cars)-1) else 1, 1, 1)
 
-    await callback.message.edit_text(text, reply_markup=keyboard.as_markup())
+    await edit_media_message(callback.message, car.image, text, reply_markup=keyboard.as_markup())
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("tuning_page_"))
@@ -1115,9 +1292,9 @@ async def buy_tuning_car(callback: CallbackQuery):
     car_id = int(callback.data.split("_")[2])
     # Найдём машину в любом ателье
     car = None
-    for brand_cars in TUNING_BRANDS.values():
+    for brand_cars in catalog().tuning_brands.values():
         for c in brand_cars:
-            if c["id"] == car_id:
+            if c.id == car_id:
                 car = c
                 break
         if car: break
@@ -1126,39 +1303,13 @@ async def buy_tuning_car(callback: CallbackQuery):
         await callback.answer("Машина не найдена", show_alert=True)
         return
 
-    user_id = callback.from_user.id
-    balance = await get_balance_with_income(user_id)
-    
-    if balance < car["price_usd"]:
+    status = await purchase_car(callback.from_user.id, car, "tuning_buy", "Тюнинг")
+    if status == "no_money":
         await callback.answer("❌ Недостаточно средств!", show_alert=True)
         return
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT issued_count FROM global_car_counts WHERE car_id = ?", (car_id,)) as cursor:
-            row = await cursor.fetchone()
-            issued = row[0] if row else 0
-
-        if issued >= car["max_global"]:
-            await callback.answer("❌ Лимит исчерпан!", show_alert=True)
-            return
-
-        new_balance = balance - car["price_usd"]
-        await db.execute("UPDATE users SET balance = ? WHERE user_id = ?", (new_balance, user_id))
-
-        async with db.execute("SELECT 1 FROM user_cars WHERE user_id = ? AND car_id = ?", (user_id, car_id)) as cursor:
-            is_duplicate = await cursor.fetchone() is not None
-
-        await db.execute("""
-            INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, car_id, is_duplicate, "Тюнинг", now_iso()))
-
-        await db.execute("""
-            INSERT INTO global_car_counts (car_id, issued_count)
-            VALUES (?, 1)
-            ON CONFLICT(car_id) DO UPDATE SET issued_count = issued_count + 1
-        """)
-        await db.commit()
+    if status == "sold_out":
+        await callback.answer("❌ Лимит исчерпан!", show_alert=True)
+        return
 
     await callback.answer("✅ Машина куплена!", show_alert=True)
     await main_menu(callback.message)
@@ -1168,76 +1319,73 @@ async def buy_tuning_car(callback: CallbackQuery):
 @dp.callback_query(F.data == "new_client_case")
 async def new_client_case(callback: CallbackQuery):
     user_id = callback.from_user.id
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT used_new_client_case FROM users WHERE user_id = ?", (user_id,)) as cursor:
+    async with uow(write=True) as tx:
+        async with tx.execute("SELECT used_new_client_case FROM users WHERE user_id = ?", (user_id,)) as cursor:
             row = await cursor.fetchone()
-            used = row[0] if row else 0
-
-    if used:
+        if row and row[0]:
+            status = "used"
+        else:
+            # Выберем случайную машину из пула выпадения
+            car, audit = RNG.choice("new_client", catalog().drop_cars)
+            status = "ok" if await take_from_limit(tx, car) else "sold_out"
+        if status == "ok":
+            # Условный UPDATE: второе нажатие не выдаст кейс повторно
+            cursor = await tx.execute("""
+                UPDATE users SET balance = balance + ?, used_new_client_case = 1
+                WHERE user_id = ? AND used_new_client_case = 0
+            """, (car.price_usd, user_id))
+            if cursor.rowcount == 0:
+                await tx.rollback()
+                status = "used"
+            else:
+                await tx.execute("""
+                    INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (user_id, car.id, await has_car(user_id, car.id), "Новый клиент", now_iso()))
+                await write_ledger(tx, [ledger_row(user_id, "new_client", car.price_usd, car.id)])
+                await write_draws(tx, [draw_row(audit, user_id, car.id)])
+                tx.on_commit(lambda: mark_owned(user_id, [car.id]))
+
+    if status == "used":
         await callback.answer("Вы уже использовали кейс «Новый клиент»! Он доступен только один раз.", show_alert=True)
         return
+    if status == "sold_out":
+        await callback.answer("❌ Эта машина недоступна!", show_alert=True)
+        return
+    note_issued(car.id)
 
-    # Выберем случайную машину из NEW_CLIENT_CASE
-    import random
-    car = random.choice(NEW_CLIENT_CASE)
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Проверим лимит
-        async with db.execute("SELECT issued_count FROM global_car_counts WHERE car_id = ?", (car["id"],)) as cursor:
-            row = await cursor.fetchone()
-            issued = row[0] if row else 0
-
-        if issued >= car["max_global"]:
-            await callback.answer("❌ Эта машина недоступна!", show_alert=True)
-            return
-
-        # Добавим
-        balance = await get_balance_with_income(user_id)
-        new_balance = balance + car["price_usd"]
-        await db.execute("""
-            UPDATE users SET balance = ?, used_new_client_case = 1 WHERE user_id = ?
-        """, (new_balance, user_id))
-        await db.execute("""
-            INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at)
-            VALUES (?, ?, 0, ?, ?)
-        """, (user_id, car["id"], "Новый клиент", now_iso()))
-        await db.execute("""
-            INSERT INTO global_car_counts (car_id, issued_count)
-            VALUES (?, 1)
-            ON CONFLICT(car_id) DO UPDATE SET issued_count = issued_count + 1
-        """)
-        await db.commit()
-
-    await callback.answer(f"🎁 Добро пожаловать! Вы получили: {car['name']}!", show_alert=True)
+    await callback.answer(f"🎁 Добро пожаловать! Вы получили: {car.name}!", show_alert=True)
     await main_menu(callback.message)
 
 # ========== ЛИДЕРБОРД ==========
 
 @dp.callback_query(F.data == "menu_leaders")
 async def menu_leaders(callback: CallbackQuery):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with connect_db() as db:
         async with db.execute("""
             SELECT user_id, username, display_name, balance 
             FROM users 
+            WHERE user_id NOT IN (SELECT user_id FROM bans WHERE until IS NULL OR until > ?)
             ORDER BY balance DESC 
             LIMIT 10
-        """) as cursor:
+        """, (int(time.time()),)) as cursor:
             leaders = await cursor.fetchall()
 
+    garages = await garage_values([row[0] for row in leaders])
     text = "🏆 Топ-10 самых богатых игроков:\n\n"
     for i, (user_id, username, name, balance) in enumerate(leaders, 1):
         display = f"@{username}" if username else name
-        text += f"{i}. {display} — ${format_number(balance)}\n"
+        text += f"{i}. {display} — ${format_number(balance)} (🚘 гараж: ${format_number(garages[user_id])})\n"
 
     keyboard = InlineKeyboardBuilder()
     keyboard.button(text="👥 Все игроки", callback_data="all_players")
     keyboard.button(text="↩️ Меню", callback_data="back_to_main")
-    await callback.message.edit_text(text, reply_markup=keyboard.as_markup())
+    await edit_message(callback.message, text, reply_markup=keyboard.as_markup())
     await callback.answer()
 
 @dp.callback_query(F.data == "all_players")
 async def all_players(callback: CallbackQuery):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with connect_db() as db:
         async with db.execute("""
             SELECT user_id, username, display_name, balance 
             FROM users 
@@ -1255,7 +1403,7 @@ async def all_players(callback: CallbackQuery):
 
     keyboard = InlineKeyboardBuilder()
     keyboard.button(text="↩️ Назад", callback_data="menu_leaders")
-    await callback.message.edit_text(text, reply_markup=keyboard.as_markup())
+    await edit_message(callback.message, text, reply_markup=keyboard.as_markup())
     await callback.answer()
 
 # ========== КОНСОЛЬ (ТОЛЬКО ДЛЯ @sky_for_pagani2) ==========
@@ -1269,11 +1417,12 @@ async def menu_console(callback: CallbackQuery):
     keyboard = InlineKeyboardBuilder()
     keyboard.button(text="💰 Выдать деньги", callback_data="admin_give_money")
     keyboard.button(text="🚘 Выдать машину", callback_data="admin_give_car")
+    keyboard.button(text="🎟 Выдать попытки", callback_data="admin_give_drops")
     keyboard.button(text="⛔ Заблокировать", callback_data="admin_ban")
     keyboard.button(text="🗑 Аннулировать", callback_data="admin_wipe")
     keyboard.button(text="↩️ Меню", callback_data="back_to_main")
     keyboard.adjust(2)
-    await callback.message.edit_text("🛠 Консоль администратора:", reply_markup=keyboard.as_markup())
+    await edit_message(callback.message, "🛠 Консоль администратора:", reply_markup=keyboard.as_markup())
     await callback.answer()
 
 # Остальные админ-функции будут в БЛОКЕ 7
@@ -1283,253 +1432,573 @@ async def menu_console(callback: CallbackQuery):
 @dp.callback_query(F.data.startswith("menu_all_cars_"))
 async def menu_all_cars(callback: CallbackQuery):
     page = int(callback.data.split("_")[3])
-    total = len(ALL_CARS)
+    total = len(catalog().all_cars)
     if page >= total:
         page = 0
 
-    car = ALL_CARS[page]
+    car = catalog().all_cars[page]
     user_id = callback.from_user.id
 
-    # Проверим, есть ли у игрока
-    has_car = False
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT 1 FROM user_cars WHERE user_id = ? AND car_id = ?", (user_id, car["id"])) as cursor:
-            has_car = await cursor.fetchone() is not None
-
-    status = "есть в твоей коллекции" if has_car else "отсутствует в коллекции"
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT currency FROM users WHERE user_id = ?", (user_id,)) as cursor:
+    async with uow() as tx:
+        mask = await owned_mask(user_id)
+        async with tx.execute("SELECT currency FROM users WHERE user_id = ?", (user_id,)) as cursor:
             row = await cursor.fetchone()
             currency = row[0] if row else "USD"
 
+    owned = bool(mask >> car.id & 1)
+    status = "есть в твоей коллекции" if owned else "отсутствует в коллекции"
+    collected, models = collection_progress(mask)
+
     text = (
-        f"🚘 {car['name']}\n"
-        f"📅 Год: {car['year']}\n"
-        f"💰 Цена: {format_price(car['price_usd'], currency)}\n"
-        f"📦 Статус: {status}"
+        f"🚘 {car.name}\n"
+        f"📅 Год: {car.year}\n"
+        f"💰 Цена: {format_price(car.price_usd, currency)}\n"
+        f"📦 Статус: {status}\n"
+        f"📚 Коллекция: {collected} из {models}"
     )
 
     keyboard = InlineKeyboardBuilder()
     if page > 0:
         keyboard.button(text="⬅️ Назад", callback_data=f"menu_all_cars_{page-1}")
-    if has_car:
-        keyboard.button(text="💰 Продать", callback_data=f"sell_car_{car['id']}")
+    if owned:
+        keyboard.button(text="💰 Продать", callback_data=f"sell_car_{car.id}")
+    keyboard.button(text="📈 Рынок", callback_data=f"market_car_{car.id}")
     if page < total - 1:
         keyboard.button(text="Дальше ➡️", callback_data=f"menu_all_cars_{page+1}")
     keyboard.button(text="↩️ Меню", callback_data="back_to_main")
     keyboard.adjust(2 if (page > 0 and page < total - 1) else 1, 1, 1)
 
-    await callback.message.edit_text(text, reply_markup=keyboard.as_markup())
+    await edit_media_message(callback.message, car.image, text, reply_markup=keyboard.as_markup())
     await callback.answer()
 
-# Продажа машин будет реализована позже (если нужно)
+# Продажа машин — в БЛОКЕ 9
 
 # Конец БЛОКА 4
 # main.py — БЛОК 5: Выбить машину и промокоды
 
 # ========== ВЫБИТЬ МАШИНУ (DROP) ==========
 
+BULK_DROP_SIZES = (5, 10)
+
+async def grant_drops(user_id: int, count: int, credits_only: bool = False) -> tuple:
+    """
+    Выбивает count машин из пула выпадения (catalog().drop_cars) одной транзакцией.
+    Оплата: таймер (раз в 30 минут), а если он не готов — бесплатные попытки drop_credits.
+    При credits_only=True (массовое открытие) тратятся только попытки.
+    Возвращает (статус, [(car, is_duplicate), ...]); статусы: "ok", "cooldown", "no_credits", "empty".
+    """
+    async with uow(write=True) as tx:
+        # Остатки на складе: max_global - issued_count
+        async with tx.execute("SELECT car_id, issued_count FROM global_car_counts") as cursor:
+            issued = dict(await cursor.fetchall())
+        snapshot = catalog()
+        limits = snapshot.limits
+        stock = {car_id: limits[car_id] - issued.get(car_id, 0) for car_id in snapshot.drop_ids}
+        available = [car_id for car_id in snapshot.drop_ids if stock[car_id] > 0]
+
+        owned = await owned_mask(user_id, tx)
+
+        granted = []
+        draws = []
+        claimed: Dict[int, int] = {}
+        for _ in range(count):
+            if not available:
+                break
+            car_id, audit = RNG.choice("drop", available)
+            draws.append(draw_row(audit, user_id, car_id))
+            granted.append((snapshot.cars_by_id[car_id], bool(owned >> car_id & 1)))
+            owned |= 1 << car_id
+            claimed[car_id] = claimed.get(car_id, 0) + 1
+            stock[car_id] -= 1
+            if stock[car_id] == 0:
+                available.remove(car_id)
+
+        if not granted:
+            await tx.rollback()
+            return "empty", []
+
+        # Списываем таймер или попытки условным UPDATE — одновременные нажатия не пройдут дважды
+        now = now_iso()
+        started_at = int(time.time())
+        paid = False
+        if not credits_only:
+            cursor = await tx.execute("""
+                UPDATE users SET last_drop_at = ? WHERE user_id = ? AND (last_drop_at IS NULL OR last_drop_at <= ?)
+            """, (started_at, user_id, started_at - COOLDOWN_PERIODS["drop"]))
+            paid = cursor.rowcount == 1
+        if not paid:
+            cursor = await tx.execute("""
+                UPDATE users SET drop_credits = drop_credits - ? WHERE user_id = ? AND drop_credits >= ?
+            """, (len(granted), user_id, len(granted)))
+            if cursor.rowcount == 0:
+                await tx.rollback()
+                return ("no_credits" if credits_only else "cooldown"), []
+
+        await tx.executemany("""
+            INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(user_id, car.id, is_duplicate, "Выпала", now) for car, is_duplicate in granted])
+        await tx.executemany("""
+            INSERT INTO global_car_counts (car_id, issued_count)
+            VALUES (?, ?)
+            ON CONFLICT(car_id) DO UPDATE SET issued_count = issued_count + excluded.issued_count
+        """, list(claimed.items()))
+        await tx.execute(
+            "UPDATE users SET balance = balance + ? WHERE user_id = ?",
+            (sum(car.price_usd for car, _ in granted), user_id)
+        )
+        await write_ledger(tx, [ledger_row(user_id, "drop", car.price_usd, car.id) for car, _ in granted])
+        await write_draws(tx, draws)
+        tx.on_commit(lambda: mark_owned(user_id, claimed))
+
+    if paid and not credits_only:
+        start_cooldown("drop", user_id, started_at)
+    for car_id, count in claimed.items():
+        note_issued(car_id, count)
+    return "ok", granted
+
+async def get_drop_credits(user_id: int) -> int:
+    async with connect_db() as db:
+        async with db.execute("SELECT drop_credits FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else 0
+
 @dp.callback_query(F.data == "drop_car")
 async def drop_car(callback: CallbackQuery):
-    user_id = callback.from_user.id
     await ensure_user(callback.from_user)
+    user_id = callback.from_user.id
 
-    # Проверим таймер: 30 минут
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT last_drop FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            last_drop = row[0] if row and row[0] else None
-
-    if last_drop:
-        last_drop_dt = datetime.fromisoformat(last_drop)
-        if datetime.utcnow() - last_drop_dt < timedelta(minutes=30):
-            await callback.answer("⏳ Вы можете выбить машину раз в 30 минут!", show_alert=True)
-            return
+    # Таймер проверяем по памяти — в БД идём, только если есть шанс выбить
+    if cooldown_remaining("drop", user_id) and not await get_drop_credits(user_id):
+        await callback.answer(cooldown_text("drop", user_id), show_alert=True)
+        return
 
-    # Выберем случайную машину из DROP_CARS
-    import random
-    car = random.choice(DROP_CARS)
+    status, granted = await grant_drops(user_id, 1)
+    if status == "cooldown":
+        await callback.answer(cooldown_text("drop", user_id), show_alert=True)
+        return
+    if status == "empty":
+        await callback.answer("❌ Сейчас нет доступных машин для выпадения!", show_alert=True)
+        return
 
-    # Добавим машину (дубликаты РАЗРЕШЕНЫ в drop)
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Проверим глобальный лимит
-        async with db.execute("SELECT issued_count FROM global_car_counts WHERE car_id = ?", (car["id"],)) as cursor:
-            row = await cursor.fetchone()
-            issued = row[0] if row else 0
-
-        if issued >= car["max_global"]:
-            # Если лимит исчерпан — попробуем другую (до 10 попыток)
-            for _ in range(10):
-                new_car = random.choice(DROP_CARS)
-                async with db.execute("SELECT issued_count FROM global_car_counts WHERE car_id = ?", (new_car["id"],)) as cursor:
-                    row2 = await cursor.fetchone()
-                    issued2 = row2[0] if row2 else 0
-                if issued2 < new_car["max_global"]:
-                    car = new_car
-                    break
-            else:
-                await callback.answer("❌ Сейчас нет доступных машин для выпадения!", show_alert=True)
-                return
+    car, is_duplicate = granted[0]
+    status = " (дубликат)" if is_duplicate else ""
+    await callback.answer(f"🎁 Вы выбили: {car.name}{status} (+${format_number(car.price_usd)})!", show_alert=True)
+    await main_menu(callback.message)
 
-        # Проверим, есть ли уже у игрока (для отметки дубликата)
-        async with db.execute("SELECT 1 FROM user_cars WHERE user_id = ? AND car_id = ?", (user_id, car["id"])) as cursor:
-            is_duplicate = await cursor.fetchone() is not None
+@dp.callback_query(F.data.startswith("drop_bulk_"))
+async def drop_car_bulk(callback: CallbackQuery):
+    size = callback.data[len("drop_bulk_"):]
+    count = next((n for n in BULK_DROP_SIZES if str(n) == size), None)
+    if count is None:
+        await callback.answer("❌ Кнопка устарела, откройте меню заново.", show_alert=True)
+        return
 
-        # Начислим цену к балансу
-        balance = await get_balance_with_income(user_id)
-        new_balance = balance + car["price_usd"]
-        await db.execute("UPDATE users SET balance = ?, last_drop = ? WHERE user_id = ?", (new_balance, now_iso(), user_id))
-        await db.execute("""
-            INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, car["id"], is_duplicate, "Выпала", now_iso()))
-        await db.execute("""
-            INSERT INTO global_car_counts (car_id, issued_count)
-            VALUES (?, 1)
-            ON CONFLICT(car_id) DO UPDATE SET issued_count = issued_count + 1
-        """)
-        await db.commit()
+    await ensure_user(callback.from_user)
+    status, granted = await grant_drops(callback.from_user.id, count, credits_only=True)
+    if status == "no_credits":
+        credits = await get_drop_credits(callback.from_user.id)
+        await callback.answer(f"🔒 Нужно {count} бесплатных попыток, у вас {credits}.", show_alert=True)
+        return
+    if status == "empty":
+        await callback.answer("❌ Сейчас нет доступных машин для выпадения!", show_alert=True)
+        return
 
-    status = " (дубликат)" if is_duplicate else ""
-    await callback.answer(f"🎁 Вы выбили: {car['name']}{status} (+${format_number(car['price_usd'])})!", show_alert=True)
-    await main_menu(callback.message)
+    total = sum(car.price_usd for car, _ in granted)
+    lines = [f"🎁 Вы выбили {len(granted)} машин (+${format_number(total)}):\n"]
+    for car, is_duplicate in granted:
+        duplicate_text = " (дубликат)" if is_duplicate else ""
+        lines.append(f"• {car.name}{duplicate_text} — ${format_number(car.price_usd)}")
+    lines.append(f"\n🎟 Осталось бесплатных попыток: {await get_drop_credits(callback.from_user.id)}")
+    await callback.answer()
+    await main_menu(callback.message, "\n".join(lines))
 
 # ========== ПРОМОКОДЫ ==========
 
+# Коды, которые создаются в БД при первом запуске (новые — командой /addpromo)
+DEFAULT_PROMO_CODES = [
+    # (код, тип награды, значение, лимит активаций, старая колонка-флаг в users)
+    ("test", "money", 1_200_000_000, None, "promo_test_used"),
+    ("test2", "money", 150_000_000, None, "promo_test2_used"),
+    ("BT", "money", 20_000_000, None, "promo_bt_used"),
+    ("BetaTest", "drops", 5, None, "promo_betatest_used"),
+]
+PROMO_REWARD_TYPES = ("money", "drops", "car")
+
+async def seed_promo_codes(db: aiosqlite.Connection):
+    """Заводит стандартные коды и переносит активации из старых колонок promo_*_used"""
+    now = int(time.time())
+    await db.executemany("""
+        INSERT OR IGNORE INTO promo_codes (code, reward_type, reward_value, max_uses, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, [(code, reward_type, value, max_uses, now) for code, reward_type, value, max_uses, _ in DEFAULT_PROMO_CODES])
+    for code, _, _, _, legacy_flag in DEFAULT_PROMO_CODES:
+        await db.execute(f"""
+            INSERT OR IGNORE INTO promo_redemptions (code, user_id, redeemed_at)
+            SELECT ?, user_id, ? FROM users WHERE {legacy_flag} = 1
+        """, (code, now))
+
+async def redeem_promo(user_id: int, code: str) -> tuple:
+    """
+    Активирует промокод. Возвращает (статус, промокод).
+    Статусы: "ok", "unknown", "used", "expired", "exhausted", "sold_out".
+    """
+    async with uow() as tx:
+        async with tx.execute("""
+            SELECT code, reward_type, reward_value, max_uses, used_count, expires_at
+            FROM promo_codes WHERE code = ?
+        """, (code,)) as cursor:
+            row = await cursor.fetchone()
+        if not row:
+            return "unknown", None
+        promo = dict(zip(("code", "reward_type", "reward_value", "max_uses", "used_count", "expires_at"), row))
+
+        # Быстрые отказы без блокировки записи: лимит и срок назад не «откатываются»
+        now = int(time.time())
+        async with tx.execute("SELECT 1 FROM promo_redemptions WHERE code = ? AND user_id = ?", (code, user_id)) as cursor:
+            if await cursor.fetchone():
+                return "used", promo
+        if promo["expires_at"] is not None and promo["expires_at"] <= now:
+            return "expired", promo
+        if promo["max_uses"] is not None and promo["used_count"] >= promo["max_uses"]:
+            return "exhausted", promo
+
+        async with uow(write=True):
+            # Одна атомарная заявка на активацию: лимит, срок и повтор проверяются в самом UPDATE
+            cursor = await tx.execute("""
+                UPDATE promo_codes SET used_count = used_count + 1
+                WHERE code = ?
+                  AND (max_uses IS NULL OR used_count < max_uses)
+                  AND (expires_at IS NULL OR expires_at > ?)
+                  AND NOT EXISTS (SELECT 1 FROM promo_redemptions WHERE code = ? AND user_id = ?)
+            """, (code, now, code, user_id))
+            if cursor.rowcount == 0:
+                await tx.rollback()
+                async with tx.execute("SELECT 1 FROM promo_redemptions WHERE code = ? AND user_id = ?", (code, user_id)) as cursor:
+                    return ("used" if await cursor.fetchone() else "exhausted"), promo
+
+            await tx.execute("INSERT INTO promo_redemptions (code, user_id, redeemed_at) VALUES (?, ?, ?)", (code, user_id, now))
+
+            reward_type, value = promo["reward_type"], promo["reward_value"]
+            if reward_type == "money":
+                await tx.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (value, user_id))
+                await write_ledger(tx, [ledger_row(user_id, "promo", value)])
+            elif reward_type == "drops":
+                await tx.execute("UPDATE users SET drop_credits = drop_credits + ? WHERE user_id = ?", (value, user_id))
+            elif reward_type == "car":
+                car = catalog().cars_by_id.get(value)
+                if not car or not await take_from_limit(tx, car):
+                    await tx.rollback()
+                    return "sold_out", promo
+                await tx.execute("""
+                    INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at)
+                    VALUES (?, ?, ?, 'Промокод', ?)
+                """, (user_id, value, await has_car(user_id, value, tx), now_iso()))
+                await write_ledger(tx, [ledger_row(user_id, "promo", 0, value)])
+                tx.on_commit(lambda: mark_owned(user_id, [value]))
+
+    if reward_type == "car":
+        note_issued(value)
+    return "ok", promo
+
+PROMO_STATUS_TEXT = {
+    "unknown": "❌ Неизвестный промокод!",
+    "used": "❌ Промокод уже активирован!",
+    "expired": "❌ Срок действия промокода истёк!",
+    "exhausted": "❌ Промокод больше не действует — лимит активаций исчерпан!",
+    "sold_out": "❌ Машина из промокода закончилась — лимит выпуска исчерпан!",
+}
+
 @dp.message(Command("promo"))
 async def cmd_promo(message: Message):
-    user_id = message.from_user.id
     await ensure_user(message.from_user)
-    
+
     args = message.text.split()
     if len(args) < 2:
         await message.answer("❌ Используйте: /promo <код>")
         return
 
-    promo_code = args[1]
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            if not row:
-                return
-
-        # Проверим, использован ли уже
-        promo_flag = None
-        reward = 0
-        extra_drops = 0
-
-        if promo_code == "test":
-            if row[11]:  # promo_test_used
-                await message.answer("❌ Промокод уже активирован!")
-                return
-            promo_flag = "promo_test_used"
-            reward = 1_200_000_000
-        elif promo_code == "test2":
-            if row[12]:  # promo_test2_used
-                await message.answer("❌ Промокод уже активирован!")
-                return
-            promo_flag = "promo_test2_used"
-            reward = 150_000_000
-        elif promo_code == "BT":
-            if row[13]:  # promo_bt_used
-                await message.answer("❌ Промокод уже активирован!")
-                return
-            promo_flag = "promo_bt_used"
-            reward = 20_000_000
-        elif promo_code == "BetaTest":
-            if row[14]:  # promo_betatest_used
-                await message.answer("❌ Промокод уже активирован!")
-                return
-            promo_flag = "promo_betatest_used"
-            extra_drops = 5  # даёт 5 бесплатных кейсов "Выбить машину"
-        else:
-            await message.answer("❌ Неизвестный промокод!")
-            return
+    status, promo = await redeem_promo(message.from_user.id, args[1])
+    if status != "ok":
+        await message.answer(PROMO_STATUS_TEXT[status])
+        return
 
-        # Начислим награду
-        if reward > 0:
-            balance = await get_balance_with_income(user_id)
-            new_balance = balance + reward
-            await db.execute(f"UPDATE users SET balance = ?, {promo_flag} = 1 WHERE user_id = ?", (new_balance, user_id))
-            await db.commit()
-            await message.answer(f"✅ Промокод активирован! Получено ${format_number(reward)}")
-        elif extra_drops > 0:
-            # Для BetaTest — просто даём флаг, а обработку сделаем при нажатии "Выбить машину"
-            await db.execute(f"UPDATE users SET {promo_flag} = 1 WHERE user_id = ?", (user_id,))
-            await db.commit()
-            await message.answer("✅ Промокод BetaTest активирован! Теперь у вас 5 бесплатных попыток 'Выбить машину'.")
+    value = promo["reward_value"]
+    if promo["reward_type"] == "money":
+        await message.answer(f"✅ Промокод активирован! Получено ${format_number(value)}")
+    elif promo["reward_type"] == "drops":
+        await message.answer(f"✅ Промокод {promo['code']} активирован! Теперь у вас {value} бесплатных попыток 'Выбить машину'.")
+    else:
+        await message.answer(f"✅ Промокод активирован! Вы получили: {catalog().cars_by_id.get(value, UNKNOWN_CAR).name}!")
 
-# ========== МОДИФИКАЦИЯ DROP ДЛЯ BETA TEST ==========
+  # main.py — БЛОК 6: Обмен машинами
 
-# Обновим функцию drop_car, чтобы учитывать BetaTest
-# (замените старую функцию drop_car на эту)
+# ========== ДВИЖОК ОБМЕНА ==========
+
+class Exchange(NamedTuple):
+    """Предложение обмена: конкретные строки user_cars с версиями, на момент предложения"""
+    initiator_id: int
+    partner_id: int
+    give: tuple           # ((user_car_id, version), ...) — машины инициатора
+    take: tuple           # ((user_car_id, version), ...) — машины партнёра
+    cash: int = 0         # доплата: > 0 — платит инициатор, < 0 — платит партнёр
+
+EXCHANGE_MAX_CARS = 10  # на сторону
+
+async def exchange_cars(trade: Exchange, offer_id: Optional[int] = None) -> str:
+    """
+    Проводит обмен N на M машин (плюс доплата) одной транзакцией.
+    Машины переходят к новому владельцу обновлением строки — цвет и история сохраняются.
+    Каждая строка проверяется по владельцу и версии: если машину успели продать,
+    обменять, перекрасить или выставить на биржу, обмен не проходит целиком.
+    С offer_id предложение закрывается в той же транзакции: принятым или, если машины ушли, недействительным.
+    Статусы: "ok", "invalid", "gone", "expired", "no_money".
+    """
+    rows = [row_id for row_id, _ in trade.give + trade.take]
+    if (
+        trade.initiator_id == trade.partner_id
+        or not (trade.give or trade.take)
+        or len(trade.give) > EXCHANGE_MAX_CARS or len(trade.take) > EXCHANGE_MAX_CARS
+        or len(set(rows)) != len(rows)
+    ):
+        return "invalid"
+    moves = (
+        [(row_id, version, trade.initiator_id, trade.partner_id) for row_id, version in trade.give]
+        + [(row_id, version, trade.partner_id, trade.initiator_id) for row_id, version in trade.take]
+    )
 
-@dp.callback_query(F.data == "drop_car")
-async def drop_car(callback: CallbackQuery):
-    user_id = callback.from_user.id
-    await ensure_user(callback.from_user)
+    async with uow(write=True) as tx:
+        # Обмен — в SAVEPOINT: если он не прошёл, «gone» закрывает предложение в той же транзакции
+        async with uow(write=True):
+            status = await transfer_cars(tx, trade, rows, moves, offer_id)
+            if status != "ok":
+                await tx.rollback()
+        if status == "gone" and offer_id is not None:
+            await tx.execute("UPDATE exchange_offers SET status = 'invalid' WHERE id = ? AND status = 'open'", (offer_id,))
+    return status
+
+async def transfer_cars(tx: "UnitOfWork", trade: Exchange, rows: List[int], moves: List[tuple], offer_id: Optional[int]) -> str:
+    """Проверки и переносы строк обмена; при статусе не "ok" вызывающий откатывает. Только внутри uow(write=True)"""
+    placeholders = ",".join("?" * len(rows))
+    async with tx.execute(f"""
+        SELECT id, user_id, car_id, version, EXISTS (
+            SELECT 1 FROM market_orders WHERE user_car_id = user_cars.id AND status = 'open'
+        ) FROM user_cars WHERE id IN ({placeholders})
+    """, rows) as cursor:
+        current = {row[0]: row[1:] for row in await cursor.fetchall()}
+    for row_id, version, owner, _ in moves:
+        found = current.get(row_id)
+        if not found or found[0] != owner or found[2] != version or found[3]:
+            return "gone"
+
+    if offer_id is not None:
+        cursor = await tx.execute("""
+            UPDATE exchange_offers SET status = 'accepted' WHERE id = ? AND status = 'open' AND expires_at > ?
+        """, (offer_id, int(time.time())))
+        if cursor.rowcount == 0:
+            return "expired"
+
+    if trade.cash:
+        payer, payee = (trade.initiator_id, trade.partner_id) if trade.cash > 0 else (trade.partner_id, trade.initiator_id)
+        cash = abs(trade.cash)
+        cursor = await tx.execute(
+            "UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?", (cash, payer, cash)
+        )
+        if cursor.rowcount == 0:
+            return "no_money"
+        await tx.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (cash, payee))
+
+    # Дубликат — если у нового владельца уже есть такая машина (включая полученную в этом же обмене)
+    owned = {user_id: await owned_mask(user_id, tx) for user_id in (trade.initiator_id, trade.partner_id)}
+    now = now_iso()
+    updates = []
+    ledger = []
+    for row_id, version, owner, receiver in moves:
+        car_id = current[row_id][1]
+        updates.append((receiver, bool(owned[receiver] >> car_id & 1), now, row_id, owner, version))
+        owned[receiver] |= 1 << car_id
+        ledger += [ledger_row(owner, "trade_out", 0, car_id), ledger_row(receiver, "trade_in", 0, car_id)]
+    if trade.cash:
+        ledger += [ledger_row(payer, "trade_out", -cash), ledger_row(payee, "trade_in", cash)]
+
+    cursor = await tx.executemany("""
+        UPDATE user_cars SET user_id = ?, is_duplicate = ?, source = 'Обмен', acquired_at = ?, version = version + 1
+        WHERE id = ? AND user_id = ? AND version = ?
+    """, updates)
+    if cursor.rowcount != len(updates):
+        return "gone"
+    await invalidate_offers_for_rows(tx, rows)
+    await write_ledger(tx, ledger)
+    given = {user_id: [] for user_id in owned}
+    received = {user_id: [] for user_id in owned}
+    for row_id, version, owner, receiver in moves:
+        given[owner].append(current[row_id][1])
+        received[receiver].append(current[row_id][1])
+    gone = {user_id: await settle_owned(tx, user_id, car_ids) for user_id, car_ids in given.items()}
+
+    def update_masks():
+        for user_id in owned:
+            unmark_owned(user_id, gone[user_id])
+            mark_owned(user_id, received[user_id])
+    tx.on_commit(update_masks)
+    return "ok"
+
+EXCHANGE_FAILURES = {
+    "invalid": "❌ Обмен невозможен.",
+    "gone": "❌ Обмен невозможен: машина уже продана, обменяна, перекрашена или выставлена на биржу.",
+    "expired": "❌ Предложение уже неактуально: истекло, отклонено или принято.",
+    "no_money": "❌ Обмен невозможен: не хватает денег на доплату.",
+}
 
-    async with aiosqlite.connect(DB_PATH) as db:
+async def tradable_car_row(user_id: int, row_id: int) -> Optional[tuple]:
+    """(car_id, version) строки игрока, если её можно обменять (не выставлена на бирже)"""
+    async with connect_db() as db:
         async with db.execute("""
-            SELECT last_drop, promo_betatest_used, balance 
-            FROM users WHERE user_id = ?
-        """, (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            if not row:
-                return
-            last_drop, has_beta, balance = row
-
-    # Проверим: если есть BetaTest — пропускаем таймер
-    if not has_beta:
-        if last_drop:
-            last_drop_dt = datetime.fromisoformat(last_drop)
-            if datetime.utcnow() - last_drop_dt < timedelta(minutes=30):
-                await callback.answer("⏳ Вы можете выбить машину раз в 30 минут!", show_alert=True)
-                return
-
-    import random
-    car = random.choice(DROP_CARS)
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT issued_count FROM global_car_counts WHERE car_id = ?", (car["id"],)) as cursor:
+            SELECT car_id, version FROM user_cars WHERE id = ? AND user_id = ? AND NOT EXISTS (
+                SELECT 1 FROM market_orders WHERE user_car_id = user_cars.id AND status = 'open'
+            )
+        """, (row_id, user_id)) as cursor:
+            return await cursor.fetchone()
+
+# ========== ВХОДЯЩИЕ ПРЕДЛОЖЕНИЯ ОБМЕНА ==========
+
+# 📥 Предложения хранятся в exchange_offers (кому, статус, срок), машины — в exchange_offer_cars
+# с версиями строк. Истёкшие закрывает один фоновый обход, а не спящая задача на каждое предложение.
+EXCHANGE_OFFER_TTL = 24 * 3600
+OFFERS_PAGE_SIZE = 5
+OFFER_SWEEP_INTERVAL = 60
+OFFER_SWEEP_BATCH = 1000
+
+async def create_offer(trade: Exchange) -> int:
+    """Сохраняет предложение обмена и возвращает его id"""
+    created_at = int(time.time())
+    async with uow(write=True) as tx:
+        cursor = await tx.execute("""
+            INSERT INTO exchange_offers (initiator_id, recipient_id, cash, status, created_at, expires_at)
+            VALUES (?, ?, ?, 'open', ?, ?)
+        """, (trade.initiator_id, trade.partner_id, trade.cash, created_at, created_at + EXCHANGE_OFFER_TTL))
+        offer_id = cursor.lastrowid
+        await tx.executemany("""
+            INSERT INTO exchange_offer_cars (offer_id, user_car_id, version, side) VALUES (?, ?, ?, ?)
+        """, [(offer_id, row_id, version, "give") for row_id, version in trade.give]
+             + [(offer_id, row_id, version, "take") for row_id, version in trade.take])
+    return offer_id
+
+async def load_offer(offer_id: int) -> Optional[Exchange]:
+    """Открытое и не истёкшее предложение или None"""
+    async with connect_db() as db:
+        async with db.execute("""
+            SELECT initiator_id, recipient_id, cash FROM exchange_offers
+            WHERE id = ? AND status = 'open' AND expires_at > ?
+        """, (offer_id, int(time.time()))) as cursor:
             row = await cursor.fetchone()
-            issued = row[0] if row else 0
-
-        if issued >= car["max_global"]:
-            for _ in range(10):
-                new_car = random.choice(DROP_CARS)
-                async with db.execute("SELECT issued_count FROM global_car_counts WHERE car_id = ?", (new_car["id"],)) as cursor:
-                    row2 = await cursor.fetchone()
-                    issued2 = row2[0] if row2 else 0
-                if issued2 < new_car["max_global"]:
-                    car = new_car
-                    break
-            else:
-                await callback.answer("❌ Сейчас нет доступных машин!", show_alert=True)
-                return
+        if not row:
+            return None
+        async with db.execute(
+            "SELECT user_car_id, version, side FROM exchange_offer_cars WHERE offer_id = ?", (offer_id,)
+        ) as cursor:
+            cars = await cursor.fetchall()
+    initiator_id, recipient_id, cash = row
+    return Exchange(
+        initiator_id=initiator_id,
+        partner_id=recipient_id,
+        give=tuple((row_id, version) for row_id, version, side in cars if side == "give"),
+        take=tuple((row_id, version) for row_id, version, side in cars if side == "take"),
+        cash=cash,
+    )
 
-        async with db.execute("SELECT 1 FROM user_cars WHERE user_id = ? AND car_id = ?", (user_id, car["id"])) as cursor:
-            is_duplicate = await cursor.fetchone() is not None
+async def invalidate_offers_for_rows(db: aiosqlite.Connection, user_car_ids: List[int]):
+    """Закрывает открытые предложения с машинами, которые ушли из гаража или изменились"""
+    await db.executemany("""
+        UPDATE exchange_offers SET status = 'invalid'
+        WHERE status = 'open' AND id IN (SELECT offer_id FROM exchange_offer_cars WHERE user_car_id = ?)
+    """, [(row_id,) for row_id in user_car_ids])
+
+async def invalidate_offers_for_user(db: aiosqlite.Connection, user_id: int):
+    """Бан и аннулирование: закрывает все открытые предложения игрока в обе стороны"""
+    await db.execute("""
+        UPDATE exchange_offers SET status = 'invalid'
+        WHERE status = 'open' AND (initiator_id = ? OR recipient_id = ?)
+    """, (user_id, user_id))
+
+async def close_offers(user_id: int, status: str, offer_id: Optional[int] = None) -> int:
+    """
+    Отклоняет (status="rejected", получатель) или отзывает (status="cancelled", автор) предложения.
+    Без offer_id — все открытые разом. Возвращает число закрытых.
+    """
+    column = "recipient_id" if status == "rejected" else "initiator_id"
+    where = "AND id = ?" if offer_id is not None else ""
+    params = (status, user_id) + ((offer_id,) if offer_id is not None else ())
+    async with uow(write=True) as tx:
+        cursor = await tx.execute(f"""
+            UPDATE exchange_offers SET status = ? WHERE {column} = ? AND status = 'open' {where}
+        """, params)
+    return cursor.rowcount
+
+async def expire_offers(now: int) -> List[tuple]:
+    """Закрывает истёкшие предложения пачкой; возвращает [(offer_id, recipient_id), ...]"""
+    async with uow(write=True) as tx:
+        async with tx.execute("""
+            SELECT id, recipient_id FROM exchange_offers WHERE status = 'open' AND expires_at <= ? LIMIT ?
+        """, (now, OFFER_SWEEP_BATCH)) as cursor:
+            expired = await cursor.fetchall()
+        await tx.executemany(
+            "UPDATE exchange_offers SET status = 'expired' WHERE id = ? AND status = 'open'",
+            [(offer_id,) for offer_id, _ in expired]
+        )
+    return expired
+
+async def offer_sweeper():
+    """Раз в OFFER_SWEEP_INTERVAL закрывает истёкшие предложения и сообщает получателям"""
+    while True:
+        await asyncio.sleep(OFFER_SWEEP_INTERVAL)
+        while True:
+            expired = await expire_offers(int(time.time()))
+            for i in range(0, len(expired), NOTIFY_BATCH_SIZE):
+                await asyncio.gather(*(
+                    notify_offer_expired(offer_id, recipient_id)
+                    for offer_id, recipient_id in expired[i:i + NOTIFY_BATCH_SIZE]
+                ))
+                await asyncio.sleep(1)
+            if len(expired) < OFFER_SWEEP_BATCH:
+                break
 
-        # Начислим
-        new_balance = balance + car["price_usd"]
-        await db.execute("UPDATE users SET balance = ?, last_drop = ? WHERE user_id = ?", (new_balance, now_iso(), user_id))
-        await db.execute("""
-            INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, car["id"], is_duplicate, "Выпала", now_iso()))
-        await db.execute("""
-            INSERT INTO global_car_counts (car_id, issued_count)
-            VALUES (?, 1)
-            ON CONFLICT(car_id) DO UPDATE SET issued_count = issued_count + 1
-        """)
-        await db.commit()
+async def notify_offer_expired(offer_id: int, user_id: int):
+    try:
+        await bot.send_message(user_id, f"⏰ Предложение обмена №{offer_id} истекло.")
+    except Exception:
+        pass
 
-    status = " (дубликат)" if is_duplicate else ""
-    await callback.answer(f"🎁 Вы выбили: {car['name']}{status} (+${format_number(car['price_usd'])})!", show_alert=True)
-    await main_menu(callback.message)
-  # main.py — БЛОК 6: Обмен машинами
+async def list_offers(user_id: int, page: int, outgoing: bool = False) -> tuple:
+    """
+    Страница открытых предложений: (всего, [(offer_id, другой игрок, имя, доплата, истекает,
+    [машины, которые отдают], [машины, которые просят]), ...]). Ближайшие к истечению — первыми.
+    """
+    mine, other = ("initiator_id", "recipient_id") if outgoing else ("recipient_id", "initiator_id")
+    now = int(time.time())
+    async with connect_db() as db:
+        async with db.execute(f"""
+            SELECT COUNT(*) FROM exchange_offers WHERE {mine} = ? AND status = 'open' AND expires_at > ?
+        """, (user_id, now)) as cursor:
+            total = (await cursor.fetchone())[0]
+        async with db.execute(f"""
+            SELECT exchange_offers.id, exchange_offers.{other}, users.display_name, cash, expires_at
+            FROM exchange_offers LEFT JOIN users ON users.user_id = exchange_offers.{other}
+            WHERE exchange_offers.{mine} = ? AND status = 'open' AND expires_at > ?
+            ORDER BY expires_at LIMIT ? OFFSET ?
+        """, (user_id, now, OFFERS_PAGE_SIZE, page * OFFERS_PAGE_SIZE)) as cursor:
+            offers = await cursor.fetchall()
+        cars: Dict[int, Dict[str, list]] = {offer[0]: {"give": [], "take": []} for offer in offers}
+        if offers:
+            placeholders = ",".join("?" * len(offers))
+            async with db.execute(f"""
+                SELECT offer_id, side, user_cars.car_id FROM exchange_offer_cars
+                JOIN user_cars ON user_cars.id = exchange_offer_cars.user_car_id
+                WHERE offer_id IN ({placeholders})
+            """, list(cars)) as cursor:
+                async for offer_id, side, car_id in cursor:
+                    cars[offer_id][side].append(car_id)
+    return total, [offer + (cars[offer[0]]["give"], cars[offer[0]]["take"]) for offer in offers]
 
 # ========== FSM STATES ==========
 
@@ -1542,20 +2011,21 @@ class ExchangeStates(StatesGroup):
 
 @dp.callback_query(F.data.startswith("exchange_start_"))
 async def exchange_start(callback: CallbackQuery, state: FSMContext):
-    car_id = int(callback.data.split("_")[2])
+    user_car_id = int(callback.data.split("_")[2])
     user_id = callback.from_user.id
 
-    # Проверим, есть ли у игрока эта машина
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT 1 FROM user_cars WHERE user_id = ? AND car_id = ?", (user_id, car_id)) as cursor:
-            if not await cursor.fetchone():
-                await callback.answer("❌ У вас нет этой машины!", show_alert=True)
-                return
+    # Проверим, что это машина игрока и она не выставлена на бирже
+    row = await tradable_car_row(user_id, user_car_id)
+    if not row:
+        await callback.answer("❌ Эта машина недоступна для обмена!", show_alert=True)
+        return
+    car_id, version = row
 
-    await state.update_data(car_id=car_id, initiator_id=user_id)
+    await state.update_data(car_id=car_id, user_car_id=user_car_id, version=version, initiator_id=user_id)
     await state.set_state(ExchangeStates.waiting_for_partner)
     
-    await callback.message.edit_text(
+    await edit_message(
+        callback.message,
         "🔄 Введите @username или имя игрока, с которым хотите обменяться:"
     )
     await callback.answer()
@@ -1575,7 +2045,7 @@ async def process_partner(message: Message, state: FSMContext):
     # Найдём партнёра в БД
     partner_id = None
     partner_name = None
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with connect_db() as db:
         # Сначала по username
         async with db.execute("SELECT user_id, display_name FROM users WHERE username = ?", (partner_identifier,)) as cursor:
             row = await cursor.fetchone()
@@ -1598,7 +2068,7 @@ async def process_partner(message: Message, state: FSMContext):
 
     data = await state.get_data()
     car_id = data["car_id"]
-    car = next((c for c in ALL_CARS if c["id"] == car_id), None)
+    car = catalog().cars_by_id.get(car_id)
     if not car:
         await message.answer("❌ Ошибка: машина не найдена.")
         await state.clear()
@@ -1607,10 +2077,12 @@ async def process_partner(message: Message, state: FSMContext):
     await state.update_data(partner_id=partner_id, partner_name=partner_name)
     await state.set_state(ExchangeStates.waiting_for_car_selection)
 
-    # Получим список машин партнёра
-    async with aiosqlite.connect(DB_PATH) as db:
+    # Получим список машин партнёра (кроме выставленных на бирже)
+    async with connect_db() as db:
         async with db.execute("""
-            SELECT car_id FROM user_cars WHERE user_id = ?
+            SELECT id, car_id, color FROM user_cars WHERE user_id = ? AND NOT EXISTS (
+                SELECT 1 FROM market_orders WHERE user_car_id = user_cars.id AND status = 'open'
+            )
         """, (partner_id,)) as cursor:
             partner_cars = await cursor.fetchall()
 
@@ -1621,10 +2093,11 @@ async def process_partner(message: Message, state: FSMContext):
 
     # Построим клавиатуру с машинами партнёра
     keyboard = InlineKeyboardBuilder()
-    for (pid,) in partner_cars[:20]:  # Ограничим для читаемости
-        pcar = next((c for c in ALL_CARS if c["id"] == pid), None)
+    for prow, pid, color in partner_cars[:20]:  # Ограничим для читаемости
+        pcar = catalog().cars_by_id.get(pid)
         if pcar:
-            keyboard.button(text=pcar["name"][:30], callback_data=f"exchange_select_{pid}")
+            color_text = f" ({color})" if color and color != "Стандартный" else ""
+            keyboard.button(text=(pcar.name + color_text)[:40], callback_data=f"exchange_select_{prow}")
     keyboard.button(text="❌ Отмена", callback_data="exchange_cancel")
     keyboard.adjust(1)
 
@@ -1636,119 +2109,182 @@ async def process_partner(message: Message, state: FSMContext):
 @dp.callback_query(F.data == "exchange_cancel")
 async def exchange_cancel(callback: CallbackQuery, state: FSMContext):
     await state.clear()
-    await callback.message.edit_text("❌ Обмен отменён.")
+    await edit_message(callback.message, "❌ Обмен отменён.")
     await callback.answer()
 
 # ========== ВЫБОР МАШИНЫ ПАРТНЁРА ==========
 
 @dp.callback_query(F.data.startswith("exchange_select_"))
 async def exchange_select_car(callback: CallbackQuery, state: FSMContext):
-    partner_car_id = int(callback.data.split("_")[2])
+    partner_row_id = int(callback.data.split("_")[2])
     data = await state.get_data()
+    if "partner_id" not in data:
+        await callback.answer("❌ Обмен устарел, начните заново.", show_alert=True)
+        return
     initiator_id = data["initiator_id"]
     partner_id = data["partner_id"]
     car_id = data["car_id"]
 
     # Сохраним выбор
-    await state.update_data(partner_car_id=partner_car_id)
+    await state.update_data(partner_row_id=partner_row_id)
     await state.set_state(ExchangeStates.waiting_for_confirmation)
 
     # Получим данные машин
-    initiator_car = next((c for c in ALL_CARS if c["id"] == car_id), None)
-    partner_car = next((c for c in ALL_CARS if c["id"] == partner_car_id), None)
+    partner_row = await tradable_car_row(partner_id, partner_row_id)
+    initiator_car = catalog().cars_by_id.get(car_id)
+    partner_car = catalog().cars_by_id.get(partner_row[0]) if partner_row else None
 
     if not initiator_car or not partner_car:
-        await callback.message.edit_text("❌ Ошибка: машины не найдены.")
+        await edit_message(callback.message, "❌ Ошибка: машины не найдены.")
         await state.clear()
         return
+    partner_version = partner_row[1]
+
+    # Сохраним предложение — оно появится во входящих партнёра, даже если сообщение не дойдёт
+    offer_id = await create_offer(Exchange(
+        initiator_id=initiator_id,
+        partner_id=partner_id,
+        give=((data["user_car_id"], data["version"]),),
+        take=((partner_row_id, partner_version),),
+    ))
+    await state.clear()
 
-    # Отправим запрос партнёру
     try:
         confirm_keyboard = InlineKeyboardBuilder()
-        confirm_keyboard.button(text="✅ Принять", callback_data=f"exchange_confirm_{initiator_id}_{car_id}_{partner_car_id}")
-        confirm_keyboard.button(text="❌ Отклонить", callback_data="exchange_reject")
-        confirm_keyboard.adjust(2)
+        confirm_keyboard.button(text="✅ Принять", callback_data=f"exchange_confirm_{offer_id}")
+        confirm_keyboard.button(text="❌ Отклонить", callback_data=f"exchange_reject_{offer_id}")
+        confirm_keyboard.button(text="📥 Все предложения", callback_data="offers_in_0")
+        confirm_keyboard.adjust(2, 1)
 
         await bot.send_message(
             partner_id,
-            f"🔄 Игрок {callback.from_user.full_name} предлагает обмен:\n"
-            f"Ваша машина: {partner_car['name']}\n"
-            f"Его машина: {initiator_car['name']}\n\n"
-            "У вас есть 5 минут на ответ!",
+            f"🔄 Игрок {callback.from_user.full_name} предлагает обмен №{offer_id}:\n"
+            f"Ваша машина: {partner_car.name}\n"
+            f"Его машина: {initiator_car.name}\n\n"
+            f"Предложение действует {format_duration(EXCHANGE_OFFER_TTL)}.",
             reply_markup=confirm_keyboard.as_markup()
         )
-
-        # Запустим таймер
-        asyncio.create_task(exchange_timeout(partner_id, 300))  # 300 сек = 5 мин
-
-        await callback.message.edit_text("✅ Запрос на обмен отправлен!")
-        await callback.answer()
-        await state.clear()
-
+        await edit_message(callback.message, f"✅ Предложение №{offer_id} отправлено!")
     except Exception as e:
-        await callback.message.edit_text("❌ Не удалось отправить запрос. Возможно, игрок заблокировал бота.")
-        await state.clear()
-        await callback.answer()
-
-# ========== ТАЙМЕР ДЛЯ ОБМЕНА ==========
-
-async def exchange_timeout(user_id: int, seconds: int):
-    await asyncio.sleep(seconds)
-    try:
-        await bot.send_message(user_id, "⏰ Время на обмен истекло. Запрос отменён.")
-    except:
-        pass  # Игнорируем, если не удалось отправить
+        await edit_message(callback.message, f"✅ Предложение №{offer_id} сохранено во входящих игрока, но сообщение не доставлено.")
+    await callback.answer()
 
-# ========== ПОДТВЕРЖДЕНИЕ ОБМЕНА ==========
+# ========== ПРИНЯТЬ / ОТКЛОНИТЬ ==========
 
 @dp.callback_query(F.data.startswith("exchange_confirm_"))
 async def exchange_confirm(callback: CallbackQuery):
     parts = callback.data.split("_")
-    initiator_id = int(parts[2])
-    car_id = int(parts[3])
-    partner_car_id = int(parts[4])
-    partner_id = callback.from_user.id
-
-    # Проверим, есть ли машины у игроков
-    async with aiosqlite.connect(DB_PATH) as db:
-        # У инициатора должна быть car_id
-        async with db.execute("SELECT 1 FROM user_cars WHERE user_id = ? AND car_id = ?", (initiator_id, car_id)) as cursor:
-            if not await cursor.fetchone():
-                await callback.answer("❌ Обмен невозможен: машина уже продана или удалена.", show_alert=True)
-                return
-
-        # У партнёра должна быть partner_car_id
-        async with db.execute("SELECT 1 FROM user_cars WHERE user_id = ? AND car_id = ?", (partner_id, partner_car_id)) as cursor:
-            if not await cursor.fetchone():
-                await callback.answer("❌ Обмен невозможен: машина уже продана или удалена.", show_alert=True)
-                return
-
-        # Удалим старые записи
-        await db.execute("DELETE FROM user_cars WHERE user_id = ? AND car_id = ?", (initiator_id, car_id))
-        await db.execute("DELETE FROM user_cars WHERE user_id = ? AND car_id = ?", (partner_id, partner_car_id))
-
-        # Добавим новые
-        await db.execute("""
-            INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at)
-            VALUES (?, ?, 0, 'Обмен', ?)
-        """, (partner_id, car_id, now_iso()))
-        await db.execute("""
-            INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at)
-            VALUES (?, ?, 0, 'Обмен', ?)
-        """, (initiator_id, partner_car_id, now_iso()))
-
-        await db.commit()
+    if len(parts) != 3:
+        # Кнопки старого формата — предложения не было в exchange_offers
+        await callback.answer("❌ Предложение устарело, попросите отправить его заново.", show_alert=True)
+        return
+    offer_id = int(parts[2])
+    trade = await load_offer(offer_id)
+    if not trade or trade.partner_id != callback.from_user.id:
+        await callback.answer(EXCHANGE_FAILURES["expired"], show_alert=True)
+        return
+    status = await exchange_cars(trade, offer_id)
+    if status != "ok":
+        await callback.answer(EXCHANGE_FAILURES[status], show_alert=True)
+        return
 
-    await callback.message.edit_text("✅ Обмен успешно завершён!")
+    await edit_message(callback.message, "✅ Обмен успешно завершён!")
+    await callback.answer()
     try:
-        await bot.send_message(initiator_id, "✅ Обмен успешно завершён!")
+        await bot.send_message(trade.initiator_id, f"✅ Предложение обмена №{offer_id} принято!")
     except:
         pass
 
-@dp.callback_query(F.data == "exchange_reject")
+@dp.callback_query(F.data.startswith("exchange_reject"))
 async def exchange_reject(callback: CallbackQuery):
-    await callback.message.edit_text("❌ Обмен отклонён.")
+    parts = callback.data.split("_")
+    if len(parts) == 3:
+        await close_offers(callback.from_user.id, "rejected", int(parts[2]))
+    await edit_message(callback.message, "❌ Обмен отклонён.")
     await callback.answer()
+
+@dp.callback_query(F.data.startswith("exchange_withdraw_"))
+async def exchange_withdraw(callback: CallbackQuery):
+    closed = await close_offers(callback.from_user.id, "cancelled", int(callback.data.split("_")[2]))
+    await callback.answer("↩️ Предложение отозвано." if closed else EXCHANGE_FAILURES["expired"])
+    await show_offers(callback, 0, outgoing=True)
+
+# ========== СПИСОК ПРЕДЛОЖЕНИЙ ==========
+
+def offer_cars_text(car_ids: list) -> str:
+    if not car_ids:
+        return "—"
+    return ", ".join(catalog().cars_by_id.get(car_id, UNKNOWN_CAR).name for car_id in car_ids)
+
+async def show_offers(callback: CallbackQuery, page: int, outgoing: bool = False):
+    total, offers = await list_offers(callback.from_user.id, page, outgoing)
+    pages = max(1, math.ceil(total / OFFERS_PAGE_SIZE))
+    if not offers and page > 0:
+        # Страница опустела (предложения приняты или истекли) — покажем последнюю
+        page = pages - 1
+        total, offers = await list_offers(callback.from_user.id, page, outgoing)
+
+    prefix = "offers_out" if outgoing else "offers_in"
+    title = "📤 Исходящие предложения" if outgoing else "📥 Входящие предложения"
+    lines = [f"{title}: {total} (стр. {page + 1}/{pages})"]
+    keyboard = InlineKeyboardBuilder()
+    now = int(time.time())
+    for offer_id, other_id, other_name, cash, expires_at, give, take in offers:
+        who = other_name or f"id {other_id}"
+        # give — машины автора предложения, take — машины получателя
+        mine, theirs = (give, take) if outgoing else (take, give)
+        cash_text = ""
+        if cash:
+            pays_me = (cash > 0) != outgoing
+            cash_text = f"\n   💵 {'вам доплачивают' if pays_me else 'вы доплачиваете'} ${format_number(abs(cash))}"
+        lines.append(
+            f"\n№{offer_id} · {'для' if outgoing else 'от'} {who} · осталось {format_duration(expires_at - now)}\n"
+            f"   Вы отдаёте: {offer_cars_text(mine)}\n"
+            f"   Вы получаете: {offer_cars_text(theirs)}{cash_text}"
+        )
+        if outgoing:
+            keyboard.row(InlineKeyboardButton(text=f"↩️ Отозвать №{offer_id}", callback_data=f"exchange_withdraw_{offer_id}"))
+        else:
+            keyboard.row(
+                InlineKeyboardButton(text=f"✅ №{offer_id}", callback_data=f"exchange_confirm_{offer_id}"),
+                InlineKeyboardButton(text=f"❌ №{offer_id}", callback_data=f"exchange_reject_{offer_id}"),
+            )
+
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"{prefix}_{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton(text="Дальше ➡️", callback_data=f"{prefix}_{page + 1}"))
+    if nav:
+        keyboard.row(*nav)
+    if total and not outgoing:
+        keyboard.row(InlineKeyboardButton(text="🗑 Отклонить все", callback_data="offers_reject_all"))
+    keyboard.row(InlineKeyboardButton(
+        text="📥 Входящие" if outgoing else "📤 Исходящие",
+        callback_data="offers_in_0" if outgoing else "offers_out_0"
+    ))
+    keyboard.row(InlineKeyboardButton(text="↩️ Меню", callback_data="back_to_main"))
+    await edit_message(callback.message, "\n".join(lines), reply_markup=keyboard.as_markup())
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("offers_in_") | F.data.startswith("offers_out_"))
+async def offers_page(callback: CallbackQuery):
+    _, direction, page = callback.data.split("_")
+    await show_offers(callback, int(page), outgoing=direction == "out")
+
+@dp.callback_query(F.data == "offers_reject_all")
+async def offers_reject_all(callback: CallbackQuery):
+    closed = await close_offers(callback.from_user.id, "rejected")
+    await callback.answer(f"🗑 Отклонено предложений: {closed}")
+    await show_offers(callback, 0)
+
+@dp.message(Command("offers"))
+async def cmd_offers(message: Message):
+    keyboard = InlineKeyboardBuilder()
+    keyboard.button(text="📥 Входящие", callback_data="offers_in_0")
+    keyboard.button(text="📤 Исходящие", callback_data="offers_out_0")
+    keyboard.adjust(2)
+    await message.answer("🔄 Предложения обмена:", reply_markup=keyboard.as_markup())
   # main.py — БЛОК 7: Админка (Консоль)
 
 # ========== ВСПОМОГАТЕЛЬНАЯ ФУНКЦИЯ: СПИСОК ИГРОКОВ ==========
@@ -1756,7 +2292,7 @@ async def exchange_reject(callback: CallbackQuery):
 async def get_all_players_kb(action: str) -> InlineKeyboardMarkup:
     """Возвращает клавиатуру со всеми игроками для админки"""
     keyboard = InlineKeyboardBuilder()
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with connect_db() as db:
         async with db.execute("SELECT user_id, username, display_name FROM users") as cursor:
             players = await cursor.fetchall()
     
@@ -1778,7 +2314,7 @@ async def admin_give_money_menu(callback: CallbackQuery):
         return
 
     kb = await get_all_players_kb("give_money")
-    await callback.message.edit_text("Выберите игрока для выдачи денег:", reply_markup=kb)
+    await edit_message(callback.message, "Выберите игрока для выдачи денег:", reply_markup=kb)
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("admin_give_money_"))
@@ -1799,7 +2335,7 @@ async def admin_select_money_amount(callback: CallbackQuery):
     keyboard.button(text="❌ Отмена", callback_data="admin_give_money")
     keyboard.adjust(2)
     
-    await callback.message.edit_text("Выберите сумму для выдачи:", reply_markup=keyboard.as_markup())
+    await edit_message(callback.message, "Выберите сумму для выдачи:", reply_markup=keyboard.as_markup())
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("admin_add_balance_"))
@@ -1811,11 +2347,52 @@ async def admin_add_balance(callback: CallbackQuery):
     target_id = int(parts[3])
     amount = int(parts[4])
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, target_id))
-        await db.commit()
+    async with uow(write=True) as tx:
+        await tx.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, target_id))
+        await write_ledger(tx, [ledger_row(target_id, "admin_money", amount)])
+
+    await edit_message(callback.message, f"✅ Игроку выдано ${format_number(amount)}")
+    await callback.answer()
+
+# ========== ВЫДАТЬ БЕСПЛАТНЫЕ ПОПЫТКИ ==========
+
+@dp.callback_query(F.data == "admin_give_drops")
+async def admin_give_drops_menu(callback: CallbackQuery):
+    if callback.from_user.username != CREATOR_USERNAME:
+        return
+
+    kb = await get_all_players_kb("give_drops")
+    await edit_message(callback.message, "Выберите игрока для выдачи попыток:", reply_markup=kb)
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("admin_give_drops_"))
+async def admin_select_drops_amount(callback: CallbackQuery):
+    if callback.from_user.username != CREATOR_USERNAME:
+        return
+
+    target_id = int(callback.data.split("_")[3])
+    keyboard = InlineKeyboardBuilder()
+    for amount in (1, 5, 10, 50):
+        keyboard.button(text=str(amount), callback_data=f"admin_add_drops_{target_id}_{amount}")
+    keyboard.button(text="❌ Отмена", callback_data="admin_give_drops")
+    keyboard.adjust(2)
+
+    await edit_message(callback.message, "Сколько бесплатных попыток выдать?", reply_markup=keyboard.as_markup())
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("admin_add_drops_"))
+async def admin_add_drops(callback: CallbackQuery):
+    if callback.from_user.username != CREATOR_USERNAME:
+        return
+
+    parts = callback.data.split("_")
+    target_id = int(parts[3])
+    amount = int(parts[4])
 
-    await callback.message.edit_text(f"✅ Игроку выдано ${format_number(amount)}")
+    async with uow(write=True) as tx:
+        await tx.execute("UPDATE users SET drop_credits = drop_credits + ? WHERE user_id = ?", (amount, target_id))
+
+    await edit_message(callback.message, f"✅ Игроку выдано бесплатных попыток: {amount}")
     await callback.answer()
 
 # ========== ВЫДАТЬ МАШИНУ ==========
@@ -1826,7 +2403,7 @@ async def admin_give_car_menu(callback: CallbackQuery):
         return
 
     kb = await get_all_players_kb("give_car")
-    await callback.message.edit_text("Выберите игрока:", reply_markup=kb)
+    await edit_message(callback.message, "Выберите игрока:", reply_markup=kb)
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("admin_give_car_"))
@@ -1839,23 +2416,23 @@ async def admin_select_car_for_player(callback: CallbackQuery):
     await show_admin_car_page(callback, target_id, 0)
 
 async def show_admin_car_page(callback: CallbackQuery, target_id: int, page: int):
-    total = len(ALL_CARS)
+    total = len(catalog().all_cars)
     if page >= total:
         page = 0
-    car = ALL_CARS[page]
+    car = catalog().all_cars[page]
 
-    text = f"Выберите машину для выдачи:\n\n{car['name']} ({car['year']})\nЦена: ${format_number(car['price_usd'])}"
+    text = f"Выберите машину для выдачи:\n\n{car.name} ({car.year})\nЦена: ${format_number(car.price_usd)}"
 
     keyboard = InlineKeyboardBuilder()
     if page > 0:
         keyboard.button(text="⬅️", callback_data=f"admin_car_page_{target_id}_{page-1}")
-    keyboard.button(text="✅ Выдать", callback_data=f"admin_grant_car_{target_id}_{car['id']}")
+    keyboard.button(text="✅ Выдать", callback_data=f"admin_grant_car_{target_id}_{car.id}")
     if page < total - 1:
         keyboard.button(text="➡️", callback_data=f"admin_car_page_{target_id}_{page+1}")
     keyboard.button(text="❌ Отмена", callback_data="admin_give_car")
     keyboard.adjust(3)
 
-    await callback.message.edit_text(text, reply_markup=keyboard.as_markup())
+    await edit_message(callback.message, text, reply_markup=keyboard.as_markup())
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("admin_car_page_"))
@@ -1877,32 +2454,83 @@ async def admin_grant_car(callback: CallbackQuery):
     target_id = int(parts[3])
     car_id = int(parts[4])
 
-    car = next((c for c in ALL_CARS if c["id"] == car_id), None)
+    car = catalog().cars_by_id.get(car_id)
     if not car:
         await callback.answer("❌ Машина не найдена", show_alert=True)
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Проверим, есть ли уже у игрока (для дубликата)
-        async with db.execute("SELECT 1 FROM user_cars WHERE user_id = ? AND car_id = ?", (target_id, car_id)) as cursor:
-            is_duplicate = await cursor.fetchone() is not None
-
-        await db.execute("""
+    async with uow(write=True) as tx:
+        await tx.execute("""
             INSERT INTO user_cars (user_id, car_id, is_duplicate, source, acquired_at)
             VALUES (?, ?, ?, 'Админка', ?)
-        """, (target_id, car_id, is_duplicate, now_iso()))
+        """, (target_id, car_id, await has_car(target_id, car_id), now_iso()))
+        await write_ledger(tx, [ledger_row(target_id, "admin_car", 0, car_id)])
 
         # Обновим глобальный счётчик
-        await db.execute("""
+        await tx.execute("""
             INSERT INTO global_car_counts (car_id, issued_count)
             VALUES (?, 1)
             ON CONFLICT(car_id) DO UPDATE SET issued_count = issued_count + 1
-        """)
-        await db.commit()
+        """, (car.id,))
+        tx.on_commit(lambda: mark_owned(target_id, [car_id]))
+    note_issued(car.id)
 
-    await callback.message.edit_text(f"✅ Машина «{car['name']}» выдана игроку!")
+    await edit_message(callback.message, f"✅ Машина «{car.name}» выдана игроку!")
     await callback.answer()
 
+# ========== БАНЫ ==========
+
+# ⛔ Бан не удаляет прогресс (для этого есть аннулирование) и переживает /start: баны лежат
+# в таблице bans и в BANNED в памяти. BanMiddleware стоит первым на уровне апдейта и отбрасывает
+# апдейты забаненных до обработчиков и до БД — проверка стоит один поиск в словаре.
+BANNED: Dict[int, Optional[int]] = {}  # user_id -> unix-время окончания, None — навсегда
+BAN_STATS = {"dropped": 0}
+BAN_DURATIONS = {"⏳ Сутки": 86400, "⏳ Неделя": 7 * 86400, "⛔ Навсегда": 0}
+
+def is_banned(user_id: int, now: Optional[float] = None) -> bool:
+    if user_id not in BANNED:
+        return False
+    until = BANNED[user_id]
+    if until is None or until > (now or time.time()):
+        return True
+    del BANNED[user_id]  # временный бан истёк; строку в bans пропустит load_bans
+    return False
+
+async def load_bans():
+    BANNED.clear()
+    async with connect_db() as db:
+        async with db.execute("SELECT user_id, until FROM bans WHERE until IS NULL OR until > ?", (int(time.time()),)) as cursor:
+            BANNED.update(await cursor.fetchall())
+
+async def ban_user(user_id: int, until: Optional[int], banned_by: int, reason: Optional[str] = None):
+    """Пишет бан в БД и сразу в память; открытые предложения обмена игрока закрываются"""
+    async with uow(write=True) as tx:
+        await tx.execute("""
+            INSERT INTO bans (user_id, until, reason, banned_by, banned_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                until = excluded.until, reason = excluded.reason,
+                banned_by = excluded.banned_by, banned_at = excluded.banned_at
+        """, (user_id, until, reason, banned_by, int(time.time())))
+        await invalidate_offers_for_user(tx, user_id)
+    BANNED[user_id] = until
+
+async def unban_user(user_id: int) -> bool:
+    async with uow(write=True) as tx:
+        cursor = await tx.execute("DELETE FROM bans WHERE user_id = ?", (user_id,))
+    BANNED.pop(user_id, None)
+    return cursor.rowcount > 0
+
+class BanMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None and is_banned(user.id):
+            BAN_STATS["dropped"] += 1
+            return None
+        return await handler(event, data)
+
+# Уровень апдейта: раньше InstrumentMiddleware, роутинга и фильтров
+dp.update.outer_middleware(BanMiddleware())
+
 # ========== ЗАБЛОКИРОВАТЬ ИГРОКА ==========
 
 @dp.callback_query(F.data == "admin_ban")
@@ -1911,7 +2539,7 @@ async def admin_ban_menu(callback: CallbackQuery):
         return
 
     kb = await get_all_players_kb("ban")
-    await callback.message.edit_text("Выберите игрока для блокировки:", reply_markup=kb)
+    await edit_message(callback.message, "Выберите игрока для блокировки:", reply_markup=kb)
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("admin_ban_"))
@@ -1925,11 +2553,16 @@ async def admin_confirm_ban(callback: CallbackQuery):
         return
 
     keyboard = InlineKeyboardBuilder()
-    keyboard.button(text="✅ Заблокировать", callback_data=f"admin_do_ban_{target_id}")
+    for label, seconds in BAN_DURATIONS.items():
+        keyboard.button(text=label, callback_data=f"admin_do_ban_{target_id}_{seconds}")
     keyboard.button(text="❌ Отмена", callback_data="admin_ban")
-    keyboard.adjust(2)
+    keyboard.adjust(3, 1)
 
-    await callback.message.edit_text("⚠️ Вы уверены? Игрок больше не сможет играть!", reply_markup=keyboard.as_markup())
+    await edit_message(
+        callback.message,
+        "⚠️ Игрок не сможет играть, пока действует бан. Прогресс сохраняется — /unban вернёт доступ.",
+        reply_markup=keyboard.as_markup()
+    )
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("admin_do_ban_"))
@@ -1937,17 +2570,29 @@ async def admin_do_ban(callback: CallbackQuery):
     if callback.from_user.username != CREATOR_USERNAME:
         return
 
-    target_id = int(callback.data.split("_")[3])
-    # Простая реализация: удалим из users и user_cars
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM users WHERE user_id = ?", (target_id,))
-        await db.execute("DELETE FROM user_cars WHERE user_id = ?", (target_id,))
-        await db.execute("DELETE FROM user_real_estate WHERE user_id = ?", (target_id,))
-        await db.commit()
+    _, _, _, target_id, seconds = callback.data.split("_")
+    until = int(time.time()) + int(seconds) if int(seconds) else None
+    await ban_user(int(target_id), until, callback.from_user.id)
 
-    await callback.message.edit_text("⛔ Игрок заблокирован (данные удалены).")
+    until_text = f"до {datetime.utcfromtimestamp(until):%d.%m %H:%M} UTC" if until else "навсегда"
+    await edit_message(callback.message, f"⛔ Игрок заблокирован {until_text}. Снять бан: /unban {target_id}")
     await callback.answer()
 
+@dp.message(Command("unban"))
+async def cmd_unban(message: Message):
+    """/unban <user_id>"""
+    if message.from_user.username != CREATOR_USERNAME:
+        return
+
+    args = message.text.split()
+    if len(args) < 2 or not args[1].isdigit():
+        await message.answer(f"❌ Используйте: /unban <user_id>\n⛔ Сейчас забанено: {len(BANNED)}")
+        return
+    if await unban_user(int(args[1])):
+        await message.answer("✅ Бан снят")
+    else:
+        await message.answer("❌ Этот игрок не забанен")
+
 # ========== АННУЛИРОВАТЬ ИГРОКА ==========
 
 @dp.callback_query(F.data == "admin_wipe")
@@ -1956,7 +2601,7 @@ async def admin_wipe_menu(callback: CallbackQuery):
         return
 
     kb = await get_all_players_kb("wipe")
-    await callback.message.edit_text("Выберите игрока для полной аннуляции:", reply_markup=kb)
+    await edit_message(callback.message, "Выберите игрока для полной аннуляции:", reply_markup=kb)
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("admin_wipe_"))
@@ -1974,7 +2619,8 @@ async def admin_confirm_wipe(callback: CallbackQuery):
     keyboard.button(text="❌ Отмена", callback_data="admin_wipe")
     keyboard.adjust(2)
 
-    await callback.message.edit_text(
+    await edit_message(
+        callback.message,
         "⚠️ ВНИМАНИЕ! Это удалит ВЕСЬ прогресс игрока: деньги, машины, таймеры, промокоды. Продолжить?",
         reply_markup=keyboard.as_markup()
     )
@@ -1986,16 +2632,255 @@ async def admin_do_wipe(callback: CallbackQuery):
         return
 
     target_id = int(callback.data.split("_")[3])
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM users WHERE user_id = ?", (target_id,))
-        await db.execute("DELETE FROM user_cars WHERE user_id = ?", (target_id,))
-        await db.execute("DELETE FROM user_real_estate WHERE user_id = ?", (target_id,))
-        await db.commit()
-
-    await callback.message.edit_text("🗑 Прогресс игрока полностью аннулирован.")
+    async with uow(write=True) as tx:
+        # Журнал не чистим: списываем остаток, чтобы пересборка баланса дала 0
+        await tx.execute("""
+            INSERT INTO ledger (user_id, kind, amount, ts)
+            SELECT user_id, ?, -balance, ? FROM users WHERE user_id = ?
+        """, (LEDGER_KINDS["wipe"], int(time.time()), target_id))
+        await tx.execute("DELETE FROM users WHERE user_id = ?", (target_id,))
+        # Машины игрока выбывают из игры — возвращаем их в лимиты max_global
+        async with tx.execute(
+            "SELECT car_id, COUNT(*) FROM user_cars WHERE user_id = ? GROUP BY car_id", (target_id,)
+        ) as cursor:
+            removed = await cursor.fetchall()
+        await tx.executemany("""
+            UPDATE global_car_counts SET issued_count = MAX(issued_count - ?, 0) WHERE car_id = ?
+        """, [(count, car_id) for car_id, count in removed])
+        await tx.execute("DELETE FROM user_cars WHERE user_id = ?", (target_id,))
+        async with tx.execute(
+            "SELECT id FROM market_orders WHERE user_id = ? AND status = 'open'", (target_id,)
+        ) as cursor:
+            cancelled = [row[0] for row in await cursor.fetchall()]
+        await tx.executemany("UPDATE market_orders SET status = 'cancelled' WHERE id = ?", [(i,) for i in cancelled])
+        await invalidate_offers_for_user(tx, target_id)
+        await tx.execute("DELETE FROM user_real_estate WHERE user_id = ?", (target_id,))
+        await tx.execute("DELETE FROM promo_redemptions WHERE user_id = ?", (target_id,))
+
+        def unlist_orders():
+            # Ещё под DB_WRITE_LOCK — биржа не увидит отменённые заявки
+            for order_id in cancelled:
+                MARKET_ORDERS.pop(order_id, None)
+        tx.on_commit(unlist_orders)
+    for car_id, count in removed:
+        note_issued(car_id, -count)
+    forget_cooldowns(target_id)
+    forget_user(target_id)
+    forget_owned(target_id)
+
+    await edit_message(callback.message, "🗑 Прогресс игрока полностью аннулирован.")
     await callback.answer()
+
+# ========== СОЗДАТЬ ПРОМОКОД ==========
+
+@dp.message(Command("addpromo"))
+async def cmd_addpromo(message: Message):
+    """/addpromo <код> <money|drops|car> <значение> [лимит активаций] [срок в днях]"""
+    if message.from_user.username != CREATOR_USERNAME:
+        return
+
+    args = message.text.split()
+    usage = "❌ Используйте: /addpromo <код> <money|drops|car> <значение> [лимит] [дней]"
+    if len(args) < 4 or args[2] not in PROMO_REWARD_TYPES or not all(a.isdigit() for a in args[3:6]):
+        await message.answer(usage)
+        return
+
+    code, reward_type, value = args[1], args[2], int(args[3])
+    max_uses = int(args[4]) if len(args) > 4 and int(args[4]) > 0 else None
+    expires_at = int(time.time()) + int(args[5]) * 86400 if len(args) > 5 else None
+    if reward_type == "car" and value not in catalog().cars_by_id:
+        await message.answer("❌ Машина с таким id не найдена")
+        return
+
+    async with uow(write=True) as tx:
+        cursor = await tx.execute("""
+            INSERT OR IGNORE INTO promo_codes (code, reward_type, reward_value, max_uses, expires_at, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (code, reward_type, value, max_uses, expires_at, int(time.time())))
+
+    if cursor.rowcount == 0:
+        await message.answer("❌ Такой промокод уже существует")
+        return
+    await message.answer(f"✅ Промокод {code} создан")
+
+# ========== ЖУРНАЛ ОПЕРАЦИЙ ==========
+
+@dp.message(Command("ledger"))
+async def cmd_ledger(message: Message):
+    """/ledger <user_id> — последние события игрока и сверка баланса"""
+    if message.from_user.username != CREATOR_USERNAME:
+        return
+
+    args = message.text.split()
+    if len(args) < 2 or not args[1].isdigit():
+        await message.answer("❌ Используйте: /ledger <user_id>")
+        return
+
+    target_id = int(args[1])
+    async with connect_db() as db:
+        async with db.execute("""
+            SELECT kind, amount, car_id, ts FROM ledger WHERE user_id = ? ORDER BY id DESC LIMIT 15
+        """, (target_id,)) as cursor:
+            events = await cursor.fetchall()
+
+    text = f"📒 Журнал игрока {target_id}:\n\n"
+    for kind, amount, car_id, ts in events:
+        car = catalog().cars_by_id.get(car_id)
+        car_text = f" — {car.name}" if car else ""
+        sign = "+" if amount >= 0 else "-"
+        text += f"{datetime.utcfromtimestamp(ts):%d.%m %H:%M} {LEDGER_KIND_NAMES.get(kind, kind)}: {sign}${format_number(abs(amount))}{car_text}\n"
+
+    mismatches = await verify_ledger(target_id)
+    if mismatches:
+        _, balance, replayed = mismatches[0]
+        text += f"\n❌ Расхождение: баланс ${format_number(balance)}, по журналу ${format_number(replayed)}"
+    else:
+        text += "\n✅ Баланс сходится с журналом"
+    await message.answer(text)
+
+# ========== ПЕРЕЗАГРУЗКА КАТАЛОГА ==========
+
+@dp.message(Command("reloadcatalog"))
+async def cmd_reload_catalog(message: Message):
+    if message.from_user.username != CREATOR_USERNAME:
+        return
+
+    old = catalog()
+    try:
+        new = await reload_catalog()
+    except (OSError, ValueError) as e:
+        await message.answer(f"❌ Каталог не загружен, работает версия {old.version}:\n{e}")
+        return
+    removed = len(set(old.cars_by_id) - set(new.cars_by_id))
+    added = len(set(new.cars_by_id) - set(old.cars_by_id))
+    await message.answer(
+        f"✅ Каталог обновлён: версия {old.version} → {new.version}\n"
+        f"🚘 Машин: {len(new.all_cars)} (+{added} / -{removed})"
+    )
+
+# ========== СТАТИСТИКА БОТА ==========
+
+@dp.message(Command("stats"))
+async def cmd_stats(message: Message):
+    if message.from_user.username != CREATOR_USERNAME:
+        return
+
+    total_edits = RENDER_STATS["sent"] + RENDER_STATS["skipped"] + RENDER_STATS["not_modified"]
+    text = (
+        "📊 Статистика отрисовки:\n"
+        f"✏️ edit_text отправлено: {RENDER_STATS['sent']}\n"
+        f"♻️ Пропущено без запроса к API: {RENDER_STATS['skipped']}\n"
+        f"⚠️ Ответов «message is not modified»: {RENDER_STATS['not_modified']}\n"
+        f"📦 Сообщений в кэше: {len(RENDER_CACHE)}"
+    )
+    if total_edits:
+        text += f"\n💡 Сэкономлено запросов: {RENDER_STATS['skipped'] * 100 // total_edits}%"
+    text += (
+        f"\n\n👤 ensure_user: без записи {USER_CACHE_STATS['avoided']}, новых {USER_CACHE_STATS['inserted']}, "
+        f"смен имени записано {USER_CACHE_STATS['renamed']} (в очереди {len(PENDING_NAMES)})"
+        f"\n⛔ Забанено: {len(BANNED)}, отброшено апдейтов: {BAN_STATS['dropped']}"
+        f"\n🖼 Картинки: file_id {len(MEDIA_FILE_IDS)}, показано по file_id {MEDIA_STATS['cached']}, "
+        f"загружено {MEDIA_STATS['uploaded']}, без файла {MEDIA_STATS['missing']}"
+        f"\n🎨 Варианты: нарисовано {VARIANT_STATS['rendered']}, удалено {VARIANT_STATS['evicted']}, "
+        f"ещё не готовы {VARIANT_STATS['not_ready']}"
+    )
+    text += "\n\n" + handler_stats_text()
+    await message.answer(text)
   # main.py — БЛОК 8: Недвижимость и финальная логика
 
+# ========== НАЧИСЛЕНИЕ ДОХОДА ОТ НЕДВИЖИМОСТИ ==========
+
+# 🏢 Доход начисляет фоновый обход: раз в ESTATE_SETTLE_INTERVAL секунд всем владельцам разом,
+# пачками по ESTATE_SETTLE_BATCH игроков на транзакцию — между пачками обработчики успевают писать.
+# Ставки лежат в estate_rates (копия каталога), чтобы начисление было чистым SQL без цикла по игрокам.
+ESTATE_INCOME_PERIOD = 10  # доход капает раз в 10 секунд (income_per_10_sec)
+ESTATE_SETTLE_INTERVAL = int(os.getenv("ESTATE_SETTLE_INTERVAL", "60"))
+ESTATE_SETTLE_BATCH = int(os.getenv("ESTATE_SETTLE_BATCH", "5000"))
+
+def estate_rate_rows(snapshot: Catalog) -> List[tuple]:
+    """Ставки дохода снимка каталога: [(estate_id, income_per_10_sec)]"""
+    return [
+        (estate["id"], estate["income_per_10_sec"])
+        for estates in snapshot.real_estate.values() for estate in estates
+        if estate.get("income_per_10_sec")
+    ]
+
+async def sync_estate_rates(db: aiosqlite.Connection, rates: Optional[List[tuple]] = None):
+    """Переписывает estate_rates из текущего каталога (при старте и после перезагрузки каталога)"""
+    if rates is None:
+        rates = estate_rate_rows(catalog())
+    await db.execute("DELETE FROM estate_rates")
+    await db.executemany("INSERT INTO estate_rates (estate_id, income_per_10_sec) VALUES (?, ?)", rates)
+
+async def settle_estate_income(db: aiosqlite.Connection, after_user: int, upto_user: int, now: int) -> int:
+    """
+    Начисляет накопленный доход владельцам с after_user < user_id <= upto_user.
+    Вызывается внутри транзакции; возвращает число игроков, которым что-то начислено.
+    """
+    period = ESTATE_INCOME_PERIOD
+    await db.execute("CREATE TEMP TABLE IF NOT EXISTS estate_due (user_id INTEGER PRIMARY KEY, amount INTEGER NOT NULL)")
+    await db.execute("DELETE FROM estate_due")
+    cursor = await db.execute("""
+        INSERT INTO estate_due (user_id, amount)
+        SELECT user_real_estate.user_id, SUM((? - collected_at) / ? * income_per_10_sec)
+        FROM user_real_estate JOIN estate_rates ON estate_rates.estate_id = user_real_estate.estate_id
+        WHERE user_real_estate.user_id > ? AND user_real_estate.user_id <= ? AND collected_at <= ?
+        GROUP BY user_real_estate.user_id
+    """, (now, period, after_user, upto_user, now - period))
+    if cursor.rowcount <= 0:
+        return 0
+    settled = cursor.rowcount
+
+    # Сдвигаем отметку на целое число периодов — остаток секунд доначислится в следующий раз
+    await db.execute("""
+        UPDATE user_real_estate SET collected_at = collected_at + (? - collected_at) / ? * ?
+        WHERE user_id > ? AND user_id <= ? AND collected_at <= ?
+          AND estate_id IN (SELECT estate_id FROM estate_rates)
+    """, (now, period, period, after_user, upto_user, now - period))
+    await db.execute("""
+        UPDATE users SET
+            balance = balance + (SELECT amount FROM estate_due WHERE estate_due.user_id = users.user_id),
+            real_estate_income = real_estate_income + (SELECT amount FROM estate_due WHERE estate_due.user_id = users.user_id)
+        WHERE user_id IN (SELECT user_id FROM estate_due)
+    """)
+    await db.execute("""
+        INSERT INTO ledger (user_id, kind, amount, ts)
+        SELECT estate_due.user_id, ?, amount, ? FROM estate_due JOIN users ON users.user_id = estate_due.user_id
+    """, (LEDGER_KINDS["estate_income"], now))
+    return settled
+
+async def settle_all_estate_income(now: Optional[int] = None) -> int:
+    """Один цикл начисления всем владельцам доходной недвижимости; возвращает число игроков"""
+    now = now or int(time.time())
+    settled = 0
+    after_user = 0
+    while True:
+        async with uow(write=True) as tx:
+            async with tx.execute("""
+                SELECT MAX(user_id) FROM (
+                    SELECT DISTINCT user_id FROM user_real_estate WHERE user_id > ? ORDER BY user_id LIMIT ?
+                )
+            """, (after_user, ESTATE_SETTLE_BATCH)) as cursor:
+                upto_user = (await cursor.fetchone())[0]
+            if upto_user is None:
+                await tx.rollback()
+                return settled
+            settled += await settle_estate_income(tx, after_user, upto_user, now)
+        after_user = upto_user
+
+async def estate_settler():
+    """Фоновое начисление дохода: лидерборд по users.balance всегда свежий"""
+    while True:
+        await asyncio.sleep(ESTATE_SETTLE_INTERVAL)
+        start = time.perf_counter()
+        try:
+            settled = await settle_all_estate_income()
+        except Exception:
+            logging.exception("Начисление дохода от недвижимости не удалось")
+            continue
+        if settled:
+            logging.info("Доход от недвижимости: %s игроков за %.2f с", settled, time.perf_counter() - start)
+
 # ========== МЕНЮ НЕДВИЖИМОСТИ ==========
 
 @dp.callback_query(F.data == "menu_realestate")
@@ -2007,13 +2892,13 @@ async def menu_realestate(callback: CallbackQuery):
     keyboard.button(text="📈 Другая недвижимость", callback_data="realestate_income")
     keyboard.button(text="↩️ Меню", callback_data="back_to_main")
     keyboard.adjust(2)
-    await callback.message.edit_text("Выберите тип недвижимости:", reply_markup=keyboard.as_markup())
+    await edit_message(callback.message, "Выберите тип недвижимости:", reply_markup=keyboard.as_markup())
     await callback.answer()
 
 # ========== ОБЩАЯ ФУНКЦИЯ ПОКУПКИ НЕДВИЖИМОСТИ ==========
 
 async def show_estate_page(callback: CallbackQuery, category: str, page: int):
-    estates = REAL_ESTATE.get(category, [])
+    estates = catalog().real_estate.get(category, [])
     if not estates:
         await callback.answer("Категория пуста", show_alert=True)
         return
@@ -2024,17 +2909,13 @@ async def show_estate_page(callback: CallbackQuery, category: str, page: int):
 
     # Проверим, куплен ли уже
     user_id = callback.from_user.id
-    is_purchased = False
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
+    async with uow() as tx:
+        async with tx.execute("""
             SELECT 1 FROM user_real_estate WHERE user_id = ? AND estate_id = ?
         """, (user_id, estate["id"])) as cursor:
             is_purchased = await cursor.fetchone() is not None
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT currency FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            currency = row[0] if row else "USD"
+        view = await project_balance(user_id)
+    currency = view.currency
 
     price_text = "✅ Уже куплено" if is_purchased else format_price(estate["price_usd"], currency)
     income_text = f"\n📈 Доход: {format_price(estate.get('income_per_10_sec', 0), currency)} / 10 сек" if estate.get("income_per_10_sec") else ""
@@ -2052,8 +2933,7 @@ async def show_estate_page(callback: CallbackQuery, category: str, page: int):
     if not is_purchased:
         # Для доходной недвижимости — проверим баланс
         if category == "income_property":
-            balance = await get_balance_with_income(user_id)
-            if balance < 500_000_000:
+            if view.balance < 500_000_000:
                 keyboard.button(text="🔒 Только при ≥500 млн $", callback_data="locked_income")
             else:
                 keyboard.button(text="🛒 Купить", callback_data=f"buy_estate_{estate['id']}")
@@ -2064,7 +2944,7 @@ async def show_estate_page(callback: CallbackQuery, category: str, page: int):
     keyboard.button(text="↩️ Назад", callback_data="menu_realestate")
     keyboard.adjust(2 if (page > 0 and page < len(estates)-1) else 1, 1, 1)
 
-    await callback.message.edit_text(text, reply_markup=keyboard.as_markup())
+    await edit_media_message(callback.message, estate["image"], text, reply_markup=keyboard.as_markup())
     await callback.answer()
 
 @dp.callback_query(F.data == "locked_income")
@@ -2100,10 +2980,10 @@ async def estate_page(callback: CallbackQuery):
 
 @dp.callback_query(F.data.startswith("buy_estate_"))
 async def buy_estate(callback: CallbackQuery):
-    estate_id = callback.data.split("_")[2]
+    estate_id = callback.data[len("buy_estate_"):]  # в id есть "_": house_1
     estate = None
     category = None
-    for cat, items in REAL_ESTATE.items():
+    for cat, items in catalog().real_estate.items():
         for item in items:
             if item["id"] == estate_id:
                 estate = item
@@ -2116,46 +2996,1645 @@ async def buy_estate(callback: CallbackQuery):
         return
 
     user_id = callback.from_user.id
-    balance = await get_balance_with_income(user_id)
+    # Доход, проверки и списание — одной транзакцией
+    async with uow(write=True) as tx:
+        balance = await get_balance_with_income(user_id)
+        async with tx.execute("SELECT 1 FROM user_real_estate WHERE user_id = ? AND estate_id = ?", (user_id, estate_id)) as cursor:
+            owned = await cursor.fetchone() is not None
+        if owned:
+            status = "❌ У вас уже есть эта недвижимость!"
+        elif balance < estate["price_usd"]:
+            status = "❌ Недостаточно средств!"
+        elif category == "income_property" and balance < 500_000_000:
+            # Для доходной недвижимости — двойная проверка
+            status = "❌ Требуется минимум 500 млн USD!"
+        else:
+            status = None
+            await tx.execute("UPDATE users SET balance = balance - ? WHERE user_id = ?", (estate["price_usd"], user_id))
+            await write_ledger(tx, [ledger_row(user_id, "estate_buy", -estate["price_usd"])])
+            await tx.execute("""
+                INSERT INTO user_real_estate (user_id, estate_id, purchased_at, collected_at)
+                VALUES (?, ?, ?, ?)
+            """, (user_id, estate_id, now_iso(), int(time.time())))
+
+    if status:
+        await callback.answer(status, show_alert=True)
+        return
 
-    if balance < estate["price_usd"]:
-        await callback.answer("❌ Недостаточно средств!", show_alert=True)
+    await callback.answer(f"✅ Недвижимость куплена: {estate['name']}", show_alert=True)
+    await menu_realestate(callback)
+
+# main.py — БЛОК 9: Рынок машин (продажа дилеру и биржа игроков)
+
+
+# ========== ЦЕНА ВЫКУПА ДИЛЕРОМ ==========
+
+HOUSE_BASE_RATE = 0.5     # дилер всегда платит минимум половину цены
+HOUSE_RARITY_BONUS = 0.4  # надбавка за редкость (максимум — для единственного экземпляра)
+
+def house_price(car: Car) -> int:
+    """
+    Цена выкупа дилером: чем меньше max_global, тем ближе к цене с надбавкой за редкость.
+    Цены сделок не учитываются — иначе два своих аккаунта накрутят цену на бирже и продадут дилеру.
+    """
+    rarity = 1 / (1 + math.log10(max(car.max_global, 1)))
+    return int(list_value(car) * (HOUSE_BASE_RATE + HOUSE_RARITY_BONUS * rarity))
+
+async def sell_to_house(user_id: int, car_id: int) -> Optional[int]:
+    """
+    Продаёт одну машину игрока дилеру. Машина выбывает из игры,
+    поэтому глобальный счётчик выпуска уменьшается. Возвращает выплату или None.
+    """
+    car = catalog().cars_by_id.get(car_id)
+    if not car:
+        return None
+
+    async with uow(write=True) as tx:
+        # Сначала продаём дубликаты и машины, не выставленные на рынок
+        async with tx.execute("""
+            SELECT id FROM user_cars WHERE user_id = ? AND car_id = ?
+            ORDER BY EXISTS (
+                SELECT 1 FROM market_orders WHERE user_car_id = user_cars.id AND status = 'open'
+            ), is_duplicate DESC, id DESC
+            LIMIT 1
+        """, (user_id, car_id)) as cursor:
+            row = await cursor.fetchone()
+        if not row:
+            await tx.rollback()
+            return None
+        user_car_id = row[0]
+
+        payout = house_price(car)
+        await tx.execute("DELETE FROM user_cars WHERE id = ?", (user_car_id,))
+        await tx.execute("""
+            UPDATE global_car_counts SET issued_count = MAX(issued_count - 1, 0) WHERE car_id = ?
+        """, (car_id,))
+        await tx.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (payout, user_id))
+        await write_ledger(tx, [ledger_row(user_id, "house_sell", payout, car_id)])
+        cancelled = await cancel_orders_for_car_row(tx, user_car_id)
+        await invalidate_offers_for_rows(tx, [user_car_id])
+        gone = await settle_owned(tx, user_id, [car_id])
+
+        def update_caches():
+            unmark_owned(user_id, gone)
+            for order_id in cancelled:
+                MARKET_ORDERS.pop(order_id, None)
+        tx.on_commit(update_caches)
+
+    note_issued(car_id, -1)
+    return payout
+
+# ========== БИРЖА: КНИГА ЗАЯВОК ==========
+
+# Открытые заявки: order_id -> {"user_id", "car_id", "side", "price", "user_car_id"}
+MARKET_ORDERS: Dict[int, Dict] = {}
+# Книги по машинам: car_id -> {"bid": макс-куча (-цена, id), "ask": мин-куча (цена, id)}
+ORDER_BOOKS: Dict[int, Dict[str, list]] = {}
+# Все изменения книги и сделки — в uow(write=True): по одной под DB_WRITE_LOCK, кэш обновляется в on_commit
+
+def book_for(car_id: int) -> Dict[str, list]:
+    book = ORDER_BOOKS.get(car_id)
+    if book is None:
+        book = ORDER_BOOKS[car_id] = {"bid": [], "ask": []}
+    return book
+
+def push_order(order_id: int, order: Dict):
+    MARKET_ORDERS[order_id] = order
+    key = -order["price"] if order["side"] == "bid" else order["price"]
+    heapq.heappush(book_for(order["car_id"])[order["side"]], (key, order_id))
+
+def best_order(car_id: int, side: str) -> Optional[tuple]:
+    """Лучшая открытая заявка стороны side: (order_id, order). Отменённые удаляются лениво."""
+    heap = book_for(car_id)[side]
+    while heap:
+        order_id = heap[0][1]
+        order = MARKET_ORDERS.get(order_id)
+        if order is not None:
+            return order_id, order
+        heapq.heappop(heap)
+    return None
+
+async def load_order_book():
+    """Поднимает открытые заявки из SQLite в память (при старте)"""
+    MARKET_ORDERS.clear()
+    ORDER_BOOKS.clear()
+    async with connect_db() as db:
+        async with db.execute("""
+            SELECT id, user_id, car_id, side, price, user_car_id FROM market_orders WHERE status = 'open'
+        """) as cursor:
+            async for order_id, user_id, car_id, side, price, user_car_id in cursor:
+                push_order(order_id, {
+                    "user_id": user_id, "car_id": car_id, "side": side,
+                    "price": price, "user_car_id": user_car_id,
+                })
+
+async def cancel_orders_for_car_row(db: aiosqlite.Connection, user_car_id: int) -> List[int]:
+    """Закрывает заявки на продажу конкретной машины (она ушла из гаража)"""
+    async with db.execute("""
+        SELECT id FROM market_orders WHERE user_car_id = ? AND status = 'open'
+    """, (user_car_id,)) as cursor:
+        order_ids = [row[0] for row in await cursor.fetchall()]
+    if order_ids:
+        await db.executemany("UPDATE market_orders SET status = 'cancelled' WHERE id = ?", [(i,) for i in order_ids])
+    return order_ids
+
+async def execute_trade(db: aiosqlite.Connection, bid_id: int, bid: Dict, ask_id: int, ask: Dict, price: int):
+    """Переносит машину продавца покупателю и деньги обратно. Вызывается внутри транзакции."""
+    is_duplicate = await has_car(bid["user_id"], ask["car_id"], db)
+    await db.execute("UPDATE users SET balance = balance - ? WHERE user_id = ?", (price, bid["user_id"]))
+    await db.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (price, ask["user_id"]))
+    await write_ledger(db, [
+        ledger_row(bid["user_id"], "market_buy", -price, ask["car_id"]),
+        ledger_row(ask["user_id"], "market_sell", price, ask["car_id"]),
+    ])
+    await db.execute("""
+        UPDATE user_cars SET user_id = ?, is_duplicate = ?, source = 'Рынок', acquired_at = ?, version = version + 1
+        WHERE id = ?
+    """, (bid["user_id"], is_duplicate, now_iso(), ask["user_car_id"]))
+    await invalidate_offers_for_rows(db, [ask["user_car_id"]])
+    await db.executemany("""
+        UPDATE market_orders SET status = 'filled', filled_price = ?, filled_at = ? WHERE id = ?
+    """, [(price, now_iso(), bid_id), (price, now_iso(), ask_id)])
+
+async def order_is_valid(db: aiosqlite.Connection, order: Dict, price: int) -> bool:
+    """Проверка встречной заявки: у продавца есть машина, у покупателя есть деньги"""
+    if order["side"] == "ask":
+        sql, params = "SELECT 1 FROM user_cars WHERE id = ? AND user_id = ?", (order["user_car_id"], order["user_id"])
+    else:
+        sql, params = "SELECT 1 FROM users WHERE user_id = ? AND balance >= ?", (order["user_id"], price)
+    async with db.execute(sql, params) as cursor:
+        return await cursor.fetchone() is not None
+
+async def place_order(user_id: int, car_id: int, side: str, price: int) -> tuple:
+    """
+    Ставит заявку и сразу пытается свести её с лучшей встречной.
+    Возвращает (статус, order_id, встречная заявка). Статус: "filled", "open" или код ошибки.
+    Каждая заявка — на одну машину; сделки не выпускают новых машин,
+    а переносят существующие строки user_cars, поэтому лимиты max_global соблюдаются.
+    """
+    if car_id not in catalog().cars_by_id or price <= 0 or side not in ("bid", "ask"):
+        return "invalid", None, None
+
+    async with uow(write=True) as tx:
+        user_car_id = None
+        if side == "ask":
+            # Выставляем дубликаты первыми и не выставляем одну машину дважды
+            async with tx.execute("""
+                SELECT id FROM user_cars WHERE user_id = ? AND car_id = ? AND NOT EXISTS (
+                    SELECT 1 FROM market_orders WHERE user_car_id = user_cars.id AND status = 'open'
+                )
+                ORDER BY is_duplicate DESC, id DESC LIMIT 1
+            """, (user_id, car_id)) as cursor:
+                row = await cursor.fetchone()
+            if not row:
+                await tx.rollback()
+                return "no_car", None, None
+            user_car_id = row[0]
+        else:
+            async with tx.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)) as cursor:
+                row = await cursor.fetchone()
+            if not row or row[0] < price:
+                await tx.rollback()
+                return "no_money", None, None
+
+        order = {"user_id": user_id, "car_id": car_id, "side": side, "price": price, "user_car_id": user_car_id}
+        cursor = await tx.execute("""
+            INSERT INTO market_orders (user_id, car_id, side, price, user_car_id, status, created_at)
+            VALUES (?, ?, ?, ?, ?, 'open', ?)
+        """, (user_id, car_id, side, price, user_car_id, now_iso()))
+        order_id = cursor.lastrowid
+        if user_car_id is not None:
+            # Выставленную на биржу машину обменять нельзя — старые предложения с ней закрываем
+            await invalidate_offers_for_rows(tx, [user_car_id])
+
+        opposite = "ask" if side == "bid" else "bid"
+        heap = book_for(car_id)[opposite]
+        # Свои и устаревшие встречные заявки вынимаем из кучи, чтобы дойти до следующих,
+        # и возвращаем в finally: из MARKET_ORDERS устаревшие уходят только после коммита
+        skipped = []
+        stale = []
+        match = None
+        try:
+            while heap:
+                other_id = heap[0][1]
+                other = MARKET_ORDERS.get(other_id)
+                if other is None:
+                    heapq.heappop(heap)
+                    continue
+                crosses = other["price"] <= price if side == "bid" else other["price"] >= price
+                if not crosses:
+                    break
+                if other["user_id"] == user_id:
+                    skipped.append(heapq.heappop(heap))  # сам с собой не торгует
+                    continue
+                # Сделка идёт по цене заявки, которая стояла в книге раньше
+                if await order_is_valid(tx, other, other["price"]):
+                    match = other_id, other
+                    break
+                stale.append(other_id)
+                skipped.append(heapq.heappop(heap))
+        finally:
+            for entry in skipped:
+                heapq.heappush(heap, entry)
+
+        if stale:
+            await tx.executemany("UPDATE market_orders SET status = 'cancelled' WHERE id = ?", [(i,) for i in stale])
+
+            def unlist_stale():
+                for stale_id in stale:
+                    MARKET_ORDERS.pop(stale_id, None)
+            tx.on_commit(unlist_stale)
+
+        if not match:
+            tx.on_commit(lambda: push_order(order_id, order))
+            return "open", order_id, None
+
+        other_id, other = match
+        trade_price = other["price"]
+        if side == "bid":
+            await execute_trade(tx, order_id, order, other_id, other, trade_price)
+        else:
+            await execute_trade(tx, other_id, other, order_id, order, trade_price)
+        buyer, seller = (order, other) if side == "bid" else (other, order)
+        gone = await settle_owned(tx, seller["user_id"], [car_id])
+
+        def settle_caches():
+            unmark_owned(seller["user_id"], gone)
+            mark_owned(buyer["user_id"], [car_id])
+            MARKET_ORDERS.pop(other_id, None)
+            note_trade(car_id, trade_price)
+        tx.on_commit(settle_caches)
+        return "filled", order_id, other
+
+async def cancel_order(user_id: int, order_id: int) -> bool:
+    async with uow(write=True) as tx:
+        order = MARKET_ORDERS.get(order_id)
+        if not order or order["user_id"] != user_id:
+            return False
+        await tx.execute("UPDATE market_orders SET status = 'cancelled' WHERE id = ?", (order_id,))
+        tx.on_commit(lambda: MARKET_ORDERS.pop(order_id, None))
+    return True
+
+async def notify_trade(order: Dict):
+    """Сообщает владельцу встречной заявки о сделке"""
+    car = catalog().cars_by_id.get(order["car_id"], UNKNOWN_CAR)
+    action = "куплена" if order["side"] == "bid" else "продана"
+    try:
+        await bot.send_message(order["user_id"], f"📈 Рынок: {car.name} {action} за ${format_number(order['price'])}!")
+    except Exception:
+        pass
+
+MARKET_STATUS_TEXT = {
+    "no_car": "❌ У вас нет свободной машины этой модели для продажи!",
+    "no_money": "❌ Недостаточно средств!",
+    "invalid": "❌ Некорректная заявка",
+}
+
+# ========== ПРОДАТЬ (КНОПКА ИЗ «ВСЕ МАШИНЫ») ==========
+
+@dp.callback_query(F.data.startswith("sell_car_"))
+async def sell_car(callback: CallbackQuery):
+    car_id = int(callback.data.split("_")[2])
+    car = catalog().cars_by_id.get(car_id)
+    if not car:
+        await callback.answer("Машина не найдена", show_alert=True)
         return
 
-    # Для доходной недвижимости — двойная проверка
-    if category == "income_property" and balance < 500_000_000:
-        await callback.answer("❌ Требуется минимум 500 млн USD!", show_alert=True)
+    best_bid = best_order(car_id, "bid")
+    text = (
+        f"💰 Продажа: {car.name}\n\n"
+        f"🏦 Дилер выкупит за ${format_number(house_price(car))}\n"
+        f"📈 Лучшая заявка на покупку: "
+        f"{'$' + format_number(best_bid[1]['price']) if best_bid else 'нет'}"
+    )
+
+    keyboard = InlineKeyboardBuilder()
+    keyboard.button(text="🏦 Продать дилеру", callback_data=f"sell_house_{car_id}")
+    if best_bid:
+        keyboard.button(text=f"⚡ Продать за ${format_number(best_bid[1]['price'])}", callback_data=f"market_ask_{car_id}_{best_bid[1]['price']}")
+    for multiplier in (1, 1.5, 2):
+        price = int(car.price_usd * multiplier)
+        keyboard.button(text=f"📋 Выставить за ${format_number(price)}", callback_data=f"market_ask_{car_id}_{price}")
+    keyboard.button(text="📋 Мои заявки", callback_data="market_my")
+    keyboard.button(text="↩️ Меню", callback_data="back_to_main")
+    keyboard.adjust(1)
+    await edit_message(callback.message, text, reply_markup=keyboard.as_markup())
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("sell_house_"))
+async def sell_house(callback: CallbackQuery):
+    car_id = int(callback.data.split("_")[2])
+    payout = await sell_to_house(callback.from_user.id, car_id)
+    if payout is None:
+        await callback.answer("❌ У вас нет этой машины!", show_alert=True)
         return
+    await callback.answer(f"🏦 Машина продана дилеру за ${format_number(payout)}", show_alert=True)
+    await main_menu(callback.message)
 
-    # Проверим, не куплено ли уже
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT 1 FROM user_real_estate WHERE user_id = ? AND estate_id = ?", (user_id, estate_id)) as cursor:
-            if await cursor.fetchone():
-                await callback.answer("❌ У вас уже есть эта недвижимость!", show_alert=True)
-                return
+# ========== БИРЖА ==========
 
-        # Списываем деньги
-        new_balance = balance - estate["price_usd"]
-        await db.execute("UPDATE users SET balance = ? WHERE user_id = ?", (new_balance, user_id))
+@dp.callback_query(F.data.startswith("market_car_"))
+async def market_car(callback: CallbackQuery):
+    car_id = int(callback.data.split("_")[2])
+    car = catalog().cars_by_id.get(car_id)
+    if not car:
+        await callback.answer("Машина не найдена", show_alert=True)
+        return
 
-        # Добавим в собственность
-        await db.execute("""
-            INSERT INTO user_real_estate (user_id, estate_id, purchased_at, last_collected)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, estate_id, now_iso(), now_iso()))
+    best_ask = best_order(car_id, "ask")
+    best_bid = best_order(car_id, "bid")
+    text = (
+        f"📈 Рынок: {car.name}\n\n"
+        f"🔻 Лучшая цена продажи: {'$' + format_number(best_ask[1]['price']) if best_ask else 'нет'}\n"
+        f"🔺 Лучшая цена покупки: {'$' + format_number(best_bid[1]['price']) if best_bid else 'нет'}"
+    )
 
-        await db.commit()
+    keyboard = InlineKeyboardBuilder()
+    if best_ask:
+        keyboard.button(text=f"⚡ Купить за ${format_number(best_ask[1]['price'])}", callback_data=f"market_bid_{car_id}_{best_ask[1]['price']}")
+    for multiplier in (0.5, 0.8):
+        price = int(car.price_usd * multiplier)
+        keyboard.button(text=f"📋 Заявка на покупку за ${format_number(price)}", callback_data=f"market_bid_{car_id}_{price}")
+    keyboard.button(text="📋 Мои заявки", callback_data="market_my")
+    keyboard.button(text="↩️ Меню", callback_data="back_to_main")
+    keyboard.adjust(1)
+    await edit_message(callback.message, text, reply_markup=keyboard.as_markup())
+    await callback.answer()
 
-    await callback.answer(f"✅ Недвижимость куплена: {estate['name']}", show_alert=True)
-    await menu_realestate(callback)
+@dp.callback_query(F.data.startswith("market_bid_") | F.data.startswith("market_ask_"))
+async def market_place(callback: CallbackQuery):
+    parts = callback.data.split("_")
+    side, car_id, price = parts[1], int(parts[2]), int(parts[3])
+    car = catalog().cars_by_id.get(car_id)
+
+    status, order_id, match = await place_order(callback.from_user.id, car_id, side, price)
+    if status == "filled":
+        await notify_trade(match)
+        action = "Куплено" if side == "bid" else "Продано"
+        await callback.answer(f"✅ {action}: {car.name} за ${format_number(match['price'])}", show_alert=True)
+        await main_menu(callback.message)
+    elif status == "open":
+        await callback.answer("📋 Заявка выставлена на рынок!", show_alert=True)
+    else:
+        await callback.answer(MARKET_STATUS_TEXT[status], show_alert=True)
+
+@dp.callback_query(F.data == "market_my")
+async def market_my(callback: CallbackQuery):
+    user_id = callback.from_user.id
+    orders = [(oid, o) for oid, o in MARKET_ORDERS.items() if o["user_id"] == user_id]
+
+    text = "📋 Ваши заявки:\n\n" if orders else "📋 У вас нет открытых заявок."
+    keyboard = InlineKeyboardBuilder()
+    for order_id, order in orders[:20]:
+        car = catalog().cars_by_id.get(order["car_id"], UNKNOWN_CAR)
+        action = "Покупка" if order["side"] == "bid" else "Продажа"
+        text += f"• {action}: {car.name} — ${format_number(order['price'])}\n"
+        keyboard.button(text=f"❌ {car.name[:25]}", callback_data=f"market_cancel_{order_id}")
+    keyboard.button(text="↩️ Меню", callback_data="back_to_main")
+    keyboard.adjust(1)
+    await edit_message(callback.message, text, reply_markup=keyboard.as_markup())
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("market_cancel_"))
+async def market_cancel(callback: CallbackQuery):
+    order_id = int(callback.data.split("_")[2])
+    if not await cancel_order(callback.from_user.id, order_id):
+        await callback.answer("❌ Заявка уже закрыта", show_alert=True)
+        return
+    await callback.answer("✅ Заявка отменена")
+    await market_my(callback)
+
+# main.py — БЛОК 10: Рыночная стоимость машин
+
+# Стоимость пересчитывается по событиям (выпуск машины, сделка на рынке)
+# только для затронутой машины и хранится в памяти — без пересканирования БД.
+
+SCARCITY_PREMIUM = 1.0              # весь тираж выпущен — стоимость удваивается
+TRADE_PRICE_ALPHA = 0.3             # вес последней сделки в сглаженной цене
+TRADE_VOLUME_HALF_LIFE = 24 * 3600  # объём торгов «забывается» наполовину за сутки
+TRADE_VOLUME_PIVOT = 5.0            # при таком объёме цена сделок весит столько же, сколько редкость
+TRADE_HISTORY_DAYS = 7              # сколько дней сделок поднимать при старте
+MARKET_VALUE_BAND = (0.5, 2.0)      # стоимость не уходит дальше этих долей цены каталога
+
+# car_id -> {"issued", "trade_price", "volume", "volume_at", "value"}
+CAR_MARKET: Dict[int, Dict] = {}
+
+def market_state(car_id: int) -> Dict:
+    state = CAR_MARKET.get(car_id)
+    if state is None:
+        state = CAR_MARKET[car_id] = {
+            "issued": 0, "trade_price": 0.0, "volume": 0.0, "volume_at": 0.0,
+            "value": catalog().prices[car_id],
+        }
+    return state
+
+def decayed_volume(state: Dict, now: float) -> float:
+    if not state["volume"]:
+        return 0.0
+    return state["volume"] * 0.5 ** ((now - state["volume_at"]) / TRADE_VOLUME_HALF_LIFE)
+
+def scarcity_value(car: Car, issued: int) -> float:
+    scarcity = min(issued / max(car.max_global, 1), 1)
+    return car.price_usd * (1 + SCARCITY_PREMIUM * scarcity)
+
+def list_value(car: Car) -> int:
+    """Цена каталога с надбавкой за редкость — без цен сделок"""
+    state = CAR_MARKET.get(car.id)
+    return int(scarcity_value(car, state["issued"] if state else 0))
+
+def compute_market_value(car: Car, state: Dict, now: float) -> int:
+    """Цена с надбавкой за редкость, смешанная с ценой сделок пропорционально объёму торгов"""
+    value = scarcity_value(car, state["issued"])
+    if state["trade_price"]:
+        volume = decayed_volume(state, now)
+        weight = volume / (volume + TRADE_VOLUME_PIVOT)
+        value = value * (1 - weight) + state["trade_price"] * weight
+    # Сделки между своими аккаунтами не должны уводить стоимость сколь угодно далеко
+    low, high = MARKET_VALUE_BAND
+    return int(min(max(value, car.price_usd * low), car.price_usd * high))
+
+def note_issued(car_id: int, delta: int = 1, now: Optional[float] = None):
+    """Событие: машина выпущена (delta > 0) или выведена из игры (delta < 0)"""
+    if car_id not in catalog().cars_by_id:
+        return
+    state = market_state(car_id)
+    state["issued"] = max(state["issued"] + delta, 0)
+    state["value"] = compute_market_value(catalog().cars_by_id[car_id], state, now or time.time())
+
+def note_trade(car_id: int, price: int, now: Optional[float] = None):
+    """Событие: сделка на рынке по цене price"""
+    if car_id not in catalog().cars_by_id:
+        return
+    now = now or time.time()
+    state = market_state(car_id)
+    if state["trade_price"]:
+        state["trade_price"] += TRADE_PRICE_ALPHA * (price - state["trade_price"])
+    else:
+        state["trade_price"] = float(price)
+    state["volume"] = decayed_volume(state, now) + 1
+    state["volume_at"] = now
+    state["value"] = compute_market_value(catalog().cars_by_id[car_id], state, now)
+
+def market_value(car_id: int) -> int:
+    """Текущая рыночная стоимость машины (из кэша)"""
+    state = CAR_MARKET.get(car_id)
+    if state is not None:
+        return state["value"]
+    car = catalog().cars_by_id.get(car_id)
+    return car.price_usd if car else 0
+
+def refresh_market_values(now: Optional[float] = None):
+    """После смены каталога пересчитывает кэш по новым price_usd и max_global"""
+    now = now or time.time()
+    cars_by_id = catalog().cars_by_id
+    for car_id, state in CAR_MARKET.items():
+        car = cars_by_id.get(car_id)
+        if car is not None:
+            state["value"] = compute_market_value(car, state, now)
+
+async def load_market_values():
+    """Начальное заполнение кэша: выпуск машин и сделки за последние дни"""
+    CAR_MARKET.clear()
+    since = (datetime.utcnow() - timedelta(days=TRADE_HISTORY_DAYS)).isoformat()
+    async with connect_db() as db:
+        async with db.execute("SELECT car_id, issued_count FROM global_car_counts") as cursor:
+            for car_id, issued in await cursor.fetchall():
+                note_issued(car_id, issued)
+        # Каждая сделка закрывает две заявки — считаем её один раз, по стороне продавца
+        async with db.execute("""
+            SELECT car_id, filled_price, filled_at FROM market_orders
+            WHERE status = 'filled' AND side = 'ask' AND filled_at >= ?
+            ORDER BY filled_at
+        """, (since,)) as cursor:
+            for car_id, price, filled_at in await cursor.fetchall():
+                note_trade(car_id, price, datetime.fromisoformat(filled_at).replace(tzinfo=timezone.utc).timestamp())
+
+async def garage_values(user_ids: List[int]) -> Dict[int, int]:
+    """Рыночная стоимость гаражей игроков одним сгруппированным запросом"""
+    if not user_ids:
+        return {}
+    placeholders = ",".join("?" * len(user_ids))
+    values = dict.fromkeys(user_ids, 0)
+    async with connect_db() as db:
+        async with db.execute(f"""
+            SELECT user_id, car_id, COUNT(*) FROM user_cars
+            WHERE user_id IN ({placeholders}) GROUP BY user_id, car_id
+        """, user_ids) as cursor:
+            for user_id, car_id, count in await cursor.fetchall():
+                values[user_id] += market_value(car_id) * count
+    return values
+
+# main.py — БЛОК 11: Таймеры (кулдауны)
+
+# ⏳ Таймеры хранятся в БД целыми секундами unix, а проверяются по памяти:
+# вид таймера -> {user_id: когда снова доступно}. Истёкшие записи убирает обход cooldown_sweeper.
+COOLDOWN_PERIODS = {"drop": 30 * 60, "luck_case": 24 * 60 * 60}
+COOLDOWN_COLUMNS = {"drop": "last_drop_at", "luck_case": "last_luck_case_at"}
+COOLDOWNS: Dict[str, Dict[int, int]] = {kind: {} for kind in COOLDOWN_PERIODS}
+COOLDOWN_QUEUE: List[tuple] = []  # куча (ready_at, kind, user_id); устаревшие записи пропускаются при обходе
+NOTIFY_USERS: set = set()  # кто включил /notify
+
+COOLDOWN_SWEEP_INTERVAL = 30  # секунд между обходами
+NOTIFY_BATCH_SIZE = 25  # Telegram пропускает ~30 сообщений в секунду
+
+COOLDOWN_BUSY_TEXT = {
+    "drop": "⏳ Следующая машина через {left}.",
+    "luck_case": "⏳ Акция удачи снова будет доступна через {left}.",
+}
+COOLDOWN_READY_TEXT = {
+    "drop": "🎁 Можно снова выбить машину!",
+    "luck_case": "🍀 Акция удачи снова доступна!",
+}
+
+def format_duration(seconds: int) -> str:
+    hours, rest = divmod(max(seconds, 0), 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours} ч {minutes} мин"
+    if minutes:
+        return f"{minutes} мин {seconds} сек"
+    return f"{seconds} сек"
+
+def start_cooldown(kind: str, user_id: int, started_at: int):
+    """Запоминает таймер, уже записанный в БД"""
+    ready_at = started_at + COOLDOWN_PERIODS[kind]
+    COOLDOWNS[kind][user_id] = ready_at
+    heapq.heappush(COOLDOWN_QUEUE, (ready_at, kind, user_id))
+
+def cooldown_remaining(kind: str, user_id: int, now: Optional[int] = None) -> int:
+    """Сколько секунд осталось до готовности (0 — можно)"""
+    ready_at = COOLDOWNS[kind].get(user_id)
+    if ready_at is None:
+        return 0
+    return max(ready_at - (now or int(time.time())), 0)
+
+def cooldown_text(kind: str, user_id: int) -> str:
+    text = COOLDOWN_BUSY_TEXT[kind].format(left=format_duration(cooldown_remaining(kind, user_id)))
+    if user_id not in NOTIFY_USERS:
+        text += "\n🔔 /notify — напомнить, когда будет готово"
+    return text
+
+def forget_cooldowns(user_id: int):
+    for timers in COOLDOWNS.values():
+        timers.pop(user_id, None)
+    NOTIFY_USERS.discard(user_id)
+
+async def load_cooldowns():
+    """Поднимает в память только идущие таймеры — остальные игроки и так свободны"""
+    now = int(time.time())
+    COOLDOWN_QUEUE.clear()
+    NOTIFY_USERS.clear()
+    async with connect_db() as db:
+        for kind, column in COOLDOWN_COLUMNS.items():
+            COOLDOWNS[kind].clear()
+            async with db.execute(
+                f"SELECT user_id, {column} FROM users WHERE {column} > ?", (now - COOLDOWN_PERIODS[kind],)
+            ) as cursor:
+                for user_id, started_at in await cursor.fetchall():
+                    start_cooldown(kind, user_id, started_at)
+        async with db.execute("SELECT user_id FROM users WHERE notify_ready = 1") as cursor:
+            NOTIFY_USERS.update(row[0] for row in await cursor.fetchall())
+
+def pop_ready_cooldowns(now: int) -> List[tuple]:
+    """Снимает истёкшие таймеры; возвращает [(kind, user_id)] для напоминаний"""
+    ready = []
+    while COOLDOWN_QUEUE and COOLDOWN_QUEUE[0][0] <= now:
+        ready_at, kind, user_id = heapq.heappop(COOLDOWN_QUEUE)
+        if COOLDOWNS[kind].get(user_id) != ready_at:
+            continue  # таймер перезапущен или игрок удалён
+        del COOLDOWNS[kind][user_id]
+        if user_id in NOTIFY_USERS:
+            ready.append((kind, user_id))
+    return ready
+
+async def notify_cooldown_ready(kind: str, user_id: int):
+    try:
+        await bot.send_message(user_id, COOLDOWN_READY_TEXT[kind])
+    except Exception:
+        pass
+
+async def cooldown_sweeper():
+    """Один обход на всех: раз в COOLDOWN_SWEEP_INTERVAL рассылает напоминания пачками"""
+    while True:
+        await asyncio.sleep(COOLDOWN_SWEEP_INTERVAL)
+        ready = pop_ready_cooldowns(int(time.time()))
+        for i in range(0, len(ready), NOTIFY_BATCH_SIZE):
+            await asyncio.gather(*(notify_cooldown_ready(kind, user_id) for kind, user_id in ready[i:i + NOTIFY_BATCH_SIZE]))
+            await asyncio.sleep(1)
+
+@dp.message(Command("notify"))
+async def cmd_notify(message: Message):
+    await ensure_user(message.from_user)
+    user_id = message.from_user.id
+    enabled = user_id not in NOTIFY_USERS
+    async with uow(write=True) as tx:
+        await tx.execute("UPDATE users SET notify_ready = ? WHERE user_id = ?", (enabled, user_id))
+    if enabled:
+        NOTIFY_USERS.add(user_id)
+        await message.answer("🔔 Напомню, когда можно будет снова выбить машину или открыть Акцию удачи.")
+    else:
+        NOTIFY_USERS.discard(user_id)
+        await message.answer("🔕 Напоминания выключены.")
+
+# main.py — БЛОК 12: Инструментирование (время обработчиков и запросы к БД)
+
+# 📊 Время ответа по обработчикам — гистограмма с фиксированными корзинами (как в Prometheus),
+# запросы к БД считаются на тот обработчик, внутри которого выполнялись (через ContextVar).
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+MAX_HANDLER_LABELS = 200  # callback_data приходит от клиента — не даём раздуть словарь
+
+class HandlerStats:
+    __slots__ = ("label", "buckets", "count", "total", "errors", "connections", "nested", "queries", "rows", "db_time")
+
+    def __init__(self, label: str):
+        self.label = label
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        self.connections = 0
+        self.nested = 0  # соединение открыто, пока у этой же задачи уже открыто другое
+        self.queries = 0
+        self.rows = 0
+        self.db_time = 0.0
+
+    def observe(self, seconds: float):
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает квантиль q"""
+        rank = q * self.count
+        seen = 0
+        for bound, hits in zip(LATENCY_BUCKETS, self.buckets):
+            seen += hits
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+HANDLER_STATS: Dict[str, HandlerStats] = {}
+BACKGROUND = "background"  # запуск, обход таймеров, рынок вне обработчиков
+CURRENT_HANDLER: ContextVar[Optional[HandlerStats]] = ContextVar("current_handler", default=None)
+
+def handler_stats(label: str) -> HandlerStats:
+    stats = HANDLER_STATS.get(label)
+    if stats is None:
+        if len(HANDLER_STATS) >= MAX_HANDLER_LABELS:
+            label = "other"
+        stats = HANDLER_STATS.setdefault(label, HandlerStats(label))
+    return stats
+
+def event_label(event) -> str:
+    """Префикс callback_data без id и сумм (market_bid_12_5000 -> market_bid) или имя команды"""
+    if isinstance(event, CallbackQuery):
+        parts = []
+        for part in (event.data or "").split("_"):
+            if part.lstrip("-").isdigit():
+                break
+            parts.append(part)
+        return "_".join(parts) or "callback"
+    text = getattr(event, "text", None) or ""
+    if text.startswith("/"):
+        return text.split()[0].split("@")[0]
+    return "message"
+
+class InstrumentMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        stats = handler_stats(event_label(event))
+        token = CURRENT_HANDLER.set(stats)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.observe(time.perf_counter() - start)
+            CURRENT_HANDLER.reset(token)
+
+dp.callback_query.outer_middleware(InstrumentMiddleware())
+dp.message.outer_middleware(InstrumentMiddleware())
+
+# Только публичный API aiosqlite (execute/executemany/fetch*): его внутренности меняются между версиями
+
+class InstrumentedCursor:
+    """Обёртка над aiosqlite.Cursor: время fetch* и число строк идут в счётчики соединения"""
+    __slots__ = ("cursor", "conn")
+
+    def __init__(self, conn: "InstrumentedConnection", cursor: aiosqlite.Cursor):
+        self.conn = conn
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)  # description, arraysize и прочее
+
+    @property
+    def rowcount(self) -> int:
+        return self.cursor.rowcount
+
+    @property
+    def lastrowid(self) -> Optional[int]:
+        return self.cursor.lastrowid
+
+    def close(self):
+        return self.cursor.close()
+
+    def __aiter__(self):
+        return self.cursor.__aiter__()
+
+    async def fetchone(self):
+        start = time.perf_counter()
+        row = await self.cursor.fetchone()
+        conn = self.conn
+        conn.db_time += time.perf_counter() - start
+        if row is not None:
+            conn.rows += 1
+        return row
+
+    async def fetchmany(self, size: Optional[int] = None):
+        start = time.perf_counter()
+        rows = await (self.cursor.fetchmany(size) if size is not None else self.cursor.fetchmany())
+        conn = self.conn
+        conn.db_time += time.perf_counter() - start
+        conn.rows += len(rows)
+        return rows
+
+    async def fetchall(self):
+        start = time.perf_counter()
+        rows = await self.cursor.fetchall()
+        conn = self.conn
+        conn.db_time += time.perf_counter() - start
+        conn.rows += len(rows)
+        return rows
+
+class QueryResult:
+    """Как у aiosqlite: и await db.execute(...), и async with db.execute(...) as cursor"""
+    __slots__ = ("conn", "sql", "parameters", "batch", "cursor")
+
+    def __init__(self, conn: "InstrumentedConnection", sql: str, parameters, batch: bool):
+        self.conn = conn
+        self.sql = sql
+        self.parameters = parameters
+        self.batch = batch
+        self.cursor = None
+
+    def __await__(self):
+        return self.__aenter__().__await__()
+
+    async def __aenter__(self) -> InstrumentedCursor:
+        # Запрос выполняется и замеряется прямо здесь — без лишней сопрограммы и вызовов на каждый execute
+        conn, sql, parameters, batch = self.conn, self.sql, self.parameters, self.batch
+        statement = SQL_STATS.get(sql)
+        if statement is None:
+            statement = await conn.first_seen(sql, (parameters[0] if parameters else []) if batch else parameters)
+        start = time.perf_counter()
+        cursor = await (conn.conn.executemany if batch else conn.conn.execute)(sql, parameters)
+        elapsed = time.perf_counter() - start
+        conn.queries += 1
+        conn.db_time += elapsed
+        rowcount = cursor.rowcount
+        if rowcount > 0:
+            conn.rows += rowcount
+        if statement is not None:
+            statement.observe(elapsed, conn.stats.label, parameters, batch)
+        self.cursor = InstrumentedCursor(conn, cursor)
+        return self.cursor
+
+    async def __aexit__(self, *exc):
+        await self.cursor.cursor.close()
+
+class InstrumentedConnection:
+    """
+    Обёртка над соединением aiosqlite.connect() со счётчиками запросов, строк и времени.
+    Копит их у себя и один раз при закрытии переносит в статистику обработчика.
+    """
+    __slots__ = ("conn", "stats", "task", "queries", "rows", "db_time")
+
+    def __init__(self, conn: aiosqlite.Connection, stats: HandlerStats):
+        self.conn = conn
+        self.stats = stats
+        self.task = asyncio.current_task()
+        depth = OPEN_CONNECTIONS.get(self.task, 0)
+        if depth:
+            stats.nested += 1
+        OPEN_CONNECTIONS[self.task] = depth + 1
+        self.queries = 0
+        self.rows = 0
+        self.db_time = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)  # rollback, total_changes и прочее — как есть
+
+    async def __aenter__(self) -> "InstrumentedConnection":
+        try:
+            await self.conn
+        except BaseException:
+            await self.close()
+            raise
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def execute(self, sql: str, parameters=None) -> QueryResult:
+        return QueryResult(self, sql, parameters or [], False)
+
+    def executemany(self, sql: str, parameters) -> QueryResult:
+        return QueryResult(self, sql, list(parameters), True)
+
+    async def first_seen(self, sql: str, parameters) -> Optional["StatementStats"]:
+        """Новый текст запроса: снимаем EXPLAIN QUERY PLAN на этом же соединении"""
+        if len(SQL_STATS) >= MAX_TRACKED_STATEMENTS:
+            return None
+        plan = []
+        if sql.split(None, 1)[0].upper() in EXPLAINABLE:
+            try:
+                async with self.conn.execute("EXPLAIN QUERY PLAN " + sql, parameters) as cursor:
+                    plan = [row[3] for row in await cursor.fetchall()]
+            except sqlite3.Error:
+                pass
+        statement = SQL_STATS.setdefault(sql, StatementStats(sql, plan))
+        if statement.full_scan or statement.temp_sort or SQL_DEBUG:
+            write_sql_log({"event": "plan", "handler": self.stats.label, "sql": statement.text, "plan": plan,
+                           "full_scan": statement.full_scan, "temp_sort": statement.temp_sort})
+        return statement
+
+    async def commit(self):
+        start = time.perf_counter()
+        await self.conn.commit()
+        self.db_time += time.perf_counter() - start
+
+    async def close(self):
+        try:
+            await self.conn.close()
+        finally:
+            depth = OPEN_CONNECTIONS.pop(self.task, 1) - 1
+            if depth:
+                OPEN_CONNECTIONS[self.task] = depth
+        stats = self.stats
+        stats.connections += 1
+        stats.queries += self.queries
+        stats.rows += self.rows
+        stats.db_time += self.db_time
+        self.queries = self.rows = 0
+        self.db_time = 0.0
+
+# Сколько соединений сейчас открыто у каждой задачи — больше одного значит вложенное соединение
+OPEN_CONNECTIONS: Dict[Optional[asyncio.Task], int] = {}
+
+def connect_db() -> InstrumentedConnection:
+    """Замена aiosqlite.connect(DB_PATH) со счётчиками для /stats"""
+    stats = CURRENT_HANDLER.get() or handler_stats(BACKGROUND)
+    return InstrumentedConnection(aiosqlite.connect(DB_PATH), stats)
+
+# ========== ЕДИНИЦА РАБОТЫ (UNIT OF WORK) ==========
+
+# 🧾 Одно соединение и одна транзакция на весь сценарий: хелперы, вызванные внутри
+# async with uow(), берут соединение задачи, а не открывают своё.
+#   uow()            — чтение; вложенные uow() получают то же соединение
+#   uow(write=True)  — DB_WRITE_LOCK + BEGIN IMMEDIATE, коммит на выходе, откат при исключении;
+#                      внутри другой записи — SAVEPOINT, откатывается только он
+# Все записи идут через uow(write=True) — DB_WRITE_LOCK напрямую берёт только write_scope.
+# Вложенная запись должна идти в той же задаче: uow(write=True) из другой задачи будет ждать блокировку.
+# tx.on_commit(fn) — fn() после коммита, ещё под DB_WRITE_LOCK (кэши в памяти); при откате не вызывается.
+CURRENT_UOW: ContextVar[Optional["UnitOfWork"]] = ContextVar("current_uow", default=None)
+
+class UnitOfWork:
+    __slots__ = ("db", "task", "scopes")
+
+    def __init__(self, db: InstrumentedConnection):
+        self.db = db
+        self.task = asyncio.current_task()
+        self.scopes: List[List] = []  # [имя savepoint (None — вся транзакция), откатан ли, on_commit]
+
+    def execute(self, sql: str, parameters=None):
+        return self.db.execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters):
+        return self.db.executemany(sql, parameters)
+
+    def on_commit(self, callback):
+        self.scopes[-1][2].append(callback)
+
+    async def rollback(self):
+        """Откатывает текущий пишущий блок; выход из него после этого ничего не коммитит"""
+        scope = self.scopes[-1]
+        if not scope[1]:
+            if scope[0] is None:
+                await self.db.rollback()
+            else:
+                await self.db.execute(f"ROLLBACK TO {scope[0]}")
+            scope[1] = True
+            scope[2].clear()
+
+    @asynccontextmanager
+    async def write_scope(self):
+        if self.scopes:
+            scope = [f"uow_{len(self.scopes)}", False, []]
+            await self.db.execute(f"SAVEPOINT {scope[0]}")
+            self.scopes.append(scope)
+            try:
+                yield
+            except BaseException:
+                await self.rollback()
+                raise
+            finally:
+                self.scopes.pop()
+                await self.db.execute(f"RELEASE {scope[0]}")
+            self.scopes[-1][2].extend(scope[2])
+            return
+        async with DB_WRITE_LOCK:
+            await self.db.execute("BEGIN IMMEDIATE")
+            self.scopes.append([None, False, []])
+            try:
+                yield
+            except BaseException:
+                await self.rollback()
+                raise
+            finally:
+                scope = self.scopes.pop()
+            if not scope[1]:
+                await self.db.commit()
+                for callback in scope[2]:
+                    callback()
+
+@asynccontextmanager
+async def uow(write: bool = False):
+    """async with uow(write=True) as tx: ... — tx.execute/executemany/rollback"""
+    tx = CURRENT_UOW.get()
+    if tx is not None and tx.task is asyncio.current_task():
+        if write:
+            async with tx.write_scope():
+                yield tx
+        else:
+            yield tx
+        return
+    async with connect_db() as db:
+        tx = UnitOfWork(db)
+        token = CURRENT_UOW.set(tx)
+        try:
+            if write:
+                async with tx.write_scope():
+                    yield tx
+            else:
+                yield tx
+        finally:
+            CURRENT_UOW.reset(token)
+
+# ========== ЖУРНАЛ МЕДЛЕННЫХ ЗАПРОСОВ ==========
+
+# 🐢 Каждый новый текст запроса один раз проходит через EXPLAIN QUERY PLAN; запросы дольше
+# SLOW_QUERY_MS пишутся в slow_queries.jsonl (с ротацией) без значений параметров — только типы.
+EXPLAINABLE = ("SELECT", "UPDATE", "DELETE", "INSERT", "REPLACE", "WITH")
+MAX_TRACKED_STATEMENTS = 500  # тексты запросов собираются и через f-строки — ограничиваем словарь
+
+class StatementStats:
+    __slots__ = ("text", "plan", "full_scan", "temp_sort", "count", "total", "max", "slow")
+
+    def __init__(self, sql: str, plan: List[str]):
+        self.text = " ".join(sql.split())
+        self.plan = plan
+        # SEARCH — поиск по индексу, SCAN — проход по всей таблице (или всему индексу)
+        self.full_scan = any(step.startswith("SCAN ") and step != "SCAN CONSTANT ROW" for step in plan)
+        self.temp_sort = any("TEMP B-TREE" in step for step in plan)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+
+    def observe(self, seconds: float, handler: str, parameters, batch: bool = False):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if seconds * 1000 >= SLOW_QUERY_MS:
+            self.slow += 1
+            write_sql_log({
+                "event": "slow", "ts": round(time.time(), 3), "handler": handler,
+                "ms": round(seconds * 1000, 3), "sql": self.text,
+                "params": f"{len(parameters)} строк" if batch else redact_params(parameters),
+                "full_scan": self.full_scan,
+            })
+
+SQL_STATS: Dict[str, StatementStats] = {}
+
+def redact_params(parameters) -> List[str]:
+    """Значения параметров в журнал не попадают — только их типы"""
+    return [type(value).__name__ for value in parameters]
+
+_sql_logger: Optional[logging.Logger] = None
+
+def write_sql_log(record: Dict):
+    global _sql_logger
+    if _sql_logger is None:
+        _sql_logger = logging.getLogger("slow_sql")
+        _sql_logger.propagate = False
+        _sql_logger.setLevel(logging.INFO)
+        file_handler = logging.handlers.RotatingFileHandler(
+            SLOW_QUERY_LOG, maxBytes=5 * 1024 * 1024, backupCount=3, encoding="utf-8"
+        )
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+        _sql_logger.addHandler(file_handler)
+    _sql_logger.info(json.dumps(record, ensure_ascii=False))
+
+def slow_sql_text(limit: int = 10) -> str:
+    if not SQL_STATS:
+        return "🐢 Запросов пока не было"
+    lines = [f"🐢 Запросы по суммарному времени (порог медленных: {SLOW_QUERY_MS:g} мс):"]
+    ranked = sorted(SQL_STATS.values(), key=lambda statement: statement.total, reverse=True)
+    for statement in ranked[:limit]:
+        flags = (" 🔍SCAN" if statement.full_scan else "") + (" 📑SORT" if statement.temp_sort else "")
+        lines.append(
+            f"• {statement.total * 1000:.0f} мс · {statement.count}× · макс {statement.max * 1000:.1f} мс"
+            f" · медленных {statement.slow}{flags}\n  {statement.text[:120]}"
+        )
+    scans = [statement for statement in SQL_STATS.values() if statement.full_scan]
+    if scans:
+        lines.append(f"\n🔍 Полный проход по таблице ({len(scans)}):")
+        for statement in scans[:limit]:
+            lines.append(f"• {statement.text[:120]}\n  {' / '.join(statement.plan)}")
+    return "\n".join(lines)
+
+@dp.message(Command("slowsql"))
+async def cmd_slow_sql(message: Message):
+    if message.from_user.username != CREATOR_USERNAME:
+        return
+    await message.answer(slow_sql_text()[:4000])
+
+def prometheus_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render_prometheus() -> str:
+    """Метрики в текстовом формате Prometheus"""
+    lines = [
+        "# TYPE bot_handler_latency_seconds histogram",
+    ]
+    for label, stats in sorted(HANDLER_STATS.items()):
+        name = prometheus_label(label)
+        cumulative = 0
+        for bound, hits in zip(LATENCY_BUCKETS, stats.buckets):
+            cumulative += hits
+            lines.append(f'bot_handler_latency_seconds_bucket{{handler="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'bot_handler_latency_seconds_bucket{{handler="{name}",le="+Inf"}} {stats.count}')
+        lines.append(f'bot_handler_latency_seconds_sum{{handler="{name}"}} {stats.total:.6f}')
+        lines.append(f'bot_handler_latency_seconds_count{{handler="{name}"}} {stats.count}')
+    counters = (
+        ("bot_handler_errors_total", "errors"),
+        ("bot_db_connections_total", "connections"),
+        ("bot_db_nested_connections_total", "nested"),
+        ("bot_db_queries_total", "queries"),
+        ("bot_db_rows_total", "rows"),
+        ("bot_db_seconds_total", "db_time"),
+    )
+    for metric, field in counters:
+        lines.append(f"# TYPE {metric} counter")
+        for label, stats in sorted(HANDLER_STATS.items()):
+            lines.append(f'{metric}{{handler="{prometheus_label(label)}"}} {getattr(stats, field)}')
+    lines.append("# TYPE bot_render_edits_total counter")
+    for outcome, count in RENDER_STATS.items():
+        lines.append(f'bot_render_edits_total{{outcome="{outcome}"}} {count}')
+    lines.append("# TYPE bot_banned_updates_total counter")
+    lines.append(f"bot_banned_updates_total {BAN_STATS['dropped']}")
+    lines.append("# TYPE bot_banned_users gauge")
+    lines.append(f"bot_banned_users {len(BANNED)}")
+    lines.append("# TYPE bot_media_total counter")
+    for outcome, count in MEDIA_STATS.items():
+        lines.append(f'bot_media_total{{outcome="{outcome}"}} {count}')
+    lines.append("# TYPE bot_media_variants_total counter")
+    for outcome, count in VARIANT_STATS.items():
+        lines.append(f'bot_media_variants_total{{outcome="{outcome}"}} {count}')
+    lines.append("# TYPE bot_ensure_user_total counter")
+    for outcome, count in USER_CACHE_STATS.items():
+        lines.append(f'bot_ensure_user_total{{outcome="{outcome}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+async def start_metrics_server(port: int):
+    """GET /metrics на отдельном порту (aiohttp уже есть в зависимостях aiogram)"""
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    logging.info("Метрики Prometheus: http://0.0.0.0:%s/metrics", port)
+
+def handler_stats_text(limit: int = 15) -> str:
+    """Самые дорогие обработчики по суммарному времени — для /stats"""
+    if not HANDLER_STATS:
+        return "⏱ Обработчики: данных пока нет"
+    lines = ["⏱ Обработчики (вызовы · p50/p95 · запросов и соединений на вызов):"]
+    ranked = sorted(HANDLER_STATS.items(), key=lambda item: item[1].total + item[1].db_time, reverse=True)
+    for label, stats in ranked[:limit]:
+        if not stats.count:
+            # Фоновые задачи: только суммарные запросы, времени ответа у них нет
+            lines.append(f"• {label}: {stats.queries} запр., {stats.connections} соед.")
+            continue
+        lines.append(
+            f"• {label}: {stats.count} · ≤{stats.quantile(0.5) * 1000:g}/≤{stats.quantile(0.95) * 1000:g} мс · "
+            f"{stats.queries / stats.count:.1f} запр., {stats.connections / stats.count:.1f} соед."
+            + (f" · ошибок {stats.errors}" if stats.errors else "")
+        )
+    return "\n".join(lines)
+
+# main.py — БЛОК 13: Генератор случайностей для выпадений (воспроизводимый и проверяемый)
+
+# 🎲 Выбор машины = blake2b(seed, "поток:счётчик") mod размер пула. У каждого процесса
+# свой seed (строка в rng_seeds), у каждого потока ("drop", "luck_case", ...) — свой счётчик.
+# Каждая выдача пишет в rng_draws (seed_id, поток, счётчик, пул, индекс): по этим данным
+# результат пересчитывается офлайн — python main.py verify-draws.
+# RNG_SEED в окружении делает прогон детерминированным (бенчмарки, нагрузочные тесты).
+
+class DrawRng:
+    __slots__ = ("seed", "seed_id", "counters")
+
+    def __init__(self, seed: bytes, seed_id: Optional[int] = None):
+        self.seed = seed
+        self.seed_id = seed_id
+        self.counters: Dict[str, int] = {}
+
+    def choice(self, stream: str, pool: list) -> tuple:
+        """Элемент пула и строка аудита (seed_id, поток, счётчик, размер пула, хеш пула, индекс)"""
+        counter = self.counters.get(stream, 0)
+        self.counters[stream] = counter + 1
+        pick = draw_value(self.seed, stream, counter) % len(pool)
+        return pool[pick], (self.seed_id, stream, counter, len(pool), pool_hash(pool), pick)
+
+def draw_value(seed: bytes, stream: str, counter: int) -> int:
+    digest = hashlib.blake2b(f"{stream}:{counter}".encode(), key=seed, digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+def pool_hash(pool: list) -> int:
+    """crc32 id пула — чтобы при проверке убедиться, что выбор шёл из того же списка"""
+    ids = [item.id if isinstance(item, Car) else item for item in pool]
+    return zlib.crc32(array("q", ids).tobytes())
+
+# До init_rng() (бенчмарки без запуска бота) — случайный seed без записи в БД
+RNG = DrawRng(secrets.token_bytes(32))
+
+async def init_rng(seed: Optional[str] = None) -> DrawRng:
+    """Регистрирует seed этого процесса; seed по умолчанию — RNG_SEED или случайный"""
+    global RNG
+    seed = seed or os.getenv("RNG_SEED")
+    key = hashlib.blake2b(seed.encode(), digest_size=32).digest() if seed else secrets.token_bytes(32)
+    async with uow(write=True) as tx:
+        cursor = await tx.execute(
+            "INSERT INTO rng_seeds (seed, created_at) VALUES (?, ?)", (key.hex(), int(time.time()))
+        )
+    RNG = DrawRng(key, cursor.lastrowid)
+    return RNG
+
+def draw_row(audit: tuple, user_id: int, car_id: int) -> tuple:
+    return audit + (user_id, car_id, int(time.time()))
+
+async def write_draws(db: aiosqlite.Connection, rows: List[tuple]):
+    """Аудит выпадений — в той же транзакции, что и выдача машины"""
+    await db.executemany("""
+        INSERT INTO rng_draws (seed_id, stream, counter, pool_size, pool_hash, pick, user_id, car_id, ts)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+
+async def verify_draws(seed_id: Optional[int] = None) -> List[tuple]:
+    """
+    Пересчитывает индекс каждого выпадения из seed и счётчика.
+    Возвращает несовпадения: (id записи, записанный индекс, пересчитанный индекс или None без seed).
+    """
+    where = "WHERE rng_draws.seed_id = ?" if seed_id is not None else ""
+    params = (seed_id,) if seed_id is not None else ()
+    mismatches = []
+    async with connect_db() as db:
+        async with db.execute(f"""
+            SELECT rng_draws.id, rng_seeds.seed, stream, counter, pool_size, pick
+            FROM rng_draws LEFT JOIN rng_seeds ON rng_seeds.id = rng_draws.seed_id
+            {where}
+        """, params) as cursor:
+            async for draw_id, seed, stream, counter, pool_size, pick in cursor:
+                expected = draw_value(bytes.fromhex(seed), stream, counter) % pool_size if seed else None
+                if expected != pick:
+                    mismatches.append((draw_id, pick, expected))
+    return mismatches
+
+# main.py — БЛОК 14: Картинки машин и недвижимости (кэш file_id)
+
+# 🖼 Поле image из каталога — файл в IMAGES_DIR. Telegram хранит загруженный файл и выдаёт file_id:
+# байты уходят один раз, дальше листание каталога — edit_media с file_id, без загрузки.
+# file_id лежат в media_files и в MEDIA_FILE_IDS; если файл на диске заменили (другой размер или mtime),
+# file_id забывается и картинка загружается заново. Машина без файла показывается с заглушкой,
+# чтобы сообщение оставалось фото: переход фото -> текст в Telegram возможен только новым сообщением.
+# Если картинок нет совсем — страницы текстовые, как раньше. Что лежит на диске, проверяется один раз
+# на снимок каталога и не чаще MEDIA_RESCAN_INTERVAL, а не на каждую страницу.
+# Предзагрузка: python main.py upload-media <chat_id> или при старте, если задан MEDIA_CHAT_ID
+# (чат или канал, куда бот шлёт картинки ради file_id; сообщения сразу удаляются).
+IMAGES_DIR = os.getenv("IMAGES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "images"))
+MEDIA_CHAT_ID = int(os.getenv("MEDIA_CHAT_ID", "0"))
+MEDIA_UPLOAD_DELAY = 1.0  # пауза между загрузками в один чат — лимиты Bot API
+MEDIA_RESCAN_INTERVAL = 600
+MEDIA_PLACEHOLDER = ":placeholder"  # ключ file_id заглушки (рисуется в памяти, файла нет)
+CAPTION_LIMIT = 1024  # длиннее подпись к фото не бывает — такие экраны остаются текстом
+MEDIA_FILE_IDS: Dict[str, str] = {}  # image -> file_id
+MEDIA_STATS = {"cached": 0, "uploaded": 0, "missing": 0}
+IMAGE_PATHS: Dict[str, Optional[str]] = {}  # image -> путь или None (файла нет)
+MEDIA_SCAN = {"key": None, "at": 0.0, "any": False}
+
+def find_image(image: str) -> Optional[str]:
+    """Путь к файлу картинки, если он есть; имена из каталога — только внутри IMAGES_DIR"""
+    if not image or os.path.basename(image) != image:
+        return None
+    path = os.path.join(IMAGES_DIR, image)
+    return path if os.path.isfile(path) else None
+
+def media_scan() -> Dict:
+    """Проверяет картинки каталога на диске — заново при смене снимка каталога или раз в MEDIA_RESCAN_INTERVAL"""
+    key = (catalog(), IMAGES_DIR)
+    now = time.monotonic()
+    if MEDIA_SCAN["key"] != key or now - MEDIA_SCAN["at"] > MEDIA_RESCAN_INTERVAL:
+        IMAGE_PATHS.clear()
+        VARIANT_NAMES.clear()
+        VARIANT_FILES.clear()
+        for image in catalog_images():
+            IMAGE_PATHS[image] = find_image(image)
+        MEDIA_SCAN.update(key=key, at=now, any=any(IMAGE_PATHS.values()))
+    return MEDIA_SCAN
+
+def image_path(image: str) -> Optional[str]:
+    media_scan()
+    try:
+        return IMAGE_PATHS[image]
+    except KeyError:
+        path = IMAGE_PATHS[image] = find_image(image)
+        return path
+
+def media_enabled() -> bool:
+    """Есть ли на диске хоть одна картинка каталога — иначе бот остаётся текстовым"""
+    return media_scan()["any"]
+
+def placeholder_png(width: int = 640, height: int = 360, rgb: tuple = (40, 40, 48)) -> bytes:
+    """Однотонный PNG для машин без картинки — без Pillow, только zlib"""
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+    rows = (b"\x00" + bytes(rgb) * width) * height
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows, 9)) + chunk(b"IEND", b"")
+
+def file_signature(path: str) -> tuple:
+    stat = os.stat(path)
+    return stat.st_size, int(stat.st_mtime)
+
+def catalog_images() -> List[str]:
+    snapshot = catalog()
+    images = {car.image for car in snapshot.all_cars}
+    images.update(estate["image"] for estates in snapshot.real_estate.values() for estate in estates)
+    images.discard("")
+    return sorted(images)
+
+async def load_media():
+    """Поднимает file_id в память, пропуская картинки, файл которых с тех пор заменили"""
+    MEDIA_FILE_IDS.clear()
+    async with connect_db() as db:
+        async with db.execute("SELECT image, file_id, size, mtime FROM media_files") as cursor:
+            rows = await cursor.fetchall()
+    for image, file_id, size, mtime in rows:
+        # Варианты адресуются содержимым — их файл не меняется
+        path = None if image.startswith(VARIANT_PREFIX) else image_path(image)
+        if path and file_signature(path) != (size, mtime):
+            continue
+        MEDIA_FILE_IDS[image] = file_id
+
+async def remember_file_id(image: str, path: Optional[str], file_id: str):
+    size, mtime = file_signature(path) if path else (0, 0)
+    async with uow(write=True) as tx:
+        await tx.execute("""
+            INSERT OR REPLACE INTO media_files (image, file_id, size, mtime, uploaded_at) VALUES (?, ?, ?, ?, ?)
+        """, (image, file_id, size, mtime, int(time.time())))
+    MEDIA_FILE_IDS[image] = file_id
+    MEDIA_STATS["uploaded"] += 1
+
+async def forget_file_id(image: str):
+    """Telegram не принял file_id (например, сменили токен бота) — загрузим файл заново"""
+    MEDIA_FILE_IDS.pop(image, None)
+    async with uow(write=True) as tx:
+        await tx.execute("DELETE FROM media_files WHERE image = ?", (image,))
+
+def media_source(image: str, color: Optional[str] = None) -> tuple:
+    """(ключ file_id, путь к файлу или None): крашеный вариант, если он уже отрисован, иначе исходник"""
+    if color in PAINT_RGB:
+        name = variant_name(image, color)
+        if name:
+            VARIANT_USED[name] = int(time.time())
+            media_key = VARIANT_PREFIX + name
+            if media_key in MEDIA_FILE_IDS:
+                return media_key, None
+            if variant_ready(name):
+                path = os.path.join(VARIANTS_DIR, name)
+                if os.path.isfile(path):  # перед загрузкой: файл могла удалить чистка в другом процессе
+                    return media_key, path
+                VARIANT_FILES[name] = False
+            VARIANT_STATS["not_ready"] += 1  # на запросе не рисуем — ждём build-variants
+    return image, None if image in MEDIA_FILE_IDS else image_path(image)
+
+async def edit_media_message(message: Message, image: str, text: str,
+                             reply_markup: Optional[InlineKeyboardMarkup] = None, color: Optional[str] = None):
+    """Страница каталога с картинкой: edit_media по file_id, первая отправка — загрузка файла"""
+    if len(text) > CAPTION_LIMIT:
+        await edit_message(message, text, reply_markup)
+        return
+    media_key, path = media_source(image, color)
+    file_id = MEDIA_FILE_IDS.get(media_key)
+    if not file_id and not path:
+        if media_key != MEDIA_PLACEHOLDER:
+            MEDIA_STATS["missing"] += 1
+        if not media_enabled():
+            await edit_message(message, text, reply_markup)
+            return
+        media_key = MEDIA_PLACEHOLDER
+        file_id = MEDIA_FILE_IDS.get(media_key)
+
+    key = (message.chat.id, message.message_id)
+    fingerprint = render_fingerprint(f"{media_key}\n{text}", reply_markup)
+    if render_skipped(key, fingerprint):
+        return
+    if file_id:
+        media = file_id
+    elif path:
+        media = FSInputFile(path)
+    else:
+        media = BufferedInputFile(placeholder_png(), "placeholder.png")
+    try:
+        if message.photo:
+            sent = await message.edit_media(InputMediaPhoto(media=media, caption=text), reply_markup=reply_markup)
+        else:
+            # Текстовое сообщение в фото не превратить — присылаем новое вместо него
+            sent = await message.answer_photo(media, caption=text, reply_markup=reply_markup)
+            await replace_message(message, sent)
+            key = (sent.chat.id, sent.message_id)
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            RENDER_STATS["not_modified"] += 1
+            remember_render(key, fingerprint)
+            return
+        if not file_id:
+            raise
+        await forget_file_id(media_key)
+        await edit_media_message(message, image, text, reply_markup, color)
+        return
+
+    RENDER_STATS["sent"] += 1
+    remember_render(key, fingerprint)
+    if file_id:
+        MEDIA_STATS["cached"] += 1
+    elif isinstance(sent, Message) and sent.photo:
+        await remember_file_id(media_key, path, sent.photo[-1].file_id)
+
+async def upload_media(chat_id: int) -> tuple:
+    """Загружает картинки каталога без file_id. Возвращает (загружено, нет файла)"""
+    uploaded = missing = 0
+    if media_enabled() and MEDIA_PLACEHOLDER not in MEDIA_FILE_IDS:
+        message = await bot.send_photo(chat_id, BufferedInputFile(placeholder_png(), "placeholder.png"))
+        await remember_file_id(MEDIA_PLACEHOLDER, None, message.photo[-1].file_id)
+        try:
+            await message.delete()
+        except TelegramBadRequest:
+            pass
+    for image in catalog_images():
+        if image in MEDIA_FILE_IDS:
+            continue
+        path = image_path(image)
+        if not path:
+            missing += 1
+            continue
+        message = await bot.send_photo(chat_id, FSInputFile(path))
+        await remember_file_id(image, path, message.photo[-1].file_id)
+        try:
+            await message.delete()
+        except TelegramBadRequest:
+            pass
+        uploaded += 1
+        await asyncio.sleep(MEDIA_UPLOAD_DELAY)
+    return uploaded, missing
+
+async def media_preloader():
+    try:
+        uploaded, missing = await upload_media(MEDIA_CHAT_ID)
+    except Exception:
+        logging.exception("Предзагрузка картинок не удалась")
+        return
+    logging.info("Картинки: загружено %s, файлов нет %s, file_id всего %s", uploaded, missing, len(MEDIA_FILE_IDS))
+
+# 🎨 Перекрашенные машины. Вариант «картинка × цвет» рисуется заранее в пуле процессов
+# (python main.py build-variants, нужен Pillow) и никогда — на запросе: пока варианта нет, показываем исходник.
+# Имя варианта — sha256 от содержимого исходника, RGB цвета и VARIANT_VERSION: файл под именем
+# не меняется, новый исходник даёт новые имена. file_id варианта регистрируется при первом показе
+# (в media_files под ключом VARIANT_PREFIX + имя). Диск ограничен VARIANTS_MAX_MB — после сборки
+# удаляются давно не показанные варианты; у кого уже есть file_id, тот заново не рисуется.
+VARIANTS_DIR = os.getenv("VARIANTS_DIR", os.path.join(IMAGES_DIR, "variants"))
+VARIANTS_MAX_BYTES = int(os.getenv("VARIANTS_MAX_MB", "512")) * 1024 * 1024
+VARIANT_PREFIX = "variant:"
+VARIANT_VERSION = 1      # поменять вместе с render_variant — все варианты нарисуются заново
+VARIANT_TINT = 0.55      # доля краски поверх исходника
+VARIANT_MAX_SIDE = 1280
+VARIANT_FLUSH_INTERVAL = 300
+SOURCE_DIGESTS: Dict[str, tuple] = {}  # путь -> (размер, mtime, sha256 содержимого)
+# Как и IMAGE_PATHS, сбрасываются в media_scan: показ страницы не читает диск
+VARIANT_NAMES: Dict[tuple, Optional[str]] = {}  # (image, цвет) -> имя варианта
+VARIANT_FILES: Dict[str, bool] = {}             # имя -> файл варианта уже нарисован
+VARIANT_USED: Dict[str, int] = {}      # имя -> время показа, ещё не записанное в media_variants
+VARIANT_STATS = {"rendered": 0, "evicted": 0, "not_ready": 0}
+
+def source_digest(path: str) -> str:
+    signature = file_signature(path)
+    cached = SOURCE_DIGESTS.get(path)
+    if cached and cached[:2] == signature:
+        return cached[2]
+    with open(path, "rb") as f:
+        digest = hashlib.file_digest(f, "sha256").hexdigest()
+    SOURCE_DIGESTS[path] = (*signature, digest)
+    return digest
+
+def variant_name(image: str, color: str) -> Optional[str]:
+    path = image_path(image)
+    if not path:
+        return None
+    try:
+        return VARIANT_NAMES[image, color]
+    except KeyError:
+        pass
+    key = f"{source_digest(path)}:{PAINT_RGB[color]}:{VARIANT_VERSION}"
+    name = VARIANT_NAMES[image, color] = hashlib.sha256(key.encode()).hexdigest()[:32] + ".jpg"
+    return name
+
+def variant_ready(name: str) -> bool:
+    ready = VARIANT_FILES.get(name)
+    if ready is None:
+        ready = VARIANT_FILES[name] = os.path.isfile(os.path.join(VARIANTS_DIR, name))
+    return ready
+
+def rescan_media():
+    """Файлы на диске изменились в этом процессе (сборка или чистка вариантов)"""
+    MEDIA_SCAN["key"] = None
+
+def paintable_images() -> List[str]:
+    """Красить можно машины из салона и тюнинга (см. menu_my_cars)"""
+    snapshot = catalog()
+    cars = snapshot.salon_cars + [car for cars in snapshot.tuning_brands.values() for car in cars]
+    return sorted({car.image for car in cars if car.image})
+
+def render_variant(source: str, rgb: tuple, target: str) -> int:
+    """Выполняется в процессе пула: краска умножается на яркость исходника, блики и тени остаются"""
+    from PIL import Image, ImageChops
+
+    with Image.open(source) as img:
+        base = img.convert("RGB")
+    base.thumbnail((VARIANT_MAX_SIDE, VARIANT_MAX_SIDE))
+    paint = ImageChops.multiply(base.convert("L").convert("RGB"), Image.new("RGB", base.size, rgb))
+    tmp = f"{target}.{os.getpid()}.tmp"
+    Image.blend(base, paint, VARIANT_TINT).save(tmp, "JPEG", quality=85, optimize=True)
+    os.replace(tmp, target)  # читатели не увидят недописанный файл
+    return os.path.getsize(target)
+
+async def build_variants(workers: Optional[int] = None) -> int:
+    """Дорисовывает недостающие варианты и ужимает каталог до бюджета. Возвращает число нарисованных"""
+    os.makedirs(VARIANTS_DIR, exist_ok=True)
+    jobs = {}
+    for image in paintable_images():
+        path = image_path(image)
+        if not path:
+            continue
+        for color, rgb in PAINT_RGB.items():
+            name = variant_name(image, color)
+            if VARIANT_PREFIX + name in MEDIA_FILE_IDS or os.path.isfile(os.path.join(VARIANTS_DIR, name)):
+                continue
+            jobs[name] = (image, color, path, rgb)
+
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = await asyncio.gather(*(
+            loop.run_in_executor(pool, render_variant, path, rgb, os.path.join(VARIANTS_DIR, name))
+            for name, (image, color, path, rgb) in jobs.items()
+        ), return_exceptions=True)
+
+    now = int(time.time())
+    rows = []
+    for (name, (image, color, path, rgb)), size in zip(jobs.items(), results):
+        if isinstance(size, Exception):
+            logging.error("Вариант %s (%s) не нарисован: %s", image, color, size)
+            continue
+        rows.append((name, image, color, size, now))
+    async with uow(write=True) as tx:
+        await tx.executemany(
+            "INSERT OR REPLACE INTO media_variants (name, image, color, size, used_at) VALUES (?, ?, ?, ?, ?)", rows
+        )
+    VARIANT_STATS["rendered"] += len(rows)
+    rescan_media()
+    await prune_variants()
+    return len(rows)
+
+async def flush_variant_usage():
+    if not VARIANT_USED:
+        return
+    used = list(VARIANT_USED.items())
+    VARIANT_USED.clear()
+    async with uow(write=True) as tx:
+        await tx.executemany(
+            "UPDATE media_variants SET used_at = MAX(used_at, ?) WHERE name = ?", [(at, name) for name, at in used]
+        )
+
+async def variant_usage_flusher():
+    while True:
+        await asyncio.sleep(VARIANT_FLUSH_INTERVAL)
+        try:
+            await flush_variant_usage()
+        except Exception:
+            logging.exception("Не удалось записать показы вариантов")
+
+async def prune_variants(max_bytes: Optional[int] = None) -> int:
+    """LRU по used_at: удаляет давно не показанные варианты, пока каталог больше бюджета"""
+    budget = VARIANTS_MAX_BYTES if max_bytes is None else max_bytes
+    await flush_variant_usage()
+    async with connect_db() as db:
+        async with db.execute("SELECT name, used_at FROM media_variants") as cursor:
+            used = dict(await cursor.fetchall())
+    files = []
+    with os.scandir(VARIANTS_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith(".jpg"):
+                stat = entry.stat()
+                files.append((used.get(entry.name, int(stat.st_mtime)), entry.name, stat.st_size))
+    total = sum(size for _, _, size in files)
+    evicted = []
+    for _, name, size in sorted(files):
+        if total <= budget:
+            break
+        os.remove(os.path.join(VARIANTS_DIR, name))
+        total -= size
+        evicted.append((name,))
+    if evicted:
+        async with uow(write=True) as tx:
+            await tx.executemany("DELETE FROM media_variants WHERE name = ?", evicted)
+    VARIANT_STATS["evicted"] += len(evicted)
+    rescan_media()
+    return len(evicted)
 
 # ========== ФИНАЛЬНЫЙ ЗАПУСК ==========
 
 async def main():
     await dp.start_polling(bot)
 
+async def cli_verify_ledger(args: List[str]):
+    """python main.py verify-ledger [user_id] — сверка балансов с журналом"""
+    await init_db()
+    mismatches = await verify_ledger(int(args[0]) if args else None)
+    for user_id, balance, replayed in mismatches:
+        print(f"❌ {user_id}: баланс {balance}, по журналу {replayed} (разница {balance - replayed})")
+    print("✅ Журнал сходится с балансами." if not mismatches else f"Расхождений: {len(mismatches)}")
+
+async def cli_verify_draws(args: List[str]):
+    """python main.py verify-draws [seed_id] — пересчёт выпадений из seed и счётчиков"""
+    await init_db()
+    mismatches = await verify_draws(int(args[0]) if args else None)
+    for draw_id, pick, expected in mismatches:
+        print(f"❌ выпадение {draw_id}: записан индекс {pick}, по seed {expected}")
+    print("✅ Все выпадения воспроизводятся из seed." if not mismatches else f"Расхождений: {len(mismatches)}")
+
+async def cli_upload_media(args: List[str]):
+    """python main.py upload-media [chat_id] — загрузка картинок каталога в Telegram и запись file_id"""
+    chat_id = int(args[0]) if args else MEDIA_CHAT_ID
+    if not chat_id:
+        print("❌ Укажите chat_id или MEDIA_CHAT_ID")
+        return
+    await init_db()
+    await load_media()
+    try:
+        uploaded, missing = await upload_media(chat_id)
+    finally:
+        await bot.session.close()
+    print(f"✅ Загружено: {uploaded}, file_id всего: {len(MEDIA_FILE_IDS)}, файлов нет: {missing}")
+
+async def cli_build_variants(args: List[str]):
+    """python main.py build-variants [процессов] — перекрашенные картинки для покраски машин"""
+    if importlib.util.find_spec("PIL") is None:
+        print("❌ Для вариантов нужен Pillow: pip install Pillow")
+        return
+    await init_db()
+    await load_media()
+    rendered = await build_variants(int(args[0]) if args else None)
+    print(f"✅ Нарисовано: {rendered}, удалено по бюджету: {VARIANT_STATS['evicted']}")
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:2] == ["verify-ledger"]:
+        asyncio.run(cli_verify_ledger(sys.argv[2:]))
+        sys.exit(0)
+    if sys.argv[1:2] == ["verify-draws"]:
+        asyncio.run(cli_verify_draws(sys.argv[2:]))
+        sys.exit(0)
+    if sys.argv[1:2] == ["upload-media"]:
+        asyncio.run(cli_upload_media(sys.argv[2:]))
+        sys.exit(0)
+    if sys.argv[1:2] == ["build-variants"]:
+        asyncio.run(cli_build_variants(sys.argv[2:]))
+        sys.exit(0)
     try:
         asyncio.run(main())
     except KeyboardInterrupt: